@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import logging
+from typing import Dict, List, Set, Tuple
+
+from web3.contract import Contract
+
+from async_rpc import AsyncRpcClient
+from block_window import AdaptiveBlockWindow, async_fetch_splitting_range
+from bloom_index import BloomIndex
+from data_models import DecentralizedExchangeType, DexTradePair, DexTradeSync, Tx
+from entity_factory import EntityFactory
+from log_decoder import PairCreatedLog, decode_pair_created, decode_sync
+from pair_registry import PairRecord, PairRegistry
+from web3_utils import get_nowbnb_token, PAIR_CREATED_EVENT_TOPIC, SYNC_EVENT_TOPIC
+
+RETRY_WAIT_SECONDS = 10
+
+
+class AsyncWindowImporter:
+    """
+    asyncio counterpart of main.get_new_pairs and main.get_window_sync_logs and main.get_window_syncs.
+
+    Every eth_getLogs of a window is issued concurrently through an AsyncRpcClient. Txs, blocks and the (rare) new
+    pairs are resolved in worker threads through EntityFactory, batched and cached like in the thread engine.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+            self,
+            client: AsyncRpcClient,
+            dex_factories: Dict[DecentralizedExchangeType, Contract],
+            e_factory: EntityFactory,
+            window: AdaptiveBlockWindow,
+            sync_addresses_per_request: int,
+            bloom_index: BloomIndex = None
+    ):
+        self.client = client
+        self.dex_factories = dex_factories
+        self.e_factory = e_factory
+        self.window = window
+        self.sync_addresses_per_request = sync_addresses_per_request
+        self.bloom_index = bloom_index
+
+    async def __handle_exception(self, retry: int, e: Exception) -> None:
+        if retry > 2:
+            self.logger.exception(f"ERROR (retry #{retry})")
+        await asyncio.sleep(RETRY_WAIT_SECONDS)
+
+    async def __get_logs(self, from_block: int, to_block: int, log_filter: dict) -> list:
+        if self.bloom_index:
+            # Only the part of the range where the bloom index (prepared for the window already) may have matches
+            addresses = log_filter.get('address')
+            block_span = self.bloom_index.span(
+                from_block, to_block, [addresses] if isinstance(addresses, str) else addresses, log_filter['topics'][0]
+            )
+            if block_span is None:
+                return []
+            from_block, to_block = block_span
+
+        return await async_fetch_splitting_range(
+            lambda range_start, range_end: self.client.get_raw_logs(
+                dict(log_filter, fromBlock=range_start, toBlock=range_end)
+            ),
+            from_block, to_block, self.window, self.__handle_exception
+        )
+
+    async def get_new_pairs(self, from_block: int, to_block: int) -> List[DexTradePair]:
+        async def __get_pair_created_events(
+                dex, factory_contract
+        ) -> List[Tuple[DecentralizedExchangeType, PairCreatedLog]]:
+            pair_logs = await self.__get_logs(from_block, to_block, {
+                'address': factory_contract.address,
+                'topics': [PAIR_CREATED_EVENT_TOPIC]
+            })
+            return [(dex, decode_pair_created(log)) for log in pair_logs]
+
+        async def __process_pair(dex, pair_created) -> DexTradePair:
+            loop = asyncio.get_running_loop()
+            for retry in itertools.count():
+                try:
+                    return await loop.run_in_executor(None, self.e_factory.get_DexTradePair, dex, pair_created)
+                except (Exception,) as e:
+                    await self.__handle_exception(retry, e)
+
+        pair_created_events = list(itertools.chain.from_iterable(await asyncio.gather(*(
+            __get_pair_created_events(dex, factory_contract) for dex, factory_contract in self.dex_factories.items()
+        ))))
+        # The tokens of every new pair in a few multicalls, instead of three eth_calls each
+        await self.__prefetch_tokens(filter(None, (
+            get_nowbnb_token(pair_created.token0, pair_created.token1) for _, pair_created in pair_created_events
+        )))
+        new_pairs = await asyncio.gather(*(
+            __process_pair(dex, pair_created) for dex, pair_created in pair_created_events
+        ))
+
+        return list(filter(None, new_pairs))
+
+    async def get_sync_logs(
+            self,
+            poll_pairs: List[PairRecord],
+            pairs: PairRegistry,
+            from_block: int,
+            to_block: int
+    ) -> list:
+        addresses = [pair.hex_address for pair in poll_pairs]
+        if self.sync_addresses_per_request > 0:
+            address_chunks = [
+                addresses[i:i + self.sync_addresses_per_request]
+                for i in range(0, len(addresses), self.sync_addresses_per_request)
+            ]
+        else:
+            address_chunks = [None]
+
+        async def __get_sync_logs(address_chunk) -> list:
+            log_filter = {'topics': [SYNC_EVENT_TOPIC]}
+            if address_chunk:
+                log_filter['address'] = address_chunk
+
+            # Topic-only requests bring logs from pairs we do not track, drop them here
+            return [
+                log for log in await self.__get_logs(from_block, to_block, log_filter)
+                if log['address'] in pairs
+            ]
+
+        sync_logs = list(itertools.chain.from_iterable(
+            await asyncio.gather(*(__get_sync_logs(address_chunk) for address_chunk in address_chunks))
+        ))
+        self.logger.debug(f"\tGot {len(sync_logs)} sync logs with {len(address_chunks)} requests")
+        return sync_logs
+
+    async def get_syncs(self, sync_logs: list, pairs: PairRegistry) -> List[DexTradeSync]:
+        sync_events = [decode_sync(log) for log in sync_logs]
+        txs = await self.__get_txs({sync.tx_hash for sync in sync_events})
+        pairs_by_addr = {pair_addr: pairs.pair(pair_addr) for pair_addr in {sync.address for sync in sync_events}}
+
+        syncs = [
+            self.e_factory.get_DexTradeSync(sync, pairs_by_addr[sync.address], tx=txs[sync.tx_hash])
+            for sync in sync_events
+        ]
+        self.logger.debug(f"\t{len(pairs_by_addr)}/{len(pairs)} pairs traded")
+
+        return syncs
+
+    async def __prefetch_tokens(self, token_addrs) -> None:
+        token_addrs = list(token_addrs)
+        if not token_addrs:
+            return
+        loop = asyncio.get_running_loop()
+        for retry in itertools.count():
+            try:
+                await loop.run_in_executor(None, self.e_factory.prefetch_tokens, token_addrs)
+                return
+            except (Exception,) as e:
+                await self.__handle_exception(retry, e)
+
+    async def __get_txs(self, tx_hashes) -> Dict[str, Tx]:
+        """
+        Txs and their blocks as the thread engine gets them, from the caches, the DDBB, the timestamp sampler and
+        batched requests (see EntityFactory.prefetch_txs), retrying the ones that could not be resolved
+        """
+        tx_hashes = set(tx_hashes)
+        txs: Dict[str, Tx] = {}
+        loop = asyncio.get_running_loop()
+        for retry in itertools.count():
+            try:
+                txs.update(await loop.run_in_executor(None, self.__resolve_txs, tx_hashes - txs.keys()))
+                return txs
+            except (Exception,) as e:
+                await self.__handle_exception(retry, e)
+
+    def __resolve_txs(self, tx_hashes: Set[str]) -> Dict[str, Tx]:
+        txs = self.e_factory.prefetch_txs(tx_hashes)
+        # The ones a failed batch or a lagging node left out, one by one: a tx not found yet raises and is retried
+        txs.update({tx_hash: self.e_factory.get_tx(tx_hash) for tx_hash in tx_hashes - txs.keys()})
+        return txs
@@ -0,0 +1,153 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from block_window import is_oversize_error
+from metrics import RPC_CALLS, RPC_RETRIES, RPC_SECONDS, provider_label
+from provider_scheduler import ProviderScheduler, ScheduledEndpoint, is_throttle_error
+from rpc_cache import RpcResponseCache
+from web3_utils import get_provider_scheduler
+
+# Requests waiting for an answer from a single provider at any given time
+MAX_IN_FLIGHT_PER_PROVIDER = 64
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_REQUEST_RETRIES = 10
+RETRY_WAIT_SECONDS = 1
+
+
+class RpcError(Exception):
+    def __init__(self, endpoint_uri: str, error: Any):
+        super().__init__(f"{endpoint_uri}: {error}")
+        self.endpoint_uri = endpoint_uri
+        self.error = error
+
+
+class AsyncRpcClient:
+    """
+    asyncio JSON-RPC client for the eth_getLogs calls of the asyncio engine.
+
+    Every request goes to the endpoint a ProviderScheduler picks, the one the thread engine shares, so rate limits
+    and throttle cooldowns hold whichever engine runs. Requests are not hedged. Every provider also gets a pool of
+    keep-alive connections and a semaphore bounding the requests in flight against it, so thousands of requests can
+    be awaited concurrently without flooding a single node. Failed requests are retried on another provider.
+
+    Logs come as the node sent them, for log_decoder.py. Txs and blocks are resolved by EntityFactory instead, with
+    the batches, caches and timestamp sampler of the thread engine.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+            self,
+            scheduler: ProviderScheduler = None,
+            max_in_flight_per_provider: int = MAX_IN_FLIGHT_PER_PROVIDER,
+            timeout_seconds: float = REQUEST_TIMEOUT_SECONDS,
+            cache: RpcResponseCache = None
+    ):
+        self.scheduler = scheduler or get_provider_scheduler()
+        self.endpoint_uris = [endpoint.endpoint_uri for endpoint in self.scheduler.endpoints]
+
+        self.max_in_flight_per_provider = max_in_flight_per_provider
+        self.timeout_seconds = timeout_seconds
+        self.cache = cache
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.__request_ids = itertools.count()
+
+    def __str__(self):
+        return f"AsyncRpcClient<{len(self.endpoint_uris)} providers, {self.max_in_flight_per_provider} in flight each>"
+
+    async def open(self) -> None:
+        """ Must be awaited from the event loop the client will be used in """
+        connector = aiohttp.TCPConnector(
+            limit=0,  # Bounded per host by the semaphores
+            limit_per_host=self.max_in_flight_per_provider,
+            keepalive_timeout=60
+        )
+        self.__session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+            headers={'Content-Type': 'application/json'}
+        )
+        self.__semaphores = {uri: asyncio.Semaphore(self.max_in_flight_per_provider) for uri in self.endpoint_uris}
+
+    async def close(self) -> None:
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
+
+    async def __aenter__(self) -> 'AsyncRpcClient':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def request(self, method: str, params: List[Any]) -> Any:
+        if not self.__session:
+            raise RuntimeError("AsyncRpcClient is not open")
+
+        if self.cache:
+            # Local disk, fast enough not to leave the event loop
+            found, result = self.cache.get(method, params)
+            if found:
+                return result
+
+        failed: List[ScheduledEndpoint] = []
+        for retry in itertools.count():
+            if retry:
+                RPC_RETRIES.inc(method=method)
+            endpoint = await self.scheduler.acquire_async(exclude=failed)
+            try:
+                result = await self.__request(endpoint, method, params)
+                if self.cache:
+                    self.cache.put(method, params, result)
+                return result
+            except (Exception,) as e:
+                failed.append(endpoint)
+                # Asking another node will not help when the range is too big, let the caller split it
+                if retry >= MAX_REQUEST_RETRIES or is_oversize_error(e):
+                    raise
+                if retry > 2:
+                    self.logger.warning(f"{method} failed (retry #{retry}): {e}")
+                await asyncio.sleep(RETRY_WAIT_SECONDS * min(retry, 10))
+
+    async def __request(self, endpoint: ScheduledEndpoint, method: str, params: List[Any]) -> Any:
+        endpoint_uri = endpoint.endpoint_uri
+        payload = json.dumps({"jsonrpc": "2.0", "method": method, "params": params, "id": next(self.__request_ids)})
+        provider = provider_label(endpoint_uri)
+        async with self.__semaphores[endpoint_uri]:
+            RPC_CALLS.inc(provider=provider, method=method)
+            start_time = time.monotonic()
+            try:
+                async with self.__session.post(endpoint_uri, data=payload) as response:
+                    response.raise_for_status()
+                    response_data = await response.json(content_type=None)
+            except (Exception,) as e:
+                # Cools the endpoint down on 403s and 429s
+                self.scheduler.record_error(endpoint, e)
+                raise
+            latency = time.monotonic() - start_time
+
+        if 'error' in response_data:
+            error = RpcError(endpoint_uri, response_data['error'])
+            # Like ScheduledProvider, other JSON-RPC errors (e.g. a too big range) say nothing about the endpoint
+            if is_throttle_error(error):
+                self.scheduler.record_error(endpoint, error)
+            raise error
+
+        RPC_SECONDS.observe(latency, provider=provider, method=method)
+        self.scheduler.record_success(endpoint, latency, method)
+        return response_data['result']
+
+    async def get_raw_logs(self, log_filter: Dict[str, Any]) -> List[dict]:
+        rpc_filter = dict(log_filter)
+        for block_key in ('fromBlock', 'toBlock'):
+            if isinstance(rpc_filter.get(block_key), int):
+                rpc_filter[block_key] = hex(rpc_filter[block_key])
+
+        return await self.request("eth_getLogs", [rpc_filter])
@@ -0,0 +1,122 @@
+import logging
+import multiprocessing
+import os
+import socket
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from data_models import BackfillShard
+from ddbb_manager import DDBBManager
+from web3_utils import get_w3
+
+# Pairs must all be known before any shard gathers syncs: a pair created in a shard trades in every later one
+PHASE_PAIRS = "pairs"
+PHASE_SYNCS = "syncs"
+PHASES = (PHASE_PAIRS, PHASE_SYNCS)
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Runs of the shards that failed (e.g. their providers kept failing) before the backfill gives up
+MAX_SHARD_ATTEMPTS = int(os.getenv("BACKFILL_MAX_SHARD_ATTEMPTS", 3))
+
+logger = logging.getLogger(__name__)
+
+
+def run_backfill(args: Namespace) -> None:
+    """
+    Imports every block from the first LP up to the current head with args.backfill_workers processes.
+
+    The range is split in shards of args.shard_size blocks, tracked in the backfill_shard table. First every shard
+    discovers the pairs created in its blocks, then, once all of them are known, every shard gathers the syncs of all
+    the pairs in its blocks. That gives the same result as a sequential run, where a window looks for the syncs of the
+    pairs created in it or before it: a pair has no syncs before it is created.
+
+    Sync shards checkpoint their windows, so a restart skips finished shards and resumes the others at their first
+    incomplete window. Pair shards are cheap and are simply imported again.
+    """
+    from main import BLOCK_FOR_THE_FIRST_LP
+
+    db_manager = DDBBManager(os.getenv("DDBB_STRING"))
+    head = get_w3().eth.get_block_number()
+    logger.info(f"Backfilling up to block {head} with {args.backfill_workers} workers")
+
+    for phase in PHASES:
+        plan_shards(db_manager, phase, BLOCK_FOR_THE_FIRST_LP - 10, head, args.shard_size)
+        run_phase(db_manager, args, phase)
+
+    logger.info(f"Backfill up to block {head} done")
+
+
+def plan_shards(db_manager: DDBBManager, phase: str, first_block: int, last_block: int, shard_size: int) -> None:
+    """ Adds the shards needed to cover up to last_block, after the ones planned by previous runs """
+    shards = db_manager.get_backfill_shards(phase)
+    if shards:
+        first_block = max(shard.last_block for shard in shards) + 1
+
+    for shard_start in range(first_block, last_block + 1, shard_size):
+        db_manager.persist(BackfillShard(
+            phase=phase, first_block=shard_start, last_block=min(shard_start + shard_size - 1, last_block),
+            status=STATUS_PENDING, worker=None, updated_at=datetime.now()
+        ))
+    db_manager.commit_changes(sync=True)
+
+
+def run_phase(db_manager: DDBBManager, args: Namespace, phase: str) -> None:
+    for attempt in range(1, MAX_SHARD_ATTEMPTS + 1):
+        pending = [shard for shard in db_manager.get_backfill_shards(phase) if shard.status != STATUS_DONE]
+        if not pending:
+            return
+
+        logger.info(f"{phase} phase, attempt #{attempt}: {len(pending)} shards to import")
+        # Each worker needs its own providers and DDBB connection, spawn does not inherit any of the parent's
+        with ProcessPoolExecutor(
+                max_workers=args.backfill_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(run_shard, args, phase, shard.first_block, shard.last_block): shard
+                for shard in pending
+            }
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    future.result()
+                    logger.info(f"{phase} shard {shard.first_block}-{shard.last_block} done")
+                except (Exception,):
+                    logger.exception(f"{phase} shard {shard.first_block}-{shard.last_block} failed")
+
+    pending = [shard for shard in db_manager.get_backfill_shards(phase) if shard.status != STATUS_DONE]
+    if pending:
+        raise RuntimeError(f"{len(pending)} {phase} shards failed {MAX_SHARD_ATTEMPTS} times, e.g. {pending[0]}")
+
+
+def run_shard(args: Namespace, phase: str, first_block: int, last_block: int) -> None:
+    """ Entry point of the worker processes """
+    from main import import_blocks, setup_loggers
+
+    setup_loggers(f"backfill-{phase}-{first_block}.log")
+    db_manager = DDBBManager(os.getenv("DDBB_STRING"))
+
+    def __set_status(status: str):
+        db_manager.persist(BackfillShard(
+            phase=phase, first_block=first_block, last_block=last_block, status=status,
+            worker=f"{socket.gethostname()}:{os.getpid()}", updated_at=datetime.now()
+        ))
+        db_manager.commit_changes(sync=True)
+
+    __set_status(STATUS_RUNNING)
+    try:
+        if phase == PHASE_PAIRS:
+            import_blocks(args, db_manager, first_block, last_block, discover_pairs=True, gather_syncs=False)
+        else:
+            start_block = db_manager.get_first_unimported_block(first_block)
+            if start_block <= last_block:
+                import_blocks(args, db_manager, start_block, last_block, discover_pairs=False, gather_syncs=True)
+    except (Exception,):
+        db_manager.rollback_changes()
+        __set_status(STATUS_FAILED)
+        raise
+    __set_status(STATUS_DONE)
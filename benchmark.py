@@ -0,0 +1,274 @@
+"""
+Throughput benchmarks, run them with `python benchmark.py <benchmark> [args...]`:
+
+    persist [n_syncs]                 rows/second of DDBBManager.persist (Session.merge) vs DDBBManager.persist_many
+    import [n_blocks] [engine]        main.import_blocks against mock_node.py: blocks/second, RPCs per window, DDBB
+                                      rows/second and peak RSS
+    decode [n_logs] [n_web3_logs]     logs/second of log_decoder.py vs web3's log formatting and processLog, on
+                                      synthetic Sync and PairCreated logs (PairCreated ones and web3 on n_web3_logs)
+
+BENCH_DDBB_STRING selects the database, a temporary SQLite file by default. The mock node is set up with its MOCK_NODE_*
+variables (see mock_node.py) and the import with the usual ones (BLOCK_LENGTH, SYNC_FETCH_MODE, RPC_BATCH_SIZE...).
+"""
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import requests
+from sqlalchemy import create_engine, func, select
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+from web3.datastructures import AttributeDict
+
+from data_models import mapper_registry, Block, Tx, Token, DexTradePair, DexTradeSync, DecentralizedExchange
+from ddbb_manager import DDBBManager
+from log_decoder import decode_pair_created, decode_sync
+from mock_node import MockNodeConfig, serve
+from web3_utils import get_lptoken_contract, EMPTY_CONTRACT, PAIR_CREATED_EVENT_TOPIC, PANCAKE_SWAP_FACTORY_ABI, \
+    SYNC_EVENT_TOPIC
+
+SYNCS_PER_TX = 2
+TXS_PER_BLOCK = 20
+MOCK_NODE_START_SECONDS = 30
+# Distinct synthetic logs the decode benchmark cycles through, so that millions of them are not held in memory
+DECODE_DISTINCT_LOGS = 10000
+# First block imported from the mock chain, whose first pairs are created a few blocks after its genesis
+BENCH_FIRST_BLOCK = int(os.getenv("BENCH_FIRST_BLOCK", 1))
+
+logger = logging.getLogger("benchmark")
+
+
+def _ddbb_string(tmp_dir: str, name: str) -> str:
+    return os.getenv("BENCH_DDBB_STRING", f"sqlite:///{os.path.join(tmp_dir, name)}.db")
+
+
+def _synthetic_pair(run_id: str) -> DexTradePair:
+    block = Block(number=0, timestamp=datetime.fromtimestamp(0))
+    pair = DexTradePair(
+        pair_addr=f"0x{run_id}pair",
+        dex=DecentralizedExchange.PANCAKESWAP.value,
+        token=Token(address=f"0x{run_id}token", name="Benchmark", symbol="BENCH", decimals=18),
+        creator_tx=Tx(hash=f"0x{run_id}creator", block=block, transaction_index=0, gas_price=5 * 10 ** 9),
+        is_token0_wbnb=True
+    )
+    # SQLite does not generate non primary key ids
+    pair.id = int(run_id, 16)
+    return pair
+
+
+def _synthetic_syncs(pair: DexTradePair, run_id: str, n_syncs: int) -> List[DexTradeSync]:
+    syncs = []
+    block, tx = None, None
+    for i in range(n_syncs):
+        tx_number = i // SYNCS_PER_TX
+        if i % (SYNCS_PER_TX * TXS_PER_BLOCK) == 0:
+            block_number = 1 + tx_number // TXS_PER_BLOCK
+            block = Block(number=block_number, timestamp=datetime.fromtimestamp(block_number * 3))
+        if i % SYNCS_PER_TX == 0:
+            tx = Tx(hash=f"0x{run_id}tx{tx_number}", block=block, transaction_index=tx_number % TXS_PER_BLOCK,
+                    gas_price=5 * 10 ** 9)
+
+        syncs.append(DexTradeSync(
+            dex_pair=pair, tx=tx, log_index=i % SYNCS_PER_TX,
+            token_reserves=2 ** 111 + i, wbnb_reserves=10 ** 21 + i
+        ))
+
+    return syncs
+
+
+def bench_persist(n_syncs: str = "100000") -> None:
+    n_syncs = int(n_syncs)
+    n_rows = n_syncs + -(-n_syncs // SYNCS_PER_TX) + -(-n_syncs // (SYNCS_PER_TX * TXS_PER_BLOCK))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path_name, persist in (
+                ("merge", lambda dbm, syncs: [dbm.persist(sync) for sync in syncs]),
+                ("persist_many", lambda dbm, syncs: dbm.persist_many(syncs)),
+        ):
+            ddbb_manager = DDBBManager(_ddbb_string(tmp_dir, path_name))
+            run_id = uuid.uuid4().hex[:8]
+            pair = _synthetic_pair(run_id)
+            ddbb_manager.persist(pair)
+            ddbb_manager.commit_changes(sync=True)
+            syncs = _synthetic_syncs(pair, run_id, n_syncs)
+
+            start_time = time.time()
+            persist(ddbb_manager, syncs)
+            ddbb_manager.commit_changes(sync=True)
+            elapsed = time.time() - start_time
+
+            logger.info(f"{path_name}: {n_rows} rows in {elapsed:.2f} seconds ({n_rows / elapsed:.0f} rows/second)")
+
+
+def _wait_for_mock_node(endpoint_uri: str) -> None:
+    deadline = time.time() + MOCK_NODE_START_SECONDS
+    while True:
+        try:
+            requests.post(endpoint_uri, json={"jsonrpc": "2.0", "id": 0, "method": "eth_blockNumber"}, timeout=1)
+            return
+        except requests.ConnectionError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _mock_node_stats(endpoint_uri: str) -> Dict[str, int]:
+    return requests.post(endpoint_uri, json={"jsonrpc": "2.0", "id": 0, "method": "mock_stats"}).json()["result"]
+
+
+def _run_import(ddbb_string: str, first_block: int, last_block: int, engine: str) -> Dict[str, float]:
+    """ Runs in its own process, so that web3_utils picks up the mock node and the peak RSS is the import's """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from main import import_blocks, parse_args
+
+    ddbb_manager = DDBBManager(ddbb_string)
+    start_time = time.time()
+    import_blocks(parse_args(["--engine", engine]), ddbb_manager, first_block, last_block)
+    elapsed = time.time() - start_time
+
+    with create_engine(ddbb_string).connect() as connection:
+        rows = {
+            table.name: connection.execute(select(func.count()).select_from(table)).scalar()
+            for table in mapper_registry.metadata.sorted_tables
+        }
+    return {
+        "elapsed": elapsed,
+        "windows": rows.pop("import_checkpoint"),
+        "syncs": rows["dex_trade_sync"],
+        "rows": sum(rows.values()),
+        # KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def bench_import(n_blocks: str = "20000", engine: str = "threads") -> None:
+    n_blocks = int(n_blocks)
+    config = MockNodeConfig()
+    spawn = multiprocessing.get_context("spawn")
+    mock_node = spawn.Process(target=serve, args=(config,), daemon=True)
+    mock_node.start()
+    try:
+        endpoint_uris = config.endpoint_uris()
+        _wait_for_mock_node(endpoint_uris[0])
+        os.environ["WEB3_PROVIDER_URLS"] = ",".join(endpoint_uris)
+        # The mock node enforces its own rate limit (MOCK_NODE_RATE_LIMIT), the one for public nodes would hide it
+        os.environ.setdefault("RATE_LIMIT_REQUESTS", str(10 ** 9))
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+            result = executor.submit(
+                _run_import, _ddbb_string(tmp_dir, "import"), BENCH_FIRST_BLOCK, BENCH_FIRST_BLOCK + n_blocks - 1,
+                engine
+            ).result()
+        stats = _mock_node_stats(endpoint_uris[0])
+    finally:
+        mock_node.terminate()
+
+    elapsed, windows = result["elapsed"], max(1, result["windows"])
+    calls = {key[len("calls."):]: value for key, value in stats.items() if key.startswith("calls.")}
+    errors = {key[len("errors."):]: value for key, value in stats.items() if key.startswith("errors.")}
+    logger.info(
+        f"import ({engine}): {n_blocks} blocks in {elapsed:.2f} seconds ({n_blocks / elapsed:.0f} blocks/second), "
+        f"{result['windows']} windows, {result['syncs']} syncs"
+    )
+    logger.info(
+        f"\t{sum(calls.values()) / windows:.1f} RPCs and {stats.get('http_requests', 0) / windows:.1f} HTTP requests "
+        f"per window ({', '.join(f'{method}: {n / windows:.1f}' for method, n in sorted(calls.items()))})"
+    )
+    logger.info(f"\tInjected errors: {errors or 'none'}")
+    logger.info(f"\t{result['rows']} DDBB rows ({result['rows'] / elapsed:.0f} rows/second), "
+                f"peak RSS {result['peak_rss_mb']:.0f} MiB")
+
+
+def _synthetic_logs(topic: str) -> List[dict]:
+    """ DECODE_DISTINCT_LOGS Sync or PairCreated logs as a node sends them """
+    rng = random.Random(0)
+
+    def __word(value: int) -> str:
+        return f"{value:064x}"
+
+    def __address() -> str:
+        return f"0x{rng.getrandbits(160):040x}"
+
+    logs = []
+    for i in range(DECODE_DISTINCT_LOGS):
+        if topic == SYNC_EVENT_TOPIC:
+            address, topics = __address(), [topic]
+            data = "0x" + __word(rng.randrange(2 ** 112)) + __word(rng.randrange(2 ** 112))
+        else:
+            address = DecentralizedExchange.PANCAKESWAP.value.factory_addr.lower()
+            topics = [topic, "0x" + __word(int(__address(), 16)), "0x" + __word(int(__address(), 16))]
+            data = "0x" + __word(int(__address(), 16)) + __word(i + 1)
+        block = 1 + i // (SYNCS_PER_TX * TXS_PER_BLOCK)
+        logs.append({
+            "address": address, "topics": topics, "data": data, "blockNumber": hex(block),
+            "blockHash": "0x" + __word(block), "transactionHash": "0x" + __word(2 ** 255 + i // SYNCS_PER_TX),
+            "transactionIndex": hex(i // SYNCS_PER_TX % TXS_PER_BLOCK), "logIndex": hex(i % SYNCS_PER_TX),
+            "removed": False,
+        })
+    return logs
+
+
+def _decode_throughput(decode: Callable[[dict], tuple], logs: List[dict], n_logs: int) -> float:
+    passes, rest = divmod(n_logs, len(logs))
+    start_time = time.perf_counter()
+    for _ in range(passes):
+        for log in logs:
+            decode(log)
+    for log in logs[:rest]:
+        decode(log)
+    return n_logs / (time.perf_counter() - start_time)
+
+
+def bench_decode(n_logs: str = "2000000", n_web3_logs: str = "100000") -> None:
+    n_logs, n_web3_logs = int(n_logs), int(n_web3_logs)
+    w3 = Web3()
+    sync_event = get_lptoken_contract(w3, EMPTY_CONTRACT).events.Sync()
+    pair_created_event = w3.eth.contract(abi=PANCAKE_SWAP_FACTORY_ABI).events.PairCreated()
+
+    def __web3_sync(log: dict) -> tuple:
+        # What w3.eth.get_logs and then ContractEvent.processLog do
+        args = sync_event.processLog(AttributeDict.recursive(log_entry_formatter(log))).args
+        return args['reserve0'], args['reserve1']
+
+    def __web3_pair_created(log: dict) -> tuple:
+        args = pair_created_event.processLog(AttributeDict.recursive(log_entry_formatter(log))).args
+        return args['token0'], args['token1'], args['pair']
+
+    for event_name, topic, web3_decode, fast_decode, n_fast_logs in (
+            ("Sync", SYNC_EVENT_TOPIC, __web3_sync, lambda log: decode_sync(log)[-2:], n_logs),
+            ("PairCreated", PAIR_CREATED_EVENT_TOPIC, __web3_pair_created,
+             lambda log: decode_pair_created(log)[-4:-1], n_web3_logs),
+    ):
+        logs = _synthetic_logs(topic)
+        if any(web3_decode(log) != fast_decode(log) for log in logs[:1000]):
+            raise AssertionError(f"log_decoder.py and web3 decode {event_name} logs differently")
+
+        fast = _decode_throughput(fast_decode, logs, n_fast_logs)
+        web3 = _decode_throughput(web3_decode, logs, n_web3_logs)
+        logger.info(f"{event_name}: log_decoder {fast:.0f} logs/second ({n_fast_logs} logs), web3 {web3:.0f} "
+                    f"logs/second ({n_web3_logs} logs), {fast / web3:.1f}x")
+
+
+BENCHMARKS = {
+    "persist": bench_persist,
+    "import": bench_import,
+    "decode": bench_decode,
+}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
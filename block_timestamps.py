@@ -0,0 +1,115 @@
+import logging
+import os
+from array import array
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from data_models import Block
+from rpc_batch import JsonRpcBatcher
+
+# Minimum seconds between the timestamps of a block and its parent in the imported blocks: 3 for BSC blocks before its
+# 2025 hard forks shortened block times below 3 seconds. Newer blocks need 0, which only interpolates blocks whose
+# sampled neighbours have the same timestamp.
+MIN_BLOCK_TIME_SECONDS = int(os.getenv("MIN_BLOCK_TIME_SECONDS", 3))
+UNKNOWN_TIMESTAMP = -1
+
+
+class BlockTimestampService:
+    """
+    Loads the timestamps of a whole import window up front and serves Block entities from them.
+
+    Timestamps live in a compact array indexed by the offset from the start of the window, and are fetched with
+    batched header requests (eth_getHeaderByNumber, or eth_getBlockByNumber without txs if the node lacks it).
+
+    With sample_every > 1 only every N-th header is fetched and the blocks in between are interpolated. That is exact
+    as long as consecutive blocks are at least block_time seconds apart: if two samples N blocks apart are exactly
+    N * block_time seconds apart, every block in between is block_time seconds after its parent. Any other segment
+    has all its headers fetched. Samples closer than that prove the blocks faster than block_time, so interpolation
+    is then left to segments of equal timestamps (block_time 0) for the rest of the run.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, batcher: JsonRpcBatcher, sample_every: int = 1, block_time: int = MIN_BLOCK_TIME_SECONDS):
+        if sample_every < 1:
+            raise ValueError(f"Invalid sample_every {sample_every}")
+
+        self.batcher = batcher
+        self.sample_every = sample_every
+        self.block_time = block_time
+        self.headers_fetched = 0
+        # (first block, timestamps, (hash, parent hash) of the fetched headers) of the loaded window, replaced as a
+        # whole so readers never see half of a load
+        self.__window = (0, array('q'), {})
+
+    def __str__(self):
+        return f"BlockTimestampService<sampling 1/{self.sample_every}, {self.headers_fetched} headers fetched>"
+
+    def load_window(self, from_block: int, to_block: int) -> None:
+        timestamps = array('q', [UNKNOWN_TIMESTAMP]) * (to_block - from_block + 1)
+        hashes: Dict[int, Tuple[str, str]] = {}
+
+        def __store(fetched: Dict[int, dict]) -> None:
+            for block_number, header in fetched.items():
+                timestamps[block_number - from_block] = int(header['timestamp'], 16)
+                hashes[block_number] = (header['hash'], header['parentHash'])
+
+        samples = list(range(from_block, to_block + 1, self.sample_every))
+        if samples[-1] != to_block:
+            samples.append(to_block)
+        __store(self.__fetch_headers(samples))
+
+        if self.block_time and any(
+                timestamps[segment_end - from_block] - timestamps[segment_start - from_block]
+                < (segment_end - segment_start) * self.block_time
+                for segment_start, segment_end in zip(samples, samples[1:])
+        ):
+            self.logger.warning(f"Blocks {from_block}-{to_block} are less than {self.block_time}s apart, from now on "
+                                f"only blocks between samples with the same timestamp are interpolated")
+            self.block_time = 0
+
+        irregular_blocks = []
+        for segment_start, segment_end in zip(samples, samples[1:]):
+            start_timestamp = timestamps[segment_start - from_block]
+            end_timestamp = timestamps[segment_end - from_block]
+            if end_timestamp - start_timestamp == (segment_end - segment_start) * self.block_time:
+                for block_number in range(segment_start + 1, segment_end):
+                    timestamps[block_number - from_block] = (
+                        start_timestamp + (block_number - segment_start) * self.block_time
+                    )
+            else:
+                irregular_blocks.extend(range(segment_start + 1, segment_end))
+
+        if irregular_blocks:
+            self.logger.debug(f"Fetching {len(irregular_blocks)} headers of irregular segments")
+            __store(self.__fetch_headers(irregular_blocks))
+
+        self.__verify_monotonic(from_block, timestamps)
+        self.__window = (from_block, timestamps, hashes)
+
+    def get_timestamp(self, block_number: int) -> Optional[int]:
+        window_start, timestamps, _ = self.__window
+        offset = block_number - window_start
+        if 0 <= offset < len(timestamps) and timestamps[offset] != UNKNOWN_TIMESTAMP:
+            return timestamps[offset]
+        return None
+
+    def get_block(self, block_number: int) -> Optional[Block]:
+        timestamp = self.get_timestamp(block_number)
+        if timestamp is None:
+            return None
+        block_hash, parent_hash = self.__window[2].get(block_number, (None, None))
+        return Block(
+            number=block_number, timestamp=datetime.fromtimestamp(timestamp), hash=block_hash, parent_hash=parent_hash
+        )
+
+    def __fetch_headers(self, block_numbers: List[int]) -> Dict[int, dict]:
+        headers = self.batcher.get_headers(block_numbers)
+        self.headers_fetched += len(block_numbers)
+        return headers
+
+    @staticmethod
+    def __verify_monotonic(window_start: int, timestamps: array) -> None:
+        for offset in range(1, len(timestamps)):
+            if timestamps[offset] < timestamps[offset - 1]:
+                block_number = window_start + offset
+                raise ValueError(f"Timestamp of block {block_number} is older than its parent's")
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import re
+import threading
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+# Errors meaning "the range was too big for the node", as opposed to throttling or a flaky node.
+# Retrying the same range will not help with these, a smaller one will.
+OVERSIZE_ERROR_MSGS = (
+    'query returned more than',
+    'too many results',
+    'response size exceeded',
+    'response size should not greater than',
+    'exceed maximum block range',
+    'block range is too wide',
+    'query timeout exceeded',
+    # The read timeout of a heavy eth_getLogs. Connect and pool timeouts mean the node is unreachable, not the range.
+    'read timed out',
+)
+MAX_BLOCK_RANGE_REGEX = re.compile(r'exceed maximum block range: (\d+)')
+
+
+def is_oversize_error(e: Exception) -> bool:
+    error_text = str(e).lower()
+    return any(msg in error_text for msg in OVERSIZE_ERROR_MSGS)
+
+
+class AdaptiveBlockWindow:
+    """
+    Decides how many blocks the next import window spans.
+
+    The window grows while responses come back small and fast, and shrinks when the node complains about the size of
+    a range (too many results, timeouts...). The logs-per-block density of recent windows caps the growth, so a quiet
+    stretch of history does not make the first busy window after it blow up.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+            self,
+            size: int,
+            min_size: int = 1,
+            max_size: int = 100000,
+            target_logs: int = 10000,
+            target_seconds: float = 30,
+            grow_factor: float = 2,
+            shrink_factor: float = 0.5,
+            density_smoothing: float = 0.3
+    ):
+        if not 0 < min_size <= size <= max_size:
+            raise ValueError(f"Expected 0 < min_size <= size <= max_size, got {min_size}, {size}, {max_size}")
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_logs = target_logs
+        self.target_seconds = target_seconds
+        self.grow_factor = grow_factor
+        self.shrink_factor = shrink_factor
+        self.density_smoothing = density_smoothing
+        self.density: Optional[float] = None  # Logs per block
+        self.__size = size
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        density = f"{self.density:.2f}" if self.density is not None else "?"
+        return f"{self.size} blocks ({density} logs/block)"
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def record(self, n_blocks: int, n_logs: int, elapsed_seconds: float) -> None:
+        """ Feed back the outcome of a window that was imported without errors """
+        with self.__lock:
+            window_density = n_logs / max(n_blocks, 1)
+            if self.density is None:
+                self.density = window_density
+            else:
+                self.density += self.density_smoothing * (window_density - self.density)
+
+            if elapsed_seconds > 2 * self.target_seconds or n_logs > 2 * self.target_logs:
+                new_size = self.__size * self.shrink_factor
+            elif elapsed_seconds < self.target_seconds and n_logs < self.target_logs:
+                new_size = self.__size * self.grow_factor
+            else:
+                new_size = self.__size
+
+            if self.density > 0:
+                new_size = min(new_size, self.target_logs / self.density)
+
+            self.__set_size(new_size)
+
+    def on_error(self, e: Exception, failed_range_size: int) -> bool:
+        """
+        Returns True if the error was caused by the size of the range, in which case the range should be split
+        instead of retried. Following windows will be smaller.
+        """
+        if not is_oversize_error(e):
+            return False
+
+        with self.__lock:
+            max_range_match = MAX_BLOCK_RANGE_REGEX.search(str(e))
+            if max_range_match:
+                # The node told us its hard limit, no need to keep probing above it
+                self.max_size = max(self.min_size, int(max_range_match.group(1)))
+
+            self.__set_size(min(self.__size, failed_range_size * self.shrink_factor))
+
+        return True
+
+    def __set_size(self, new_size: float) -> None:
+        new_size = int(max(self.min_size, min(self.max_size, new_size)))
+        if new_size != self.__size:
+            self.logger.debug(f"Block window {self.__size} -> {new_size}")
+            self.__size = new_size
+
+
+def fetch_splitting_range(
+        fetch: Callable[[int, int], List[T]],
+        from_block: int,
+        to_block: int,
+        window: AdaptiveBlockWindow,
+        handle_exception: Callable[[int, Exception], None]
+) -> List[T]:
+    """
+    Calls fetch(from_block, to_block), splitting the range in halves whenever the node rejects it for being too big.
+    Any other error is passed to handle_exception(retry, e) and the range retried as is.
+    """
+    retry = 0
+    while True:
+        try:
+            return fetch(from_block, to_block)
+        except (Exception,) as e:
+            if to_block > from_block and window.on_error(e, to_block - from_block + 1):
+                middle = (from_block + to_block) // 2
+                return fetch_splitting_range(fetch, from_block, middle, window, handle_exception) + \
+                    fetch_splitting_range(fetch, middle + 1, to_block, window, handle_exception)
+
+            handle_exception(retry, e)
+            retry += 1
+
+
+async def async_fetch_splitting_range(
+        fetch: Callable[[int, int], Awaitable[List[T]]],
+        from_block: int,
+        to_block: int,
+        window: AdaptiveBlockWindow,
+        handle_exception: Callable[[int, Exception], Awaitable[None]]
+) -> List[T]:
+    """ asyncio version of fetch_splitting_range, both halves of a split range are fetched concurrently """
+    retry = 0
+    while True:
+        try:
+            return await fetch(from_block, to_block)
+        except (Exception,) as e:
+            if to_block > from_block and window.on_error(e, to_block - from_block + 1):
+                middle = (from_block + to_block) // 2
+                first_half, second_half = await asyncio.gather(
+                    async_fetch_splitting_range(fetch, from_block, middle, window, handle_exception),
+                    async_fetch_splitting_range(fetch, middle + 1, to_block, window, handle_exception)
+                )
+                return first_half + second_half
+
+            await handle_exception(retry, e)
+            retry += 1
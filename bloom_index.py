@@ -0,0 +1,285 @@
+import logging
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from eth_utils import keccak
+
+from metrics import CACHE_LOOKUPS
+from rpc_batch import JsonRpcBatcher
+
+# SQLite file of the bloom index, shared by every process importing from the same node. Empty disables the index.
+BLOOM_INDEX_PATH = os.getenv("BLOOM_INDEX_PATH", "")
+# Blocks per segment of the lowest level, segments per segment of the level above, and how many levels there are
+BLOOM_SEGMENT_BLOCKS = int(os.getenv("BLOOM_SEGMENT_BLOCKS", 64))
+BLOOM_FANOUT = int(os.getenv("BLOOM_FANOUT", 16))
+BLOOM_LEVELS = int(os.getenv("BLOOM_LEVELS", 4))
+# Segments kept in memory, about 300 bytes each
+BLOOM_CACHED_SEGMENTS = int(os.getenv("BLOOM_CACHED_SEGMENTS", 100000))
+
+BLOOM_BITS = 2048
+BLOOM_BYTES = BLOOM_BITS // 8
+
+
+def bloom_key(item: str) -> int:
+    """ The 3 bits an address or topic sets in a logsBloom (M3:2048 in the Yellow Paper), packed in 11 bits each """
+    item_hash = keccak(hexstr=item)
+    return sum(
+        (((item_hash[i] << 8) | item_hash[i + 1]) & (BLOOM_BITS - 1)) << (11 * (i // 2)) for i in (0, 2, 4)
+    )
+
+
+def bloom_may_contain(bloom: int, key: int) -> bool:
+    """ False if the logs of a bloom (read as a big-endian integer) surely have nothing from the item of the key """
+    return bool((bloom >> (key & 2047)) & (bloom >> ((key >> 11) & 2047)) & (bloom >> (key >> 22)) & 1)
+
+
+class BloomIndex:
+    """
+    Tells which parts of a range of blocks may have logs of some addresses with some topic, from the logsBloom of
+    their headers, so that eth_getLogs is only asked about those.
+
+    Level 0 ORs the blooms of BLOOM_SEGMENT_BLOCKS consecutive blocks, and each level above ORs BLOOM_FANOUT segments
+    of the one below. Lookups go down from the highest level only through segments whose bloom may match, so a range
+    where an address never shows up is ruled out with a few checks. Blooms have false positives but no false
+    negatives: a part left out surely has no matching log.
+
+    Complete segments are persisted in a SQLite file, headers are only fetched (batched) for the blocks that are not
+    indexed yet. Blocks of a segment that is not complete are kept in memory. Blocks that are not indexed at all, or
+    whose header has an empty bloom (nodes that do not fill them in), always may have logs.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+            self,
+            path: str,
+            batcher: JsonRpcBatcher,
+            segment_blocks: int = BLOOM_SEGMENT_BLOCKS,
+            fanout: int = BLOOM_FANOUT,
+            levels: int = BLOOM_LEVELS
+    ):
+        if segment_blocks < 1 or fanout < 2 or levels < 1:
+            raise ValueError(f"Invalid bloom index shape: {segment_blocks} blocks, fanout {fanout}, {levels} levels")
+
+        self.path = path
+        self.batcher = batcher
+        self.segment_blocks = segment_blocks
+        self.fanout = fanout
+        self.levels = levels
+        self.headers_fetched = 0
+        self.__lock = threading.RLock()
+        # Bloom of each segment by (level, first block), loaded from the file on demand
+        self.__segments: Dict[Tuple[int, int], int] = {}
+        # Range of blocks whose segments are all in __segments
+        self.__loaded = (0, -1)
+        # Level 0 segments being filled, or complete with an empty bloom: (last block covered, bloom) by first block
+        self.__partial: Dict[int, Tuple[int, int]] = {}
+        self.__connection = sqlite3.connect(
+            # Backfill workers share the file, WAL lets them read while another one writes
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS bloom_shape (segment_blocks INTEGER, fanout INTEGER)")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS bloom_segment (level INTEGER, first_block INTEGER, bloom BLOB NOT NULL, "
+            "PRIMARY KEY (level, first_block))"
+        )
+        shape = self.__connection.execute("SELECT segment_blocks, fanout FROM bloom_shape").fetchone()
+        if shape is None:
+            self.__connection.execute("INSERT INTO bloom_shape VALUES (?, ?)", (segment_blocks, fanout))
+        elif shape != (segment_blocks, fanout):
+            raise ValueError(f"{path} indexes segments of {shape[0]} blocks with fanout {shape[1]}")
+
+    def __str__(self):
+        return f"BloomIndex<{self.path}, {self.segment_blocks}x{self.fanout}^{self.levels - 1} blocks, " \
+               f"{self.headers_fetched} headers fetched>"
+
+    def prepare(self, from_block: int, to_block: int) -> None:
+        """ Indexes the blocks between from_block and to_block that are not indexed yet, which must be final """
+        with self.__lock:
+            self.__load(from_block, to_block)
+            missing_blocks = []
+            for segment_start in self.__segment_starts(0, from_block, to_block):
+                if (0, segment_start) in self.__segments:
+                    continue
+                covered_to, _ = self.__partial.get(segment_start, (segment_start - 1, 0))
+                # Blocks of the segment before from_block are final too, the segment is filled from its start
+                missing_blocks.extend(range(covered_to + 1, min(segment_start + self.segment_blocks - 1, to_block) + 1))
+            if not missing_blocks:
+                return
+
+            try:
+                headers = self.batcher.get_headers(missing_blocks)
+            except (Exception,):
+                self.logger.exception(f"Could not fetch {len(missing_blocks)} headers, blocks {from_block}-{to_block} "
+                                      f"are not indexed")
+                return
+            self.headers_fetched += len(missing_blocks)
+
+            for block_number in missing_blocks:
+                segment_start = block_number - block_number % self.segment_blocks
+                covered_to, bloom = self.__partial.get(segment_start, (segment_start - 1, 0))
+                header = headers.get(block_number)
+                if covered_to != block_number - 1 or not header or not header.get('logsBloom'):
+                    # A gap in the segment, it is only indexed up to there
+                    continue
+                bloom |= int(header['logsBloom'], 16)
+                if block_number == segment_start + self.segment_blocks - 1 and bloom:
+                    self.__partial.pop(segment_start, None)
+                    self.__store(0, segment_start, bloom)
+                else:
+                    self.__partial[segment_start] = (block_number, bloom)
+
+    def ranges(
+            self, from_block: int, to_block: int, addresses: Optional[Sequence[str]], topic: Optional[str]
+    ) -> List[Tuple[int, int]]:
+        """
+        The ranges between from_block and to_block that may have logs of any of addresses (any address if None) with
+        topic as their first one (any topic if None)
+        """
+        address_keys = None if addresses is None else [bloom_key(address) for address in addresses]
+        topic_key = None if topic is None else bloom_key(topic)
+
+        def __matches(bloom: int) -> bool:
+            return (topic_key is None or bloom_may_contain(bloom, topic_key)) and \
+                   (address_keys is None or any(bloom_may_contain(bloom, key) for key in address_keys))
+
+        found: List[Tuple[int, int]] = []
+        with self.__lock:
+            self.__load(from_block, to_block)
+            for segment_start in self.__segment_starts(self.levels - 1, from_block, to_block):
+                self.__find(self.levels - 1, segment_start, from_block, to_block, __matches, found)
+
+        merged: List[Tuple[int, int]] = []
+        for range_start, range_end in found:
+            if merged and merged[-1][1] + 1 == range_start:
+                merged[-1] = (merged[-1][0], range_end)
+            else:
+                merged.append((range_start, range_end))
+        CACHE_LOOKUPS.inc(cache="bloom_index", result="pruned" if merged != [(from_block, to_block)] else "kept")
+        return merged
+
+    def span(
+            self, from_block: int, to_block: int, addresses: Optional[Sequence[str]], topic: Optional[str]
+    ) -> Optional[Tuple[int, int]]:
+        """
+        The smallest range around every part of ranges(), None if there is none. Asking for the span takes one
+        eth_getLogs call at most, asking for each range may take more calls than the whole range did.
+        """
+        block_ranges = self.ranges(from_block, to_block, addresses, topic)
+        return (block_ranges[0][0], block_ranges[-1][1]) if block_ranges else None
+
+    def bloom(self, from_block: int, to_block: int) -> Optional[int]:
+        """ OR of the blooms of every block between from_block and to_block, None unless they are all indexed """
+        with self.__lock:
+            self.__load(from_block, to_block)
+            bloom = 0
+            for segment_start in self.__segment_starts(self.levels - 1, from_block, to_block):
+                segment_bloom = self.__cover(self.levels - 1, segment_start, from_block, to_block)
+                if segment_bloom is None:
+                    return None
+                bloom |= segment_bloom
+            return bloom
+
+    def roll_back(self, first_block: int) -> None:
+        """ Forgets every segment with blocks from first_block on, they may belong to a branch that was reorged away """
+        with self.__lock:
+            for level in range(self.levels):
+                size = self.__size(level)
+                self.__connection.execute(
+                    "DELETE FROM bloom_segment WHERE level = ? AND first_block > ?", (level, first_block - size)
+                )
+            self.__segments.clear()
+            self.__loaded = (0, -1)
+            self.__partial = {
+                segment_start: (covered_to, bloom) for segment_start, (covered_to, bloom) in self.__partial.items()
+                if covered_to < first_block
+            }
+
+    def __size(self, level: int) -> int:
+        return self.segment_blocks * self.fanout ** level
+
+    def __segment_starts(self, level: int, from_block: int, to_block: int) -> Iterable[int]:
+        size = self.__size(level)
+        return range(from_block - from_block % size, to_block + 1, size)
+
+    def __level_0_bloom(self, segment_start: int, to_block: int) -> Optional[int]:
+        bloom = self.__segments.get((0, segment_start))
+        if bloom is not None:
+            return bloom
+        covered_to, bloom = self.__partial.get(segment_start, (segment_start - 1, 0))
+        return bloom if bloom and covered_to >= min(segment_start + self.segment_blocks - 1, to_block) else None
+
+    def __find(
+            self, level: int, segment_start: int, from_block: int, to_block: int, matches: Callable[[int], bool],
+            found: List[Tuple[int, int]]
+    ) -> None:
+        segment_end = segment_start + self.__size(level) - 1
+        bloom = self.__level_0_bloom(segment_start, to_block) if level == 0 \
+            else self.__segments.get((level, segment_start))
+        if bloom is not None and not matches(bloom):
+            return
+        if level == 0:
+            found.append((max(segment_start, from_block), min(segment_end, to_block)))
+            return
+
+        for child_start in self.__segment_starts(level - 1, max(segment_start, from_block), min(segment_end, to_block)):
+            self.__find(level - 1, child_start, from_block, to_block, matches, found)
+
+    def __cover(self, level: int, segment_start: int, from_block: int, to_block: int) -> Optional[int]:
+        if level == 0:
+            return self.__level_0_bloom(segment_start, to_block)
+        bloom = self.__segments.get((level, segment_start))
+        if bloom is not None:
+            return bloom
+
+        segment_end = segment_start + self.__size(level) - 1
+        bloom = 0
+        for child_start in self.__segment_starts(level - 1, max(segment_start, from_block), min(segment_end, to_block)):
+            child_bloom = self.__cover(level - 1, child_start, from_block, to_block)
+            if child_bloom is None:
+                return None
+            bloom |= child_bloom
+        return bloom
+
+    def __load(self, from_block: int, to_block: int) -> None:
+        if self.__loaded[0] <= from_block and to_block <= self.__loaded[1]:
+            return
+        if len(self.__segments) > BLOOM_CACHED_SEGMENTS:
+            self.__segments.clear()
+
+        # From the start of the highest segment around from_block, so that __find sees all of them
+        load_from = from_block - from_block % self.__size(self.levels - 1)
+        for level, first_block, bloom in self.__connection.execute(
+                "SELECT level, first_block, bloom FROM bloom_segment WHERE first_block BETWEEN ? AND ? AND level < ?",
+                (load_from, to_block, self.levels)
+        ):
+            self.__segments[(level, first_block)] = int.from_bytes(bloom, "big")
+        self.__loaded = (load_from, to_block)
+
+    def __store(self, level: int, segment_start: int, bloom: int) -> None:
+        self.__segments[(level, segment_start)] = bloom
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO bloom_segment (level, first_block, bloom) VALUES (?, ?, ?)",
+            (level, segment_start, bloom.to_bytes(BLOOM_BYTES, "big"))
+        )
+
+        # The parent is complete once its last child is
+        if level + 1 >= self.levels:
+            return
+        parent_size = self.__size(level + 1)
+        parent_start = segment_start - segment_start % parent_size
+        parent_bloom = 0
+        for child_start in range(parent_start, parent_start + parent_size, self.__size(level)):
+            child_bloom = self.__segments.get((level, child_start))
+            if child_bloom is None:
+                row = self.__connection.execute(
+                    "SELECT bloom FROM bloom_segment WHERE level = ? AND first_block = ?", (level, child_start)
+                ).fetchone()
+                if row is None:
+                    return
+                child_bloom = self.__segments[(level, child_start)] = int.from_bytes(row[0], "big")
+            parent_bloom |= child_bloom
+        self.__store(level + 1, parent_start, parent_bloom)
@@ -0,0 +1,227 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+
+from metrics import TAIL_RECONNECTS
+from web3_utils import PAIR_CREATED_EVENT_TOPIC, SYNC_EVENT_TOPIC
+
+# WebSocket endpoints the tail subscribes through, comma separated, tried in turn after each disconnection
+WEB3_WS_URLS = [url for url in os.getenv("WEB3_WS_URLS", "").split(",") if url]
+# Blocks on top of a block before its rows are final. Blocks the subscription covers are imported (provisionally) as
+# soon as the next header comes, and rolled back if they are reorged before they are final, other blocks are only
+# imported once final.
+TAIL_CONFIRMATIONS = max(1, int(os.getenv("TAIL_CONFIRMATIONS", 15)))
+# Seconds between head checks when following the chain without a subscription
+TAIL_POLL_SECONDS = float(os.getenv("TAIL_POLL_SECONDS", 1))
+TAIL_RECONNECT_SECONDS = float(os.getenv("TAIL_RECONNECT_SECONDS", 5))
+# Blocks whose logs and hashes are kept, older ones are dropped and polled again if ever needed
+TAIL_MAX_BUFFERED_BLOCKS = int(os.getenv("TAIL_MAX_BUFFERED_BLOCKS", 1000))
+
+SUBSCRIPTION_HEADS = "heads"
+SUBSCRIPTION_PAIRS = "pairs"
+SUBSCRIPTION_SYNCS = "syncs"
+
+
+class ChainTail:
+    """
+    Follows the head of the chain through eth_subscribe over WebSocket: new headers, PairCreated logs of the DEX
+    factories and every Sync log (pairs are filtered by whoever takes the logs, as pairs_by_addr grows).
+
+    Logs are buffered by block and hash until they are taken. Only the logs of the block hash seen last for each height
+    are taken, so logs of blocks that were reorged away are never handed out. Blocks the current connection cannot
+    vouch for (before it subscribed, or headers that do not chain up after a reorg or a missed notification) are
+    reported as gaps, to be polled with eth_getLogs instead.
+
+    Hashes of the blocks taken are kept, so that a reorg of any of them is reported by take_reorg(). So is losing
+    track of them (a disconnection, or headers that do not chain up), as they may have been reorged meanwhile.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, ws_urls: List[str], factory_addrs: List[str]):
+        if not ws_urls:
+            raise ValueError("ChainTail needs at least one WebSocket endpoint")
+
+        self.ws_urls = ws_urls
+        self.factory_addrs = factory_addrs
+        self.__condition = threading.Condition()
+        self.__head: Optional[int] = None
+        # First block whose logs all came through the current connection, None while disconnected
+        self.__covered_from: Optional[int] = None
+        self.__hashes: Dict[int, str] = {}
+        self.__logs: Dict[int, Dict[str, List[dict]]] = {}
+        # Last block taken, and the first taken block reorged (or lost track of) since take_reorg() was last called
+        self.__taken_to: Optional[int] = None
+        self.__reorged_from: Optional[int] = None
+        # Kind of each subscription by id
+        self.__subscriptions: Dict[str, str] = {}
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.__thread: Optional[threading.Thread] = None
+
+    def __str__(self):
+        return f"ChainTail<{', '.join(self.ws_urls)}, head {self.__head}, {len(self.__hashes)} blocks buffered>"
+
+    def start(self) -> None:
+        self.__loop = asyncio.new_event_loop()
+        self.__task = self.__loop.create_task(self.__follow())
+        self.__thread = threading.Thread(
+            target=self.__loop.run_until_complete, args=(self.__task,), name="ChainTail", daemon=True
+        )
+        self.__thread.start()
+
+    def stop(self) -> None:
+        if self.__thread:
+            self.__loop.call_soon_threadsafe(self.__task.cancel)
+            self.__thread.join()
+            self.__loop.close()
+            self.__thread = None
+
+    @property
+    def head(self) -> Optional[int]:
+        """ Last head notified through the current connection, None while disconnected """
+        return self.__head
+
+    def covers(self, block: int) -> bool:
+        return self.__covered_from is not None and block >= self.__covered_from
+
+    def wait_for_head(self, block: int, timeout: float) -> Optional[int]:
+        """ Waits up to timeout seconds for the head to reach block, returns the head (None if disconnected) """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__head is None or self.__head >= block, timeout=timeout)
+            return self.__head
+
+    def take_reorg(self) -> Optional[int]:
+        """ First block taken that was reorged, or lost track of, since the last call. None if there is none. """
+        with self.__condition:
+            reorged_from, self.__reorged_from = self.__reorged_from, None
+            return reorged_from
+
+    def take_logs(self, first_block: int, last_block: int) -> Optional[Tuple[list, list]]:
+        """
+        PairCreated and Sync logs of the canonical blocks between first_block and last_block, as the node sent them
+        (see log_decoder.py), or None if any of those blocks is a gap. Either way, no log up to last_block is buffered
+        anymore.
+        """
+        with self.__condition:
+            blocks = range(first_block, last_block + 1)
+            complete = self.covers(first_block) and all(block in self.__hashes for block in blocks)
+            logs = [
+                log for block in blocks for log in self.__logs.get(block, {}).get(self.__hashes.get(block), [])
+            ] if complete else None
+            if complete:
+                self.__taken_to = max(self.__taken_to or last_block, last_block)
+            for block in [block for block in self.__logs if block <= last_block]:
+                del self.__logs[block]
+
+        if logs is None:
+            return None
+        return [log for log in logs if log['topics'][0] == PAIR_CREATED_EVENT_TOPIC], \
+               [log for log in logs if log['topics'][0] == SYNC_EVENT_TOPIC]
+
+    async def __follow(self) -> None:
+        for retry in itertools.count():
+            ws_url = self.ws_urls[retry % len(self.ws_urls)]
+            try:
+                async with websockets.connect(ws_url, max_size=None) as ws:
+                    await self.__subscribe(ws)
+                    async for message in ws:
+                        self.__handle(json.loads(message))
+                self.logger.warning(f"{ws_url} closed the connection")
+            except asyncio.CancelledError:
+                raise
+            except (Exception,):
+                self.logger.exception(f"Error following {ws_url}")
+
+            TAIL_RECONNECTS.inc()
+            with self.__condition:
+                # Whatever was produced until the next subscription is a gap
+                self.__head, self.__covered_from = None, None
+                self.__lose_track()
+                self.__hashes.clear()
+                self.__logs.clear()
+                self.__condition.notify_all()
+            await asyncio.sleep(TAIL_RECONNECT_SECONDS)
+
+    async def __subscribe(self, ws) -> None:
+        requests = {
+            SUBSCRIPTION_HEADS: ["newHeads"],
+            SUBSCRIPTION_PAIRS: ["logs", {"address": self.factory_addrs, "topics": [PAIR_CREATED_EVENT_TOPIC]}],
+            SUBSCRIPTION_SYNCS: ["logs", {"topics": [SYNC_EVENT_TOPIC]}],
+        }
+        for request_id, params in enumerate(requests.values()):
+            await ws.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": "eth_subscribe", "params": params}))
+        await ws.send(json.dumps({"jsonrpc": "2.0", "id": len(requests), "method": "eth_blockNumber", "params": []}))
+
+        self.__subscriptions.clear()
+        kinds = list(requests.keys())
+        # Notifications of the new subscriptions may come before every answer
+        while True:
+            message = json.loads(await ws.recv())
+            if "id" not in message:
+                self.__handle(message)
+                continue
+            if "error" in message:
+                raise ConnectionError(f"Could not subscribe: {message['error']}")
+            if message["id"] < len(kinds):
+                self.__subscriptions[message["result"]] = kinds[message["id"]]
+                continue
+
+            # Subscriptions are set up before the node answers this, so every later block comes through them
+            head = int(message["result"], 16)
+            with self.__condition:
+                self.__covered_from = head + 1
+                self.__head = max(self.__head or head, head)
+                self.__condition.notify_all()
+            self.logger.info(f"Following the chain through {ws.remote_address}, covering from block {head + 1}")
+            return
+
+    def __handle(self, message: dict) -> None:
+        if message.get("method") != "eth_subscription":
+            return
+        kind = self.__subscriptions.get(message["params"]["subscription"])
+        result = message["params"]["result"]
+        with self.__condition:
+            if kind == SUBSCRIPTION_HEADS:
+                self.__add_header(int(result["number"], 16), result["hash"], result["parentHash"])
+            elif kind in (SUBSCRIPTION_PAIRS, SUBSCRIPTION_SYNCS):
+                block_logs = self.__logs.setdefault(int(result["blockNumber"], 16), {}) \
+                    .setdefault(result["blockHash"], [])
+                if result.get("removed"):
+                    # Reorged away, the hash of its height will not match anymore but there is no point in keeping it
+                    block_logs[:] = [log for log in block_logs if log["logIndex"] != result["logIndex"]]
+                else:
+                    block_logs.append(result)
+
+    def __add_header(self, number: int, block_hash: str, parent_hash: str) -> None:
+        # Headers above a reorged one belong to the old branch. If its parent is not the block below either, there
+        # is no telling how deep the branch switched: every height below is left without a hash, so they are gaps.
+        stale_blocks = [block for block in self.__hashes if block >= number]
+        if self.__taken_to is not None and number <= self.__taken_to and self.__hashes.get(number) != block_hash:
+            self.__reorged_from = min(self.__reorged_from or number, number)
+        for stale in stale_blocks:
+            del self.__hashes[stale]
+        if self.__hashes.get(number - 1, parent_hash) != parent_hash:
+            self.logger.warning(f"Block {number} does not follow the known chain, polling the blocks below it")
+            self.__lose_track()
+            self.__hashes.clear()
+        self.__hashes[number] = block_hash
+
+        for old_block in [block for block in self.__logs if block < number - TAIL_MAX_BUFFERED_BLOCKS]:
+            del self.__logs[old_block]
+        for old_block in [block for block in self.__hashes if block < number - TAIL_MAX_BUFFERED_BLOCKS]:
+            del self.__hashes[old_block]
+
+        self.__head = number
+        self.__condition.notify_all()
+
+    def __lose_track(self) -> None:
+        # Called with the condition held, before forgetting the hashes of the blocks taken
+        taken_blocks = [block for block in self.__hashes if self.__taken_to is not None and block <= self.__taken_to]
+        if taken_blocks:
+            self.__reorged_from = min(self.__reorged_from or min(taken_blocks), min(taken_blocks))
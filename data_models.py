@@ -1,14 +1,12 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
 from typing import Optional
 
 from eth_typing import ChecksumAddress
-from sqlalchemy import Column, Table, String, Integer, BigInteger, DateTime, ForeignKey, Boolean, Numeric, Sequence
+from sqlalchemy import Column, Table, String, Integer, BigInteger, DateTime, ForeignKey, Boolean, Numeric, Sequence, \
+    UniqueConstraint
 from web3 import Web3
-from web3.contract import Contract
-
-from web3_utils import get_w3, get_lptoken_contract
 
 from sqlalchemy.orm import registry, relationship
 
@@ -76,10 +74,15 @@ class Block:
         "block",
         mapper_registry.metadata,
         Column("number", BigInteger(), primary_key=True),
-        Column("timestamp", DateTime(), nullable=False)
+        Column("timestamp", DateTime(), nullable=False),
+        # Unknown for blocks imported before they were stored, and parent_hash for blocks whose header was not fetched
+        Column("hash", String()),
+        Column("parent_hash", String()),
     )
     number: int
     timestamp: datetime
+    hash: Optional[str] = None
+    parent_hash: Optional[str] = None
 
     def __str__(self):
         return f"Block {self.number}"
@@ -140,17 +143,9 @@ class DexTradePair:
     creator_tx: Tx
     is_token0_wbnb: bool
 
-    __pair_contract: Optional[Contract] = field(default=None, init=False, repr=False, hash=False, compare=False)
-
-
     def get_pair_addr(self) -> ChecksumAddress:
         return Web3.toChecksumAddress(self.pair_addr)
 
-    def pair_contract(self) -> Contract:
-        if not self.__pair_contract:
-            self.__pair_contract = get_lptoken_contract(get_w3(), self.get_pair_addr())
-        return self.__pair_contract
-
     def __str__(self):
         return f"Pair for {self.token} ({self.dex})"
 
@@ -192,12 +187,15 @@ class DexTradeSync:
     __table__ = Table(
         "dex_trade_sync",
         mapper_registry.metadata,
-        Column("id", BigInteger(), Sequence('dex_trade_sync_seq'), primary_key=True),
+        # SQLite only autoincrements INTEGER primary keys, it ignores sequences
+        Column("id", BigInteger().with_variant(Integer(), "sqlite"), Sequence('dex_trade_sync_seq'), primary_key=True),
         Column("dex_pair_id", BigInteger(), ForeignKey("dex_trade_pair.id"), nullable=False),
         Column("tx_hash", String(), ForeignKey("tx.hash"), nullable=False),
         Column("log_index", Integer(), nullable=False),
         Column("token_reserves", Numeric(precision=78, scale=0), nullable=False),
         Column("wbnb_reserves", Numeric(precision=78, scale=0), nullable=False),
+        # A log is identified by its tx and index, this lets bulk inserts skip the syncs that are already there
+        UniqueConstraint("tx_hash", "log_index", name="dex_trade_sync_log_uc"),
     )
 
     __mapper_args__ = {  # type: ignore
@@ -214,4 +212,84 @@ class DexTradeSync:
     wbnb_reserves: int
 
     def __str__(self):
-        return f"tradesync for {self.dex_pair}"
\ No newline at end of file
+        return f"tradesync for {self.dex_pair}"
+
+
+@dataclass(unsafe_hash=True)
+@mapper_registry.mapped
+class PairActivity:
+    """ Syncs of a pair seen since first_block, which schedule how often its logs are polled (see pair_activity.py) """
+    __table__ = Table(
+        "pair_activity",
+        mapper_registry.metadata,
+        Column("pair_addr", String(), primary_key=True),
+        Column("first_block", BigInteger(), nullable=False),
+        Column("last_sync_block", BigInteger(), nullable=False),
+        Column("syncs", BigInteger(), nullable=False),
+    )
+
+    pair_addr: str
+    first_block: int
+    last_sync_block: int
+    syncs: int
+
+    def __str__(self):
+        return f"{self.syncs} syncs of {self.pair_addr} since block {self.first_block}"
+
+
+@dataclass(unsafe_hash=True)
+@mapper_registry.mapped
+class ImportCheckpoint:
+    """ A window of blocks whose new pairs and syncs are all in the DDBB, written in the same transaction as them """
+    __table__ = Table(
+        "import_checkpoint",
+        mapper_registry.metadata,
+        Column("first_block", BigInteger(), primary_key=True),
+        Column("last_block", BigInteger(), nullable=False),
+        Column("new_pairs", Integer(), nullable=False),
+        Column("syncs", Integer(), nullable=False),
+        # When the window left each stage of the import pipeline
+        Column("fetched_at", DateTime(), nullable=False),
+        Column("decoded_at", DateTime(), nullable=False),
+        Column("persisted_at", DateTime(), nullable=False),
+        # Set while blocks of the window may still be reorged (see TAIL_CONFIRMATIONS): then its rows are rolled back
+        Column("provisional", Boolean()),
+    )
+
+    first_block: int
+    last_block: int
+    new_pairs: int
+    syncs: int
+    fetched_at: datetime
+    decoded_at: datetime
+    persisted_at: datetime
+    provisional: Optional[bool] = None
+
+    def __str__(self):
+        return f"Checkpoint of blocks {self.first_block}-{self.last_block}"
+
+
+@dataclass(unsafe_hash=True)
+@mapper_registry.mapped
+class BackfillShard:
+    """ A range of blocks imported by one worker process of a sharded backfill, in one of its phases """
+    __table__ = Table(
+        "backfill_shard",
+        mapper_registry.metadata,
+        Column("phase", String(), primary_key=True),
+        Column("first_block", BigInteger(), primary_key=True),
+        Column("last_block", BigInteger(), nullable=False),
+        Column("status", String(), nullable=False),
+        Column("worker", String()),
+        Column("updated_at", DateTime(), nullable=False),
+    )
+
+    phase: str
+    first_block: int
+    last_block: int
+    status: str
+    worker: Optional[str]
+    updated_at: datetime
+
+    def __str__(self):
+        return f"{self.phase} shard {self.first_block}-{self.last_block} ({self.status})"
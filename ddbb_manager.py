@@ -1,11 +1,26 @@
+import csv
+import io
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from typing import List
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-from sqlalchemy import create_engine, text, desc
+from sqlalchemy import case, create_engine, event, func, text, desc, select, inspect, tuple_, Sequence, Table, \
+    UniqueConstraint
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import sessionmaker, Session, joinedload
 
-from data_models import mapper_registry, Block, DexTradePair
+from data_models import mapper_registry, BackfillShard, Block, DexTrade, DexTradePair, DexTradeSync, ImportCheckpoint, \
+    PairActivity, Token, Tx
+from metrics import DDBB_ROWS, DDBB_SECONDS, DDBB_WAIT_SECONDS
+
+# Rows written per COPY/INSERT statement by persist_many
+PERSIST_MANY_BATCH_SIZE = 10000
+
+BLOCK_COLUMNS = ("number", "timestamp", "hash", "parent_hash")
+TX_COLUMNS = ("hash", "block_number", "transaction_index", "gas_price")
+SYNC_COLUMNS = ("dex_pair_id", "tx_hash", "log_index", "token_reserves", "wbnb_reserves")
+ACTIVITY_COLUMNS = ("pair_addr", "first_block", "last_sync_block", "syncs")
 
 
 class DDBBManager:
@@ -14,19 +29,47 @@ class DDBBManager:
     def __init__(self, ddbb_string: str, prune_schema=False):
         self.ddbb_string = ddbb_string
         self.__engine = self.__create_ddbb_engine(ddbb_string, prune_schema=prune_schema)
-        self.__session: Session = sessionmaker(bind=self.__engine)()
+        # Entities outlive commits (pairs list, EntityFactory caches) and are read from other threads, so they must
+        # not be expired on commit: refreshing them would use the session outside of the DB worker thread.
+        self.__session: Session = sessionmaker(bind=self.__engine, expire_on_commit=False)()
         self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='DDBBManagerWorker')
+        self.__pair_ids: Dict[str, int] = {}
 
         if not self.__engine:
             raise ValueError("could not create DDBB engine")
+        if self.__engine.dialect.name == "sqlite":
+            event.listen(self.__session, "before_flush", self.__assign_sqlite_pair_ids)
 
 
     def __str__(self):
         return f"DDBBManager<{self.__engine}>"
 
+    @staticmethod
+    def __assign_sqlite_pair_ids(session: Session, flush_context, instances) -> None:
+        # SQLite only generates INTEGER primary keys, pair ids (a unique column) come from a sequence elsewhere
+        new_pairs = [entity for entity in session.new if isinstance(entity, DexTradePair) and entity.id is None]
+        if new_pairs:
+            last_id = session.execute(select(func.coalesce(func.max(DexTradePair.__table__.c.id), 0))).scalar()
+            for pair_id, pair in enumerate(new_pairs, last_id + 1):
+                pair.id = pair_id
+
+    def __submit(self, operation: str, fn: Callable[[], Any]) -> Future:
+        """ Runs fn on the DB worker thread, timing how long it waited for it and how long it took """
+        submit_time = time.monotonic()
+
+        def __run():
+            start_time = time.monotonic()
+            DDBB_WAIT_SECONDS.observe(start_time - submit_time, operation=operation)
+            try:
+                return fn()
+            finally:
+                DDBB_SECONDS.observe(time.monotonic() - start_time, operation=operation)
+
+        return self.__executor.submit(__run)
+
     def get_last_block(self) -> Block:
-        block_list = self.__executor.submit(
-            lambda: self.__session \
+        block_list = self.__submit(
+            "get_last_block", lambda: self.__session \
                 .query(Block) \
                 .order_by(desc(Block.number)) \
                 .limit(1).all()
@@ -34,36 +77,443 @@ class DDBBManager:
 
         return block_list[0] if block_list else None
 
-    def get_all_pairs(self) -> List[DexTradePair]:
-        return self.__executor.submit(
-            lambda: self.__session \
-                .query(DexTradePair) \
-                .options(joinedload('*')) \
+    def get_first_unimported_block(self, from_block: int = None) -> Optional[int]:
+        """
+        First block after the contiguous run of checkpointed windows starting at from_block, or after the first
+        checkpoint if from_block is None (None if there is none). Unlike get_last_block, it never skips blocks of a
+        window that was not completely imported.
+        """
+        def __query():
+            next_block = from_block
+            checkpoints = self.__session \
+                .query(ImportCheckpoint.first_block, ImportCheckpoint.last_block) \
+                .order_by(ImportCheckpoint.first_block)
+            if from_block is not None:
+                checkpoints = checkpoints.filter(ImportCheckpoint.first_block >= from_block)
+            for first_block, last_block in checkpoints.yield_per(PERSIST_MANY_BATCH_SIZE):
+                if next_block is not None and first_block > next_block:
+                    break
+                next_block = max(next_block or 0, last_block + 1)
+            return next_block
+
+        return self.__submit("get_first_unimported_block", __query).result()
+
+    def get_first_provisional_block(self) -> Optional[int]:
+        """ First block of the provisional checkpoints, None if every checkpoint is final """
+        checkpoint_table: Table = ImportCheckpoint.__table__
+        return self.__submit(
+            "get_first_provisional_block", lambda: self.__session.execute(
+                select(func.min(checkpoint_table.c.first_block)).where(checkpoint_table.c.provisional)
+            ).scalar()
+        ).result()
+
+    def finalize_checkpoints(self, last_block: int) -> None:
+        """ Makes the provisional checkpoints of windows up to last_block final, in the transaction of persist() """
+        checkpoint_table: Table = ImportCheckpoint.__table__
+        self.__submit("finalize_checkpoints", lambda: self.__session.execute(
+            checkpoint_table.update()
+            .where(checkpoint_table.c.provisional, checkpoint_table.c.last_block <= last_block)
+            .values(provisional=None)
+        ))
+
+    def get_backfill_shards(self, phase: str) -> List[BackfillShard]:
+        # Workers update shards from other processes, what this session loaded before is stale
+        return self.__submit(
+            "get_backfill_shards", lambda: self.__session \
+                .query(BackfillShard) \
+                .filter(BackfillShard.phase == phase) \
+                .order_by(BackfillShard.first_block) \
+                .populate_existing() \
                 .all()
         ).result()
 
+    def stream_pairs(self, consume: Callable[[tuple], None]) -> int:
+        """
+        Calls consume, in the DDBB thread, with (pair_addr, id, dex_name, token_address, token_decimals,
+        is_token0_wbnb) of every pair. Rows are read a batch at a time and no entity is loaded. Returns the pairs read.
+        """
+        pair_table: Table = DexTradePair.__table__
+        token_table: Table = Token.__table__
+
+        def __stream() -> int:
+            rows = 0
+            for row in self.__session.execute(
+                select(pair_table.c.pair_addr, pair_table.c.id, pair_table.c.dex_name, pair_table.c.token_address,
+                       token_table.c.decimals, pair_table.c.is_token0_wbnb)
+                .select_from(pair_table.outerjoin(token_table, token_table.c.address == pair_table.c.token_address))
+                # A server side cursor where there is one, so that rows are not all buffered by the driver either
+                .execution_options(stream_results=True)
+            ).yield_per(PERSIST_MANY_BATCH_SIZE):
+                consume(tuple(row))
+                rows += 1
+            return rows
+
+        return self.__submit("stream_pairs", __stream).result()
+
+    def get_pair_activity(self) -> Dict[str, Tuple[int, Optional[int], int]]:
+        """
+        (first block, last sync block, syncs) of every pair by address. Pairs without activity yet count from the
+        block they were created in.
+        """
+        pair_table: Table = DexTradePair.__table__
+        tx_table: Table = Tx.__table__
+        activity_table: Table = PairActivity.__table__
+        return self.__submit(
+            "get_pair_activity", lambda: {
+                pair_addr: (first_block, last_sync_block, syncs)
+                for pair_addr, first_block, last_sync_block, syncs in self.__session.execute(
+                    select(pair_table.c.pair_addr, func.coalesce(activity_table.c.first_block, tx_table.c.block_number),
+                           activity_table.c.last_sync_block, func.coalesce(activity_table.c.syncs, 0))
+                    .select_from(pair_table.join(tx_table, tx_table.c.hash == pair_table.c.creator_tx_hash)
+                                 .outerjoin(activity_table, activity_table.c.pair_addr == pair_table.c.pair_addr))
+                ).yield_per(PERSIST_MANY_BATCH_SIZE)
+            }
+        ).result()
+
+    def persist_pair_activity(self, rows: List[Tuple[str, int, int, int]], sync=False) -> None:
+        """
+        Adds (pair_addr, first_block, last_sync_block, syncs) rows to the activity of each pair, in the same
+        transaction as persist(): syncs are added and the block range widened, so that processes importing different
+        ranges can write the same pairs in any order.
+        """
+        f = self.__submit("persist_pair_activity", lambda: self.__upsert_activity(rows))
+
+        if sync:
+            f.result()
+
+    def get_sync_rows(
+            self, pair_addrs: Iterable[str] = None, from_block: int = None, to_block: int = None
+    ) -> List[tuple]:
+        """
+        Plain (pair_addr, token decimals, block number, block timestamp, log_index, token_reserves, wbnb_reserves)
+        rows of the syncs of pair_addrs (all pairs if None) between from_block and to_block, ordered by pair and log
+        """
+        def __query():
+            rows = self.__session \
+                .query(DexTradePair.pair_addr, Token.decimals, Block.number, Block.timestamp, DexTradeSync.log_index,
+                       DexTradeSync.token_reserves, DexTradeSync.wbnb_reserves) \
+                .select_from(DexTradeSync) \
+                .join(DexTradeSync.dex_pair).join(DexTradePair.token) \
+                .join(DexTradeSync.tx).join(Tx.block)
+            if pair_addrs is not None:
+                rows = rows.filter(DexTradePair.pair_addr.in_(list(pair_addrs)))
+            if from_block is not None:
+                rows = rows.filter(Block.number >= from_block)
+            if to_block is not None:
+                rows = rows.filter(Block.number <= to_block)
+            rows = rows.order_by(DexTradePair.pair_addr, Block.number, DexTradeSync.log_index)
+            return [tuple(row) for row in rows.yield_per(PERSIST_MANY_BATCH_SIZE)]
+
+        return self.__submit("get_sync_rows", __query).result()
+
+    def get_block_hashes(self, from_block: int, to_block: int) -> Dict[int, Tuple[Optional[str], Optional[str]]]:
+        """ (hash, parent_hash) of the blocks stored between from_block and to_block, by number """
+        block_table: Table = Block.__table__
+        return self.__submit(
+            "get_block_hashes", lambda: {
+                number: (block_hash, parent_hash) for number, block_hash, parent_hash in self.__session.execute(
+                    select(block_table.c.number, block_table.c.hash, block_table.c.parent_hash)
+                    .where(block_table.c.number.between(from_block, to_block))
+                )
+            }
+        ).result()
+
+    def roll_back_blocks(self, first_block: int) -> List[str]:
+        """
+        Deletes everything imported from first_block on, in one transaction and with a few bulk statements: syncs,
+        trades and pairs (and their activity) of the txs of those blocks, the txs and the blocks. Checkpoints are cut
+        right before first_block. Returns the addresses of the deleted pairs.
+
+        The activity of the pairs that remain loses the syncs of those blocks: they are subtracted, and the last sync
+        block goes back to the last sync left in the DDBB. Syncs only written to Parquet are not in the DDBB, so then it
+        goes back to first_block - 1, which only keeps the pair polled as hot a little longer.
+        """
+        tx_table: Table = Tx.__table__
+        pair_table: Table = DexTradePair.__table__
+        sync_table: Table = DexTradeSync.__table__
+        activity_table: Table = PairActivity.__table__
+        checkpoint_table: Table = ImportCheckpoint.__table__
+
+        def __delete():
+            orphan_txs = select(tx_table.c.hash).where(tx_table.c.block_number >= first_block)
+            orphan_pair_addrs = select(pair_table.c.pair_addr).where(pair_table.c.creator_tx_hash.in_(orphan_txs))
+            orphan_pairs = [pair_addr for pair_addr, in self.__session.execute(orphan_pair_addrs)]
+            pair_syncs = (
+                sync_table.join(pair_table, pair_table.c.id == sync_table.c.dex_pair_id)
+                .join(tx_table, tx_table.c.hash == sync_table.c.tx_hash)
+            )
+            orphan_syncs = select(func.count()).select_from(pair_syncs).where(
+                pair_table.c.pair_addr == activity_table.c.pair_addr, tx_table.c.block_number >= first_block
+            ).scalar_subquery()
+            last_kept_sync_block = select(func.max(tx_table.c.block_number)).select_from(pair_syncs).where(
+                pair_table.c.pair_addr == activity_table.c.pair_addr, tx_table.c.block_number < first_block
+            ).scalar_subquery()
+            self.__session.execute(
+                activity_table.update().where(activity_table.c.last_sync_block >= first_block).values(
+                    syncs=activity_table.c.syncs - orphan_syncs,
+                    last_sync_block=func.coalesce(last_kept_sync_block, first_block - 1)
+                )
+            )
+            deleted = {}
+            for table, condition in (
+                    (sync_table, sync_table.c.tx_hash.in_(orphan_txs)),
+                    (DexTrade.__table__, DexTrade.__table__.c.tx_hash.in_(orphan_txs)),
+                    # Pairs without syncs left count from the block they were created in again, as new ones
+                    (activity_table, activity_table.c.pair_addr.in_(orphan_pair_addrs)
+                     | (activity_table.c.first_block >= first_block) | (activity_table.c.syncs <= 0)),
+                    # Pairs created in those blocks have no syncs or trades before them
+                    (pair_table, pair_table.c.creator_tx_hash.in_(orphan_txs)),
+                    (tx_table, tx_table.c.block_number >= first_block),
+                    (Block.__table__, Block.__table__.c.number >= first_block),
+                    (checkpoint_table, checkpoint_table.c.first_block >= first_block),
+            ):
+                deleted[table.name] = self.__session.execute(table.delete().where(condition)).rowcount
+            self.__session.execute(
+                checkpoint_table.update()
+                .where(checkpoint_table.c.first_block < first_block, checkpoint_table.c.last_block >= first_block)
+                .values(last_block=first_block - 1)
+            )
+            self.__session.commit()
+            # Loaded entities of the deleted rows must not be merged back as they were
+            self.__session.expunge_all()
+            self.__pair_ids.clear()
+            self.logger.warning(f"Rolled back blocks from {first_block} on, deleted rows: {deleted}")
+            return orphan_pairs
+
+        return self.__submit("roll_back_blocks", __delete).result()
+
     def get_entity_by_pl(self, cls, primary_key_value):
-        return self.__executor.submit(
-            lambda: self.__session.query(cls).get(primary_key_value)
+        return self.__submit(
+            "get_entity_by_pl", lambda: self.__session.query(cls).options(joinedload('*')).get(primary_key_value)
         ).result()
 
+    def get_entities_by_pks(self, cls, primary_key_values: Iterable) -> Dict:
+        """ Batch version of get_entity_by_pl, returns the entities found keyed by their primary key """
+        mapper = inspect(cls)
+        primary_key_column = mapper.primary_key[0]
+        primary_key_attr = mapper.get_property_by_column(primary_key_column).key
+        primary_key_values = list(primary_key_values)
+
+        def __query():
+            entities = []
+            for chunk_start in range(0, len(primary_key_values), PERSIST_MANY_BATCH_SIZE):
+                # Related entities are loaded too, lazy loads would use the session outside of this thread
+                entities.extend(self.__session.query(cls).options(joinedload('*')).filter(primary_key_column.in_(
+                    primary_key_values[chunk_start:chunk_start + PERSIST_MANY_BATCH_SIZE]
+                )))
+            return {getattr(entity, primary_key_attr): entity for entity in entities}
+
+        return self.__submit("get_entities_by_pks", __query).result()
+
     def commit_changes(self, sync=False):
-        f = self.__executor.submit(
-            lambda: self.__session.commit()
+        f = self.__submit(
+            "commit", lambda: self.__session.commit()
         )
 
         if sync:
             f.result()
 
 
+    def rollback_changes(self) -> None:
+        """ Discards everything not committed yet, a session whose commit failed is unusable until then """
+        self.__submit(
+            "rollback", lambda: self.__session.rollback()
+        ).result()
+
     def persist(self, entity, sync=False) -> None:
-        f = self.__executor.submit(
-            lambda: self.__session.merge(entity)
-        )
+        f = self.__submit("persist", lambda: self.__merge(entity))
+
+        if sync:
+            f.result()
+
+    def __merge(self, entity) -> None:
+        if isinstance(entity, DexTradePair):
+            # Backfill shards of other processes may be inserting the same dex and token, which pairs share
+            for shared_entity in (entity.dex, entity.token):
+                if shared_entity is not None:
+                    self.__insert_ignoring_conflicts(shared_entity)
+        self.__session.merge(entity)
+        DDBB_ROWS.inc(table=inspect(type(entity)).local_table.name)
+
+    def persist_many(self, entities: Iterable, sync=False) -> None:
+        """
+        Bulk alternative to persist() for Block, Tx and DexTradeSync entities (the Tx and Block of a sync, and the
+        Block of a Tx, are persisted too).
+
+        Rows are written with COPY on PostgreSQL and with executemany on other databases, skipping the ones that
+        already exist instead of merging them, in the same transaction as persist().
+        """
+        blocks, txs, syncs, pair_ids = self.__stage_rows(entities)
+        f = self.__submit("persist_many", lambda: self.__write_rows(blocks, txs, syncs, pair_ids))
 
         if sync:
             f.result()
 
+    @staticmethod
+    def __stage_rows(entities: Iterable) -> Tuple[List[tuple], List[tuple], List[tuple], Dict[str, int]]:
+        blocks: Dict[int, tuple] = {}
+        txs: Dict[str, tuple] = {}
+        syncs: Dict[Tuple[str, int], tuple] = {}
+        pair_ids: Dict[str, int] = {}
+
+        def __stage_block(block: Block):
+            blocks[block.number] = (block.number, block.timestamp, block.hash, block.parent_hash)
+
+        def __stage_tx(tx: Tx):
+            __stage_block(tx.block)
+            txs[tx.hash] = (tx.hash, tx.block.number, tx.transaction_index, tx.gas_price)
+
+        for entity in entities:
+            if isinstance(entity, DexTradeSync):
+                __stage_tx(entity.tx)
+                # New pairs do not have an id until they are flushed, theirs is resolved in the DB thread
+                if entity.dex_pair.id is not None:
+                    pair_ids[entity.dex_pair.pair_addr] = entity.dex_pair.id
+                syncs[(entity.tx.hash, entity.log_index)] = (
+                    entity.dex_pair.pair_addr, entity.tx.hash, entity.log_index,
+                    entity.token_reserves, entity.wbnb_reserves
+                )
+            elif isinstance(entity, Tx):
+                __stage_tx(entity)
+            elif isinstance(entity, Block):
+                __stage_block(entity)
+            else:
+                raise TypeError(f"persist_many does not support {type(entity).__name__}")
+
+        return list(blocks.values()), list(txs.values()), list(syncs.values()), pair_ids
+
+    def __write_rows(self, blocks: List[tuple], txs: List[tuple], syncs: List[tuple], pair_ids: Dict[str, int]) -> None:
+        # Entities queued with persist() must reach the DB first: they may be referenced by (or be the same as)
+        # the rows below, and ON CONFLICT DO NOTHING only skips rows that are already there.
+        self.__session.flush()
+
+        missing_pair_ids = {
+            pair_addr for pair_addr, *_ in syncs if pair_addr not in pair_ids and pair_addr not in self.__pair_ids
+        }
+        if missing_pair_ids:
+            pair_table: Table = DexTradePair.__table__
+            self.__pair_ids.update(self.__session.execute(
+                select(pair_table.c.pair_addr, pair_table.c.id).where(pair_table.c.pair_addr.in_(missing_pair_ids))
+            ).all())
+        sync_rows = [(pair_ids.get(pair_addr) or self.__pair_ids[pair_addr], *row) for pair_addr, *row in syncs]
+
+        self.__insert_rows(Block.__table__, BLOCK_COLUMNS, blocks)
+        self.__insert_rows(Tx.__table__, TX_COLUMNS, txs)
+        self.__insert_rows(DexTradeSync.__table__, SYNC_COLUMNS, sync_rows)
+
+    def __insert_rows(self, table: Table, columns: Tuple[str, ...], rows: List[tuple]) -> None:
+        for batch_start in range(0, len(rows), PERSIST_MANY_BATCH_SIZE):
+            batch = rows[batch_start:batch_start + PERSIST_MANY_BATCH_SIZE]
+            if self.__engine.dialect.name == "postgresql":
+                self.__copy_rows(table, columns, batch)
+            elif self.__engine.dialect.name == "sqlite":
+                self.__session.execute(
+                    sqlite.insert(table).on_conflict_do_nothing(),
+                    [dict(zip(columns, row)) for row in batch]
+                )
+            else:
+                batch = self.__skip_existing_rows(table, columns, batch)
+                if batch:
+                    self.__session.execute(table.insert(), [dict(zip(columns, row)) for row in batch])
+        DDBB_ROWS.inc(len(rows), table=table.name)
+
+    def __insert_ignoring_conflicts(self, entity) -> None:
+        """
+        Inserts the row of entity unless it is there. Unlike merge (which looks it up, then inserts it) this does not
+        fail when another transaction inserts it first: it waits for that one to commit. The merge then finds it.
+        """
+        if self.__engine.dialect.name not in ("postgresql", "sqlite"):
+            return
+        table: Table = inspect(type(entity)).local_table
+        insert = (postgresql if self.__engine.dialect.name == "postgresql" else sqlite).insert(table)
+        self.__session.execute(
+            insert.on_conflict_do_nothing(), {column.name: getattr(entity, column.name) for column in table.columns}
+        )
+
+    def __skip_existing_rows(self, table: Table, columns: Tuple[str, ...], rows: List[tuple]) -> List[tuple]:
+        """ Rows whose key is neither in the table nor earlier in rows, for dialects without ON CONFLICT DO NOTHING """
+        key_columns = self.__row_key_columns(table)
+        key_indexes = [columns.index(column.name) for column in key_columns]
+        keys = [tuple(row[i] for i in key_indexes) for row in rows]
+        key_expression = key_columns[0] if len(key_columns) == 1 else tuple_(*key_columns)
+        existing_keys = {
+            tuple(key) for key in self.__session.execute(select(*key_columns).where(
+                key_expression.in_([key[0] for key in keys] if len(key_columns) == 1 else keys)
+            ))
+        }
+
+        new_rows = []
+        for key, row in zip(keys, rows):
+            if key not in existing_keys:
+                existing_keys.add(key)
+                new_rows.append(row)
+        return new_rows
+
+    @staticmethod
+    def __row_key_columns(table: Table) -> list:
+        # What identifies a row: its primary key, unless that is a generated id and the table has a unique constraint
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint) and constraint.name:
+                return list(constraint.columns)
+        return list(table.primary_key.columns)
+
+    def __upsert_activity(self, rows: List[Tuple[str, int, int, int]]) -> None:
+        activity_table: Table = PairActivity.__table__
+        if self.__engine.dialect.name in ("postgresql", "sqlite"):
+            insert = (postgresql if self.__engine.dialect.name == "postgresql" else sqlite).insert(activity_table)
+            statement = insert.on_conflict_do_update(index_elements=[activity_table.c.pair_addr], set_={
+                "first_block": case((insert.excluded.first_block < activity_table.c.first_block,
+                                     insert.excluded.first_block), else_=activity_table.c.first_block),
+                "last_sync_block": case((insert.excluded.last_sync_block > activity_table.c.last_sync_block,
+                                         insert.excluded.last_sync_block), else_=activity_table.c.last_sync_block),
+                "syncs": activity_table.c.syncs + insert.excluded.syncs,
+            })
+            for batch_start in range(0, len(rows), PERSIST_MANY_BATCH_SIZE):
+                self.__session.execute(statement, [
+                    dict(zip(ACTIVITY_COLUMNS, row)) for row in rows[batch_start:batch_start + PERSIST_MANY_BATCH_SIZE]
+                ])
+        else:
+            for pair_addr, first_block, last_sync_block, syncs in rows:
+                activity = self.__session.get(PairActivity, pair_addr)
+                if activity is None:
+                    self.__session.add(PairActivity(
+                        pair_addr=pair_addr, first_block=first_block, last_sync_block=last_sync_block, syncs=syncs
+                    ))
+                else:
+                    activity.first_block = min(activity.first_block, first_block)
+                    activity.last_sync_block = max(activity.last_sync_block, last_sync_block)
+                    activity.syncs += syncs
+        DDBB_ROWS.inc(len(rows), table=activity_table.name)
+
+    def __copy_rows(self, table: Table, columns: Tuple[str, ...], rows: List[tuple]) -> None:
+        # COPY cannot skip conflicting rows, so copy into a temporary staging table and move them from there
+        staging_table = f"staging_{table.name}"
+        column_list = ", ".join(columns)
+        target_columns, source_columns = column_list, column_list
+        id_column = table.c.get("id")
+        if id_column is not None and isinstance(id_column.default, Sequence):
+            target_columns = f"id, {column_list}"
+            source_columns = f"nextval('{id_column.default.name}'), {column_list}"
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+
+        self.__session.execute(text(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table} ON COMMIT DELETE ROWS "
+            f"AS SELECT {column_list} FROM {table.name} WITH NO DATA"
+        ))
+        cursor = self.__session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {staging_table} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+        finally:
+            cursor.close()
+        self.__session.execute(text(
+            f"INSERT INTO {table.name} ({target_columns}) SELECT {source_columns} FROM {staging_table} "
+            f"ON CONFLICT DO NOTHING"
+        ))
+        self.__session.execute(text(f"TRUNCATE {staging_table}"))
+
     @staticmethod
     def __create_ddbb_engine(ddbb_string, prune_schema=False):
         engine = None
@@ -77,8 +527,59 @@ class DDBBManager:
                         conn.execute(text("drop schema public CASCADE; create schema public"))
 
                 mapper_registry.metadata.create_all(engine)
+                DDBBManager.__add_missing_columns(engine)
+                DDBBManager.__add_missing_unique_constraints(engine)
             except (Exception,):
                 engine = None
                 DDBBManager.logger.exception("could not create ddbb engine")
 
         return engine
+
+    @staticmethod
+    def __add_missing_columns(engine) -> None:
+        # create_all only creates missing tables, nullable columns added to existing ones are added here
+        ddbb_inspector = inspect(engine)
+        with engine.begin() as conn:
+            for table in mapper_registry.metadata.sorted_tables:
+                existing_columns = {column["name"] for column in ddbb_inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing_columns and column.nullable:
+                        DDBBManager.logger.info(f"Adding column {table.name}.{column.name}")
+                        conn.execute(text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                        ))
+
+    @staticmethod
+    def __add_missing_unique_constraints(engine) -> None:
+        """
+        create_all does not add constraints to existing tables either. Bulk inserts rely on the named unique
+        constraints to skip the rows already there, so they are added as unique indexes, removing the duplicates
+        imported without them first (the row with the lowest id is kept).
+        """
+        ddbb_inspector = inspect(engine)
+        with engine.begin() as conn:
+            for table in mapper_registry.metadata.sorted_tables:
+                existing = {
+                    tuple(constraint["column_names"])
+                    for constraint in ddbb_inspector.get_unique_constraints(table.name)
+                } | {
+                    tuple(index["column_names"]) for index in ddbb_inspector.get_indexes(table.name) if index["unique"]
+                }
+                for constraint in table.constraints:
+                    if not isinstance(constraint, UniqueConstraint) or not constraint.name:
+                        continue
+                    column_names = tuple(column.name for column in constraint.columns)
+                    if column_names in existing:
+                        continue
+
+                    column_list = ", ".join(column_names)
+                    DDBBManager.logger.info(f"Adding unique index {constraint.name} on {table.name} ({column_list})")
+                    removed = conn.execute(text(
+                        f"DELETE FROM {table.name} WHERE id NOT IN "
+                        f"(SELECT MIN(id) FROM {table.name} GROUP BY {column_list})"
+                    )).rowcount if "id" in table.c else 0
+                    if removed:
+                        DDBBManager.logger.warning(f"Removed {removed} duplicated rows from {table.name}")
+                    conn.execute(text(
+                        f"CREATE UNIQUE INDEX IF NOT EXISTS {constraint.name} ON {table.name} ({column_list})"
+                    ))
@@ -0,0 +1,95 @@
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Hashable, Optional
+
+from metrics import CACHE_LOOKUPS
+
+HITS = "hits"
+DB_HITS = "db_hits"
+RPC_FETCHES = "rpc_fetches"
+
+
+def estimate_entity_size(entity: Any) -> int:
+    """ Shallow estimation of the memory held by an entity: the object, its attributes and their direct values """
+    size = sys.getsizeof(entity)
+    attributes = getattr(entity, '__dict__', None)
+    if attributes:
+        size += sys.getsizeof(attributes)
+        size += sum(sys.getsizeof(value) for value in attributes.values() if not hasattr(value, '__dict__'))
+    return size
+
+
+class LRUEntityCache:
+    """ Thread-safe LRU cache bounded both by number of entries and by (estimated) memory """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.__entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self.__sizes: Dict[Hashable, int] = {}
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __str__(self):
+        return f"LRUEntityCache<{len(self)}/{self.max_entries} entries, {self.__bytes / 2 ** 20:.1f} MiB>"
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            entity = self.__entries.get(key)
+            if entity is not None:
+                self.__entries.move_to_end(key)
+            return entity
+
+    def put(self, key: Hashable, entity: Any) -> None:
+        entity_size = estimate_entity_size(entity)
+        with self.__lock:
+            if key in self.__entries:
+                self.__bytes -= self.__sizes[key]
+            self.__entries[key] = entity
+            self.__entries.move_to_end(key)
+            self.__sizes[key] = entity_size
+            self.__bytes += entity_size
+
+            while self.__entries and (len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes):
+                evicted_key, _ = self.__entries.popitem(last=False)
+                self.__bytes -= self.__sizes.pop(evicted_key)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__sizes.clear()
+            self.__bytes = 0
+
+
+class EntityCacheStats:
+    """ Thread-safe counters of where entities came from (cache, DB or RPC), per entity type """
+
+    def __init__(self):
+        self.__counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.__lock = threading.Lock()
+
+    def count(self, cls: type, counter: str, n: int = 1) -> None:
+        CACHE_LOOKUPS.inc(n, cache=cls.__name__, result=counter)
+        with self.__lock:
+            self.__counters[cls.__name__][counter] += n
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.__lock:
+            return {entity_type: dict(counters) for entity_type, counters in self.__counters.items()}
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__counters.clear()
+
+    def __str__(self):
+        return ", ".join(
+            f"{entity_type}: {counters.get(HITS, 0)} cached/{counters.get(DB_HITS, 0)} DB/"
+            f"{counters.get(RPC_FETCHES, 0)} RPC"
+            for entity_type, counters in sorted(self.snapshot().items())
+        )
@@ -1,58 +1,204 @@
+import logging
+import os
 from datetime import datetime
+from typing import Callable, Dict, Hashable, Iterable
 
 from eth_typing import ChecksumAddress
 from hexbytes import HexBytes
 from web3 import Web3
-from web3.types import TxData, TxReceipt
+from web3.types import BlockData, TxData
 
-from data_models import Token, Block, Tx, DexTradePair, DexTrade, DexTradeSync
+from block_timestamps import BlockTimestampService
+from data_models import Token, Block, Tx, DexTradePair, DexTradeSync
 from ddbb_manager import DDBBManager
-from web3_utils import get_erc20_contract, get_w3, WBNB_ADDRESS
+from entity_cache import EntityCacheStats, LRUEntityCache, HITS, DB_HITS, RPC_FETCHES
+from log_decoder import PairCreatedLog, SyncLog
+from rpc_batch import BatchRpcError, JsonRpcBatcher
+from token_metadata import TokenMetadataResolver
+from web3_utils import get_w3, WBNB_ADDRESS
 
 
-class EntityFactory:
+# Entries kept in memory per entity type, and the (estimated) memory they may take
+CACHE_MAX_ENTRIES = {
+    Token: int(os.getenv("TOKEN_CACHE_SIZE", 100000)),
+    Block: int(os.getenv("BLOCK_CACHE_SIZE", 200000)),
+    Tx: int(os.getenv("TX_CACHE_SIZE", 500000)),
+    DexTradePair: int(os.getenv("PAIR_CACHE_SIZE", 500000)),
+}
+CACHE_MAX_BYTES_PER_TYPE = int(os.getenv("ENTITY_CACHE_MAX_MB", 256)) * 2 ** 20
 
-    def __init__(self, dbm: DDBBManager = None):
-        self.dbm = dbm
 
-    def get_token(self, token_addr: ChecksumAddress) -> Token:
-        if isinstance(token_addr, str):
-            token_addr = Web3.toChecksumAddress(token_addr)
+class EntityFactory:
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+            self,
+            dbm: DDBBManager = None,
+            batcher: JsonRpcBatcher = None,
+            timestamps: BlockTimestampService = None
+    ):
+        self.dbm = dbm
+        self.batcher = batcher
+        self.timestamps = timestamps
+        self.cache_stats = EntityCacheStats()
+        self.token_resolver = TokenMetadataResolver(batcher)
+        self.__caches = {
+            cls: LRUEntityCache(max_entries, CACHE_MAX_BYTES_PER_TYPE) for cls, max_entries in CACHE_MAX_ENTRIES.items()
+        }
+        self.__prefetched_txs: Dict[str, Tx] = {}
+
+    def __get_entity(self, cls, primary_key: Hashable, fetch: Callable[[], object]):
+        """ Looks the entity up in the cache, then in the DDBB and calls fetch() only if it is in none of them """
+        cache = self.__caches[cls]
+        entity = cache.get(primary_key)
+        if entity is not None:
+            self.cache_stats.count(cls, HITS)
+            return entity
 
         if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Token, token_addr)
+            entity = self.dbm.get_entity_by_pl(cls, primary_key)
             if entity:
+                self.cache_stats.count(cls, DB_HITS)
+                cache.put(primary_key, entity)
                 return entity
 
-        contract = get_erc20_contract(get_w3(), token_addr)
-        try:
-            name = contract.functions.name().call()
-        except:
-            name = ""
+        entity = fetch()
+        if entity is not None:
+            self.cache_stats.count(cls, RPC_FETCHES)
+            cache.put(primary_key, entity)
+        return entity
+
+    def prefetch_txs(self, tx_hashes: Iterable[str]) -> Dict[str, Tx]:
+        """
+        Resolves the given txs, and their blocks, with a few batch requests so that get_tx can serve them without any
+        round-trip until clear_prefetched() is called. Does nothing without a batcher.
+
+        Returns the txs it could resolve, by hash, so callers can use them even after another window cleared them.
+        """
+        resolved: Dict[str, Tx] = {}
+        if not self.batcher:
+            return resolved
+
+        tx_hashes = {tx_hash.hex() if isinstance(tx_hash, HexBytes) else tx_hash for tx_hash in tx_hashes}
+        for tx_hash in tx_hashes:
+            tx = self.__prefetched_txs.get(tx_hash) or self.__caches[Tx].get(tx_hash)
+            if tx is not None:
+                resolved[tx_hash] = tx
+        tx_hashes -= resolved.keys()
+        if self.dbm and tx_hashes:
+            txs_in_ddbb = self.dbm.get_entities_by_pks(Tx, tx_hashes)
+            self.cache_stats.count(Tx, DB_HITS, len(txs_in_ddbb))
+            self.__prefetch(txs_in_ddbb)
+            resolved.update(txs_in_ddbb)
+            tx_hashes -= txs_in_ddbb.keys()
+        if not tx_hashes:
+            return resolved
 
         try:
-            symbol = contract.functions.symbol().call()
-        except:
-            symbol = ""
+            txs_data = self.batcher.get_transactions(tx_hashes)
+            block_numbers = {tx_data['blockNumber'] for tx_data in txs_data.values()}
+            blocks = {}
+            for block_number in block_numbers:
+                block = self.__caches[Block].get(block_number)
+                if block is not None:
+                    self.cache_stats.count(Block, HITS)
+                    blocks[block_number] = block
+            if self.dbm and block_numbers - blocks.keys():
+                blocks_in_ddbb = self.dbm.get_entities_by_pks(Block, block_numbers - blocks.keys())
+                self.cache_stats.count(Block, DB_HITS, len(blocks_in_ddbb))
+                blocks.update(blocks_in_ddbb)
+            if self.timestamps:
+                blocks.update({
+                    block_number: block for block_number, block in (
+                        (block_number, self.timestamps.get_block(block_number))
+                        for block_number in block_numbers - blocks.keys()
+                    ) if block
+                })
+            fetched_blocks = {
+                block_number: self.block_from_data(block_data)
+                for block_number, block_data in self.batcher.get_blocks(block_numbers - blocks.keys()).items()
+            }
+            self.cache_stats.count(Block, RPC_FETCHES, len(fetched_blocks))
+            blocks.update(fetched_blocks)
+        except BatchRpcError:
+            # get_tx will fetch them one by one
+            self.logger.exception(f"Could not prefetch {len(tx_hashes)} txs")
+            return resolved
+
+        for block_number, block in blocks.items():
+            self.__caches[Block].put(block_number, block)
+        self.cache_stats.count(Tx, RPC_FETCHES, len(txs_data))
+        fetched_txs = {
+            tx_hash: self.tx_from_data(tx_data, blocks[tx_data['blockNumber']]) for tx_hash, tx_data in txs_data.items()
+        }
+        self.__prefetch(fetched_txs)
+        resolved.update(fetched_txs)
+        return resolved
+
+    def __prefetch(self, txs: Dict[str, Tx]) -> None:
+        # Prefetched txs are kept apart too, so the LRU cannot evict them before the window is done
+        self.__prefetched_txs.update(txs)
+        for tx_hash, tx in txs.items():
+            self.__caches[Tx].put(tx_hash, tx)
+
+    def clear_prefetched(self) -> None:
+        self.__prefetched_txs.clear()
+
+    def clear_caches(self) -> None:
+        """ Forgets every entity, after a reorg they may be from the abandoned branch """
+        self.clear_prefetched()
+        for cache in self.__caches.values():
+            cache.clear()
 
-        try:
-            decimals = contract.functions.decimals().call()
-        except:
-            decimals = 0
+    def get_token(self, token_addr: ChecksumAddress) -> Token:
+        if isinstance(token_addr, str):
+            token_addr = Web3.toChecksumAddress(token_addr)
 
-        return Token(address=token_addr, name=name, symbol=symbol, decimals=decimals)
+        return self.__get_entity(Token, token_addr, lambda: self.__fetch_token(token_addr))
+
+    def __fetch_token(self, token_addr: ChecksumAddress) -> Token:
+        return self.token_resolver.resolve([token_addr])[token_addr]
+
+    def prefetch_tokens(self, token_addrs: Iterable[ChecksumAddress]) -> Dict[ChecksumAddress, Token]:
+        """
+        Resolves the given tokens, the ones in neither the cache nor the DDBB with a few multicalls (see
+        TokenMetadataResolver), so that get_token serves them from the cache. Returns them by address.
+        """
+        resolved: Dict[ChecksumAddress, Token] = {}
+        token_addrs = {Web3.toChecksumAddress(token_addr) for token_addr in token_addrs}
+        for token_addr in token_addrs:
+            token = self.__caches[Token].get(token_addr)
+            if token is not None:
+                resolved[token_addr] = token
+        token_addrs -= resolved.keys()
+        if self.dbm and token_addrs:
+            tokens_in_ddbb = self.dbm.get_entities_by_pks(Token, token_addrs)
+            self.cache_stats.count(Token, DB_HITS, len(tokens_in_ddbb))
+            resolved.update(tokens_in_ddbb)
+            token_addrs -= tokens_in_ddbb.keys()
+        if token_addrs:
+            fetched_tokens = self.token_resolver.resolve(token_addrs)
+            self.cache_stats.count(Token, RPC_FETCHES, len(fetched_tokens))
+            resolved.update(fetched_tokens)
+
+        for token_addr, token in resolved.items():
+            self.__caches[Token].put(token_addr, token)
+        return resolved
 
     def get_block(self, block_number: int) -> Block:
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Block, block_number)
-            if entity:
-                return entity
+        return self.__get_entity(Block, block_number, lambda: self.__fetch_block(block_number))
 
-        block_data = get_w3().eth.get_block(block_number)
+    def __fetch_block(self, block_number: int) -> Block:
+        block = self.timestamps.get_block(block_number) if self.timestamps else None
+        return block or self.block_from_data(get_w3().eth.get_block(block_number))
 
+    @staticmethod
+    def block_from_data(block_data: BlockData) -> Block:
         return Block(
-            number=block_number,
-            timestamp=datetime.fromtimestamp(block_data['timestamp'])
+            number=block_data['number'],
+            timestamp=datetime.fromtimestamp(block_data['timestamp']),
+            hash=block_data['hash'].hex(),
+            parent_hash=block_data['parentHash'].hex()
         )
 
     def get_tx(self, tx_hash: str) -> Tx:
@@ -62,275 +208,55 @@ class EntityFactory:
         if isinstance(tx_hash, HexBytes):
             tx_hash = tx_hash.hex()
 
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Tx, tx_hash)
-            if entity:
-                return entity
-
-        tx_data: TxData = get_w3().eth.get_transaction(tx_hash)
-
-        return Tx(
-            hash=tx_hash,
-            block=self.get_block(tx_data['blockNumber']),
-            transaction_index=tx_data['transactionIndex'],
-            gas_price=tx_data['gasPrice']
-        )
-
-    def get_DexTradePair(self, dex, pair_created, none_on_not_wbnb_pair=True) -> DexTradePair:
-        if none_on_not_wbnb_pair and WBNB_ADDRESS not in (pair_created.args.values()):
-            return None
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(DexTradePair, pair_created.args.pair)
-            if entity:
-                return entity
-
-        is_token0_wbnb = WBNB_ADDRESS == pair_created.args.token0
-        token_addr = pair_created.args.token1 if is_token0_wbnb else pair_created.args.token0
-        symbol = contract.functions.symbol().call()
-        decimals = contract.functions.decimals().call()
+        prefetched_tx = self.__prefetched_txs.get(tx_hash)
+        if prefetched_tx:
+            self.cache_stats.count(Tx, HITS)
+            return prefetched_tx
 
-        return Token(address=token_addr, name=name, symbol=symbol, decimals=decimals)
-
-    def get_block(self, block_number: int) -> Block:
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Block, block_number)
-            if entity:
-                return entity
-
-        block_data = get_w3().eth.get_block(block_number)
-
-        return Block(
-            number=block_number,
-            timestamp=datetime.fromtimestamp(block_data['timestamp'])
-        )
-
-    def get_tx(self, tx_hash: str) -> Tx:
-        if not tx_hash:
-            raise ValueError("tx_hash cannot be None")
-
-        if isinstance(tx_hash, HexBytes):
-            tx_hash = tx_hash.hex()
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Tx, tx_hash)
-            if entity:
-                return entity
+        return self.__get_entity(Tx, tx_hash, lambda: self.__fetch_tx(tx_hash))
 
+    def __fetch_tx(self, tx_hash: str) -> Tx:
         tx_data: TxData = get_w3().eth.get_transaction(tx_hash)
 
-        return Tx(
-            hash=tx_hash,
-            block=self.get_block(tx_data['blockNumber']),
-            transaction_index=tx_data['transactionIndex'],
-            gas_price=tx_data['gasPrice']
-        )
-
-    def get_DexTradePair(self, dex, pair_created, none_on_not_wbnb_pair=True) -> DexTradePair:
-        if none_on_not_wbnb_pair and WBNB_ADDRESS not in (pair_created.args.values()):
-            return None
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(DexTradePair, pair_created.args.pair)
-            if entity:
-                return entity
-
-        is_token0_wbnb = WBNB_ADDRESS == pair_created.args.token0
-        token_addr = pair_created.args.token1 if is_token0_wbnb else pair_created.args.token0
-        try:
-            name = contract.functions.name().call()
-        except:
-            name = ""
-
-        symbol = contract.functions.symbol().call()
-        decimals = contract.functions.decimals().call()
-
-        return Token(address=token_addr, name=name, symbol=symbol, decimals=decimals)
-
-    def get_block(self, block_number: int) -> Block:
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Block, block_number)
-            if entity:
-                return entity
-
-        block_data = get_w3().eth.get_block(block_number)
-
-        return Block(
-            number=block_number,
-            timestamp=datetime.fromtimestamp(block_data['timestamp'])
-        )
-
-    def get_tx(self, tx_hash: str) -> Tx:
-        if not tx_hash:
-            raise ValueError("tx_hash cannot be None")
-
-        if isinstance(tx_hash, HexBytes):
-            tx_hash = tx_hash.hex()
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Tx, tx_hash)
-            if entity:
-                return entity
-
-        tx_data: TxData = get_w3().eth.get_transaction(tx_hash)
-
-        return Tx(
-            hash=tx_hash,
-            block=self.get_block(tx_data['blockNumber']),
-            transaction_index=tx_data['transactionIndex'],
-            gas_price=tx_data['gasPrice']
-        )
-
-    def get_DexTradePair(self, dex, pair_created, none_on_not_wbnb_pair=True) -> DexTradePair:
-        if none_on_not_wbnb_pair and WBNB_ADDRESS not in (pair_created.args.values()):
-            return None
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(DexTradePair, pair_created.args.pair)
-            if entity:
-                return entity
-
-        is_token0_wbnb = WBNB_ADDRESS == pair_created.args.token0
-        token_addr = pair_created.args.token1 if is_token0_wbnb else pair_created.args.token0
-        try:
-            name = contract.functions.name().call()
-        except:
-            name = ""
-
-        symbol = contract.functions.symbol().call()
-        decimals = contract.functions.decimals().call()
-
-        return Token(address=token_addr, name=name, symbol=symbol, decimals=decimals)
-
-    def get_block(self, block_number: int) -> Block:
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Block, block_number)
-            if entity:
-                return entity
-
-        block_data = get_w3().eth.get_block(block_number)
-
-        return Block(
-            number=block_number,
-            timestamp=datetime.fromtimestamp(block_data['timestamp'])
-        )
-
-    def get_tx(self, tx_hash: str) -> Tx:
-        if not tx_hash:
-            raise ValueError("tx_hash cannot be None")
-
-        if isinstance(tx_hash, HexBytes):
-            tx_hash = tx_hash.hex()
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Tx, tx_hash)
-            if entity:
-                return entity
-
-        tx_data: TxData = get_w3().eth.get_transaction(tx_hash)
+        return self.tx_from_data(tx_data, self.get_block(tx_data['blockNumber']))
 
+    @staticmethod
+    def tx_from_data(tx_data: TxData, block: Block) -> Tx:
+        if block.hash is None and tx_data.get('blockHash'):
+            # Blocks of interpolated timestamps only get their hash from their txs
+            block.hash = tx_data['blockHash'].hex()
+        tx_hash = tx_data['hash']
         return Tx(
-            hash=tx_hash,
-            block=self.get_block(tx_data['blockNumber']),
+            hash=tx_hash.hex() if isinstance(tx_hash, HexBytes) else tx_hash,
+            block=block,
             transaction_index=tx_data['transactionIndex'],
             gas_price=tx_data['gasPrice']
         )
 
-    def get_DexTradePair(self, dex, pair_created, none_on_not_wbnb_pair=True) -> DexTradePair:
-        if none_on_not_wbnb_pair and WBNB_ADDRESS not in (pair_created.args.values()):
+    def get_DexTradePair(self, dex, pair_created: PairCreatedLog, none_on_not_wbnb_pair=True) -> DexTradePair:
+        if none_on_not_wbnb_pair and WBNB_ADDRESS not in (pair_created.token0, pair_created.token1):
             return None
 
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(DexTradePair, pair_created.args.pair)
-            if entity:
-                return entity
-
-        is_token0_wbnb = WBNB_ADDRESS == pair_created.args.token0
-        token_addr = pair_created.args.token1 if is_token0_wbnb else pair_created.args.token0
-        symbol = contract.functions.symbol().call()
-        decimals = contract.functions.decimals().call()
-
-        return Token(address=token_addr, name=name, symbol=symbol, decimals=decimals)
-
-    def get_block(self, block_number: int) -> Block:
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Block, block_number)
-            if entity:
-                return entity
-
-        block_data = get_w3().eth.get_block(block_number)
-
-        return Block(
-            number=block_number,
-            timestamp=datetime.fromtimestamp(block_data['timestamp'])
+        return self.__get_entity(
+            DexTradePair, pair_created.pair, lambda: self.__fetch_DexTradePair(dex, pair_created)
         )
 
-    def get_tx(self, tx_hash: str) -> Tx:
-        if not tx_hash:
-            raise ValueError("tx_hash cannot be None")
-
-        if isinstance(tx_hash, HexBytes):
-            tx_hash = tx_hash.hex()
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(Tx, tx_hash)
-            if entity:
-                return entity
-
-        tx_data: TxData = get_w3().eth.get_transaction(tx_hash)
-
-        return Tx(
-            hash=tx_hash,
-            block=self.get_block(tx_data['blockNumber']),
-            transaction_index=tx_data['transactionIndex'],
-            gas_price=tx_data['gasPrice']
-        )
-
-    def get_DexTradePair(self, dex, pair_created, none_on_not_wbnb_pair=True) -> DexTradePair:
-        if none_on_not_wbnb_pair and WBNB_ADDRESS not in (pair_created.args.values()):
-            return None
-
-        if self.dbm:
-            entity = self.dbm.get_entity_by_pl(DexTradePair, pair_created.args.pair)
-            if entity:
-                return entity
-
-        is_token0_wbnb = WBNB_ADDRESS == pair_created.args.token0
-        token_addr = pair_created.args.token1 if is_token0_wbnb else pair_created.args.token0
+    def __fetch_DexTradePair(self, dex, pair_created: PairCreatedLog) -> DexTradePair:
+        is_token0_wbnb = WBNB_ADDRESS == pair_created.token0
+        token_addr = pair_created.token1 if is_token0_wbnb else pair_created.token0
         token = self.get_token(token_addr)
 
         return DexTradePair(
-            pair_addr=pair_created.args.pair,
-            dex=dex, token=token, creator_tx=self.get_tx(pair_created.transactionHash),
+            pair_addr=pair_created.pair,
+            dex=dex, token=token, creator_tx=self.get_tx(pair_created.tx_hash),
             is_token0_wbnb=is_token0_wbnb
         )
 
-    def get_DexTrade(self, swap_info: TxReceipt, dex_pair: DexTradePair) -> DexTrade:
-        # No cache in DDBB for this entity
-        if dex_pair.is_token0_wbnb:
-            token_in = swap_info.args['amount1In']
-            token_out = swap_info.args['amount1Out']
-            wbnb_in = swap_info.args['amount0In']
-            wbnb_out = swap_info.args['amount0Out']
-        else:
-            token_in = swap_info.args['amount0In']
-            token_out = swap_info.args['amount0Out']
-            wbnb_in = swap_info.args['amount1In']
-            wbnb_out = swap_info.args['amount1Out']
-
-        return DexTrade(
-            dex_pair=dex_pair,
-            tx=self.get_tx(swap_info.transactionHash),
-            log_index=swap_info.logIndex,
-            token_delta=token_in - token_out,
-            wbnb_delta=wbnb_in - wbnb_out
-        )
-
-    def get_DexTradeSync(self, swap_info: TxReceipt, dex_pair: DexTradePair) -> DexTradeSync:
+    def get_DexTradeSync(self, sync: SyncLog, dex_pair: DexTradePair, tx: Tx = None) -> DexTradeSync:
         return DexTradeSync(
             dex_pair=dex_pair,
-            tx=self.get_tx(swap_info.transactionHash),
-            log_index=swap_info.logIndex,
-            token_reserves=swap_info.args['reserve1'] if dex_pair.is_token0_wbnb else swap_info.args['reserve0'],
-            wbnb_reserves=swap_info.args['reserve0'] if dex_pair.is_token0_wbnb else swap_info.args['reserve1']
+            tx=tx or self.get_tx(sync.tx_hash),
+            log_index=sync.log_index,
+            token_reserves=sync.reserve1 if dex_pair.is_token0_wbnb else sync.reserve0,
+            wbnb_reserves=sync.reserve0 if dex_pair.is_token0_wbnb else sync.reserve1
         )
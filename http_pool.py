@@ -0,0 +1,41 @@
+import os
+import threading
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Keep-alive connections kept per host, should be at least the threads that may talk to it at once: connections over
+# it are closed after their request and opened again for the next one
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 64))
+
+__sessions: Dict[str, requests.Session] = {}
+__sessions_lock = threading.Lock()
+
+
+def get_http_session(endpoint_uri: str) -> requests.Session:
+    """ Process-wide session for an endpoint, every thread shares its pool of keep-alive connections """
+    with __sessions_lock:
+        session = __sessions.get(endpoint_uri)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            __sessions[endpoint_uri] = session
+        return session
+
+
+def connection_setups() -> int:
+    """ Connections (TCP and, for https, TLS handshakes) opened so far by the sessions of get_http_session """
+    total = 0
+    with __sessions_lock:
+        sessions = list(__sessions.values())
+    for session in sessions:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    total += pool.num_connections
+    return total
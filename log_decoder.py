@@ -0,0 +1,69 @@
+from typing import NamedTuple, Union
+
+from eth_typing import ChecksumAddress
+from web3 import Web3
+
+from web3_utils import PAIR_CREATED_EVENT_TOPIC, SYNC_EVENT_TOPIC
+
+# Hex characters of a 0x-prefixed log data of two 32 bytes words
+TWO_WORDS_DATA_LENGTH = 2 + 2 * 64
+
+
+class SyncLog(NamedTuple):
+    """ Sync(uint112 reserve0, uint112 reserve1) of a UniswapV2 pair """
+    # Of the pair, in the case the node sent it
+    address: str
+    block_number: int
+    tx_hash: str
+    log_index: int
+    reserve0: int
+    reserve1: int
+
+
+class PairCreatedLog(NamedTuple):
+    """ PairCreated(address indexed token0, address indexed token1, address pair, uint256) of a UniswapV2 factory """
+    # Of the factory, in the case the node sent it
+    address: str
+    block_number: int
+    tx_hash: str
+    log_index: int
+    token0: ChecksumAddress
+    token1: ChecksumAddress
+    pair: ChecksumAddress
+    pair_index: int
+
+
+def _hex(value: Union[str, bytes]) -> str:
+    # Logs come as the node sent them (hex strings) or formatted by web3 (HexBytes)
+    return value if isinstance(value, str) else "0x" + bytes.hex(value)
+
+
+def _int(value: Union[str, int]) -> int:
+    return value if isinstance(value, int) else int(value, 16)
+
+
+def decode_sync(log: dict) -> SyncLog:
+    """ The Sync event of an eth_getLogs result: the two words of its data, without going through its ABI """
+    data = _hex(log['data'])
+    if len(data) != TWO_WORDS_DATA_LENGTH or _hex(log['topics'][0]) != SYNC_EVENT_TOPIC:
+        raise ValueError(f"Not a Sync log: {log}")
+
+    return SyncLog(
+        log['address'], _int(log['blockNumber']), _hex(log['transactionHash']), _int(log['logIndex']),
+        int(data[2:66], 16), int(data[66:], 16)
+    )
+
+
+def decode_pair_created(log: dict) -> PairCreatedLog:
+    """ The PairCreated event of an eth_getLogs result: tokens from its topics, pair and index from its data """
+    topics = log['topics']
+    data = _hex(log['data'])
+    if len(topics) != 3 or len(data) != TWO_WORDS_DATA_LENGTH or _hex(topics[0]) != PAIR_CREATED_EVENT_TOPIC:
+        raise ValueError(f"Not a PairCreated log: {log}")
+
+    # Addresses are the last 20 bytes of their words. Checksumming is slow, but pairs are created a few per block.
+    return PairCreatedLog(
+        log['address'], _int(log['blockNumber']), _hex(log['transactionHash']), _int(log['logIndex']),
+        Web3.toChecksumAddress("0x" + _hex(topics[1])[-40:]), Web3.toChecksumAddress("0x" + _hex(topics[2])[-40:]),
+        Web3.toChecksumAddress("0x" + data[26:66]), int(data[66:], 16)
+    )
@@ -1,3 +1,5 @@
+import argparse
+import asyncio
 import itertools
 import logging
 import os
@@ -5,24 +7,91 @@ import sys
 import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
 
 from web3.contract import Contract
 
-from data_models import DecentralizedExchange, DecentralizedExchangeType, DexTradePair
+from async_gatherer import AsyncWindowImporter
+from async_rpc import AsyncRpcClient, MAX_IN_FLIGHT_PER_PROVIDER
+from block_timestamps import BlockTimestampService
+from bloom_index import BloomIndex, BLOOM_INDEX_PATH
+from block_window import AdaptiveBlockWindow, fetch_splitting_range
+from chain_tail import ChainTail, TAIL_CONFIRMATIONS, TAIL_POLL_SECONDS, WEB3_WS_URLS
+from data_models import DecentralizedExchange, DecentralizedExchangeType, DexTradePair, DexTradeSync, ImportCheckpoint
 from ddbb_manager import DDBBManager
 from entity_factory import EntityFactory
-from web3_utils import get_w3, get_contract, WEB3_PROVIDERS
+from http_pool import connection_setups
+from log_decoder import PairCreatedLog, SyncLog, decode_pair_created, decode_sync
+from metrics import BLOCKS_IMPORTED, LAST_IMPORTED_BLOCK, METRICS_JSON_PATH, METRICS_PORT, REGISTRY, REORGS, \
+    TAIL_WINDOWS
+from pair_activity import PairActivityScheduler, PAIR_COLD_AFTER_BLOCKS
+from pair_registry import PairRecord, PairRegistry
+from parquet_sink import ParquetSink
+from pipeline import Pipeline
+from provider_scheduler import is_throttle_error
+from reorgs import ReorgDetector, REORG_CHECK_BLOCKS
+from rpc_batch import JsonRpcBatcher
+from web3_utils import get_w3, get_contract, get_nowbnb_token, get_raw_logs, get_provider_scheduler, get_rpc_cache, \
+    IPC_PATH, PANCAKE_SWAP_FACTORY_ABI, PAIR_CREATED_EVENT_TOPIC, WEB3_PROVIDERS, SYNC_EVENT_TOPIC, WBNB_ADDRESS
 
 BLOCK_FOR_THE_FIRST_LP = 6810423
-BLOCK_LENGTH = 5000
+BLOCK_LENGTH = int(os.getenv("BLOCK_LENGTH", 5000))
+MIN_BLOCK_LENGTH = int(os.getenv("MIN_BLOCK_LENGTH", 50))
+MAX_BLOCK_LENGTH = int(os.getenv("MAX_BLOCK_LENGTH", 50000))
+# Logs a window should bring at most, the window controller sizes windows from the recent logs per block density
+TARGET_LOGS_PER_WINDOW = int(os.getenv("TARGET_LOGS_PER_WINDOW", 20000))
 MAX_THREADS = int(os.getenv("THREADS", len(WEB3_PROVIDERS)))
+# Retries of errors other than throttles wait 1, 2, 4... seconds, up to this
+MAX_RETRY_WAIT_SECONDS = 30
+
+# "threads" parallelises RPCs with a pool of MAX_THREADS threads, "asyncio" issues them concurrently from one thread
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+
+# "batched" pulls every Sync log of a window with a few eth_getLogs calls (filtered by topic and, optionally, by chunks
+# of pair addresses) and dispatches them to the pairs in memory. "per_pair" issues one eth_getLogs per known pair.
+SYNC_FETCH_MODE = os.getenv("SYNC_FETCH_MODE", "batched")
+# Pair addresses per eth_getLogs call in batched mode. 0 means filtering only by topic, which returns the Sync logs of
+# every UniswapV2-like pair on the chain, so it only pays off when most of those pairs are already known.
+SYNC_ADDRESSES_PER_REQUEST = int(os.getenv("SYNC_ADDRESSES_PER_REQUEST", 1000))
+# Calls per JSON-RPC batch when resolving the txs and blocks of a window, 0 resolves them one request at a time
+RPC_BATCH_SIZE = int(os.getenv("RPC_BATCH_SIZE", 100))
+# Block timestamps of each window are loaded fetching one header every BLOCK_TIMESTAMPS_SAMPLE_EVERY blocks (and
+# interpolating the rest when it is exact), 0 fetches each block when it is first needed instead
+BLOCK_TIMESTAMPS_SAMPLE_EVERY = int(os.getenv("BLOCK_TIMESTAMPS_SAMPLE_EVERY", 100))
+# Windows waiting between pipeline stages (fetch -> decode -> persist). 0 runs each window through all of them before
+# starting the next one.
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 1))
+# Where the syncs of each window (and their txs and blocks) are written, comma separated: "ddbb" and/or "parquet".
+# Pairs, tokens and checkpoints always go to the DDBB.
+SINK_DDBB = "ddbb"
+SINK_PARQUET = "parquet"
+SINKS = set(os.getenv("SINKS", SINK_DDBB).split(","))
+PARQUET_PATH = os.getenv("PARQUET_PATH", "parquet")
 
 LOG_FORMAT_STR = '%(asctime)s - %(levelname)s - %(message)s'
 LOG_FORMAT = logging.Formatter(LOG_FORMAT_STR)
 LOGGERS_CONF = {
     "ddbb_manager": logging.DEBUG,
     "web3_utils": logging.DEBUG,
+    "async_rpc": logging.DEBUG,
+    "async_gatherer": logging.DEBUG,
+    "block_window": logging.DEBUG,
+    "block_timestamps": logging.DEBUG,
+    "bloom_index": logging.DEBUG,
+    "rpc_batch": logging.DEBUG,
+    "pipeline": logging.DEBUG,
+    "provider_scheduler": logging.DEBUG,
+    "rpc_cache": logging.DEBUG,
+    "reorgs": logging.DEBUG,
+    "backfill": logging.DEBUG,
+    "chain_tail": logging.DEBUG,
+    "pair_activity": logging.DEBUG,
+    "entity_factory": logging.DEBUG,
+    "metrics": logging.DEBUG,
     "main": logging.DEBUG
 }
 
@@ -37,14 +106,9 @@ FILTER_NOT_FOUND_ERR_MSG = '{\'code\': -32000, \'message\': \'filter not found\'
 MAX_FNF_RETRIES_FOR_WARNING = 50
 FNF_ERROR_WAIT_SECONDS = 10
 
-FORBIDEN_ERROR_MSG = "403 Client Error: Forbidden for url"
-FORBIDDEN_ERROR_WAIT_SECONDS = 5 * 60
 
-# The rate limit of BSC endpoint on Testnet and Mainnet is 10K/5min (https://docs.binance.org/smart-chain/developer/rpc.html#rate-limit)
-RATE_LIMIT_WAIT_TIME = 10 / (10000 / (5*60))
-
-def setup_loggers():
-    file_handler = logging.FileHandler('main.log', mode='w', encoding='utf-16')
+def setup_loggers(log_file: str = 'main.log'):
+    file_handler = logging.FileHandler(log_file, mode='w', encoding='utf-16')
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(LOG_FORMAT)
 
@@ -66,42 +130,93 @@ def setup_loggers():
     for logger_name, log_level in LOGGERS_CONF.items():
         this_logger = logging.getLogger(logger_name)
 
+        # Backfill worker processes set their loggers up again for each shard they run
+        this_logger.handlers.clear()
         this_logger.addHandler(file_handler)
         this_logger.addHandler(stdout_handler)
         this_logger.setLevel(log_level)
 
+@lru_cache(maxsize=None)
+def get_worker_pool(stage: str) -> ThreadPoolExecutor:
+    """ Threads of a pipeline stage, kept for the whole run instead of being created again for every window """
+    return ThreadPoolExecutor(max_workers=MAX_THREADS, thread_name_prefix=f"{stage.capitalize()}Worker")
+
+
 def __handle_exception_from_w3_provider(retry: int, e: Exception):
-    error_text = str(e)
-    if FORBIDEN_ERROR_MSG in error_text or 'too many' in error_text:
-        logger.warning("Got forbidden, 403, waiting...")
-        time.sleep(FORBIDDEN_ERROR_WAIT_SECONDS)
     if retry > 2:
         logger.exception(f"ERROR (retry #{retry})")
+    # Throttled providers are cooled down and requests rerouted by the ProviderScheduler, anything else (connection
+    # errors, "filter not found"...) backs off here so that retries do not spin
+    if not is_throttle_error(e):
+        time.sleep(min(2 ** retry, MAX_RETRY_WAIT_SECONDS))
+
+
+def fetch_logs_pruned(
+        fetch: Callable[[int, int], list],
+        from_block: int,
+        to_block: int,
+        window: AdaptiveBlockWindow,
+        bloom_index: Optional[BloomIndex],
+        addresses: Optional[List[str]],
+        topic: str
+) -> list:
+    """ fetch_splitting_range over the part of the range where the bloom index may have logs of addresses with topic """
+    block_span = bloom_index.span(from_block, to_block, addresses, topic) if bloom_index else (from_block, to_block)
+    if block_span is None:
+        return []
+    return fetch_splitting_range(fetch, *block_span, window, __handle_exception_from_w3_provider)
+
 
 def get_new_pairs(
         dex_factories: Dict[DecentralizedExchangeType, Contract],
-        start_block: int,
-        e_factory: EntityFactory
+        from_block: int,
+        to_block: int,
+        e_factory: EntityFactory,
+        window: AdaptiveBlockWindow,
+        bloom_index: BloomIndex = None
 ) -> List[DexTradePair]:
     new_pairs = []
     for dex, factory_contract in dex_factories.items():
         for retry in itertools.count():
             try:
                 logger.info(f"\tGetting pairs for {dex.dex_name}...")
-                pair_logs = factory_contract.events.PairCreated.getLogs(
-                    fromBlock=start_block - 1,
-                    toBlock=start_block + BLOCK_LENGTH - 1
+                pair_logs = fetch_logs_pruned(
+                    lambda range_start, range_end: get_raw_logs(get_w3(), {
+                        'fromBlock': range_start,
+                        'toBlock': range_end,
+                        'address': factory_contract.address,
+                        'topics': [PAIR_CREATED_EVENT_TOPIC]
+                    }),
+                    from_block, to_block, window, bloom_index, [factory_contract.address], PAIR_CREATED_EVENT_TOPIC
                 )
 
-                with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-                    def __process_pair(pair_for_worker):
-                        pair = e_factory.get_DexTradePair(dex, pair_for_worker)
-                        if pair:
-                            logger.debug(f"{threading.current_thread().name} got {pair}")
+                new_pairs.extend(process_pair_created_events(
+                    dex, [decode_pair_created(pair_log) for pair_log in pair_logs], e_factory
+                ))
+                break
+            except (Exception,) as e:
+                __handle_exception_from_w3_provider(retry, e)
 
-                        return pair
+    return list(filter(None, new_pairs))
 
-                    new_pairs.extend(executor.map(__process_pair, pair_logs))
+
+def get_tail_pairs(
+        dex_factories: Dict[DecentralizedExchangeType, Contract],
+        pair_logs: list,
+        e_factory: EntityFactory
+) -> List[DexTradePair]:
+    """ get_new_pairs for the PairCreated logs a ChainTail got through its subscription """
+    new_pairs = []
+    for dex, factory_contract in dex_factories.items():
+        factory_addr = factory_contract.address.lower()
+        pair_created_events = [
+            decode_pair_created(pair_log) for pair_log in pair_logs if pair_log['address'].lower() == factory_addr
+        ]
+        if not pair_created_events:
+            continue
+        for retry in itertools.count():
+            try:
+                new_pairs.extend(process_pair_created_events(dex, pair_created_events, e_factory))
                 break
             except (Exception,) as e:
                 __handle_exception_from_w3_provider(retry, e)
@@ -109,98 +224,552 @@ def get_new_pairs(
     return list(filter(None, new_pairs))
 
 
-def find_and_persist_trades(
-        indexed_pair: Tuple[int, DexTradePair],
+def process_pair_created_events(
+        dex: DecentralizedExchangeType,
+        pair_created_events: List[PairCreatedLog],
+        e_factory: EntityFactory
+) -> List[Optional[DexTradePair]]:
+    e_factory.prefetch_txs(
+        pair_created.tx_hash for pair_created in pair_created_events
+        if WBNB_ADDRESS in (pair_created.token0, pair_created.token1)
+    )
+    e_factory.prefetch_tokens(filter(None, (
+        get_nowbnb_token(pair_created.token0, pair_created.token1) for pair_created in pair_created_events
+    )))
+    def __process_pair(pair_for_worker):
+        pair = e_factory.get_DexTradePair(dex, pair_for_worker)
+        if pair:
+            logger.debug(f"{threading.current_thread().name} got {pair}")
+
+        return pair
+
+    return list(get_worker_pool("fetch").map(__process_pair, pair_created_events))
+
+
+def find_trades(
+        indexed_pair: Tuple[int, PairRecord],
         total_pairs: int,
-        start_block: int,
+        pairs: PairRegistry,
+        from_block: int,
+        to_block: int,
         e_factory: EntityFactory,
-        ddbb_manager: DDBBManager
-) -> int:
+        window: AdaptiveBlockWindow,
+        bloom_index: BloomIndex = None
+) -> List[DexTradeSync]:
     index, pair = indexed_pair
     for retry in itertools.count():
         try:
-            sync_logs = pair.pair_contract().events.Sync.getLogs(
-                fromBlock=start_block - 1,
-                toBlock=start_block + BLOCK_LENGTH - 1
+            sync_logs = fetch_logs_pruned(
+                lambda range_start, range_end: get_raw_logs(get_w3(), {
+                    'fromBlock': range_start,
+                    'toBlock': range_end,
+                    'address': pair.hex_address,
+                    'topics': [SYNC_EVENT_TOPIC]
+                }),
+                from_block, to_block, window, bloom_index, [pair.hex_address], SYNC_EVENT_TOPIC
             )
+            if not sync_logs:
+                return []
 
-            for sync in sync_logs:
-                ddbb_manager.persist(e_factory.get_DexTradeSync(sync, pair))
+            sync_events = [decode_sync(sync_log) for sync_log in sync_logs]
+            txs = e_factory.prefetch_txs(sync.tx_hash for sync in sync_events)
+            dex_pair = pairs.pair(pair.hex_address)
+            syncs = [e_factory.get_DexTradeSync(sync, dex_pair, tx=txs.get(sync.tx_hash)) for sync in sync_events]
 
-            logger.debug(f"{threading.current_thread().name} ({index}/{total_pairs}) got {len(sync_logs)} swaps for {pair}")
-            return len(sync_logs)
+            logger.debug(f"{threading.current_thread().name} ({index}/{total_pairs}) got {len(sync_logs)} swaps for "
+                         f"{dex_pair.pair_addr}")
+            return syncs
         except (Exception,) as e:
             __handle_exception_from_w3_provider(retry, e)
 
 
-def main():
+def get_window_sync_logs(
+        poll_pairs: List[PairRecord],
+        pairs: PairRegistry,
+        from_block: int,
+        to_block: int,
+        window: AdaptiveBlockWindow,
+        bloom_index: BloomIndex = None
+) -> list:
+    addresses = [pair.hex_address for pair in poll_pairs]
+    if SYNC_ADDRESSES_PER_REQUEST > 0:
+        address_chunks = [
+            addresses[i:i + SYNC_ADDRESSES_PER_REQUEST] for i in range(0, len(addresses), SYNC_ADDRESSES_PER_REQUEST)
+        ]
+    else:
+        address_chunks = [None]
+
+    def __fetch_sync_logs(address_chunk):
+        def __get_logs(range_start, range_end):
+            log_filter = {
+                'fromBlock': range_start,
+                'toBlock': range_end,
+                'topics': [SYNC_EVENT_TOPIC]
+            }
+            if address_chunk:
+                log_filter['address'] = address_chunk
+
+            # Topic-only requests bring logs from pairs we do not track, drop them here
+            return [log for log in get_raw_logs(get_w3(), log_filter) if log['address'] in pairs]
+
+        return fetch_logs_pruned(__get_logs, from_block, to_block, window, bloom_index, address_chunk, SYNC_EVENT_TOPIC)
+
+    sync_logs = list(itertools.chain.from_iterable(get_worker_pool("fetch").map(__fetch_sync_logs, address_chunks)))
+
+    logger.debug(f"\tGot {len(sync_logs)} sync logs with {len(address_chunks)} requests")
+    return sync_logs
+
+
+def get_window_syncs(
+        sync_logs: list,
+        pairs: PairRegistry,
+        e_factory: EntityFactory
+) -> List[DexTradeSync]:
+    sync_events = [decode_sync(sync_log) for sync_log in sync_logs]
+    txs = e_factory.prefetch_txs(sync.tx_hash for sync in sync_events)
+    pairs_by_addr = {pair_addr: pairs.pair(pair_addr) for pair_addr in {sync.address for sync in sync_events}}
+
+    def __process_sync(sync: SyncLog):
+        for retry in itertools.count():
+            try:
+                return e_factory.get_DexTradeSync(sync, pairs_by_addr[sync.address], tx=txs.get(sync.tx_hash))
+            except (Exception,) as e:
+                __handle_exception_from_w3_provider(retry, e)
+
+    syncs = list(get_worker_pool("decode").map(__process_sync, sync_events))
+
+    logger.debug(f"\t{len(pairs_by_addr)}/{len(pairs)} pairs traded")
+    return syncs
+
+
+@dataclass
+class WindowImport:
+    """ A window of blocks going through the import pipeline """
+    block: int
+    length: int
+    new_pairs: List[DexTradePair] = field(default_factory=list)
+    sync_logs: list = field(default_factory=list)
+    syncs: List[DexTradeSync] = field(default_factory=list)
+    started_at: datetime = None
+    fetched_at: datetime = None
+    decoded_at: datetime = None
+    # Imported before TAIL_CONFIRMATIONS deep, rolled back if reorged until then
+    provisional: bool = False
+
+    @property
+    def from_block(self) -> int:
+        return self.block - 1
+
+    @property
+    def to_block(self) -> int:
+        return self.block + self.length - 1
+
+    def checkpoint(self) -> ImportCheckpoint:
+        return ImportCheckpoint(
+            first_block=self.block, last_block=self.block + self.length - 1,
+            new_pairs=len(self.new_pairs), syncs=len(self.syncs),
+            fetched_at=self.fetched_at, decoded_at=self.decoded_at, persisted_at=datetime.now(),
+            provisional=self.provisional or None
+        )
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Imports DEX pairs and their trades from BSC into the DDBB")
+    parser.add_argument(
+        "--engine", choices=(ENGINE_THREADS, ENGINE_ASYNCIO), default=os.getenv("ENGINE", ENGINE_THREADS),
+        help="How RPCs are parallelised (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--max-in-flight", type=int, default=int(os.getenv("MAX_IN_FLIGHT", MAX_IN_FLIGHT_PER_PROVIDER)),
+        help="Concurrent requests per provider with the asyncio engine (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--backfill-workers", type=int, default=int(os.getenv("BACKFILL_WORKERS", 0)),
+        help="Processes that backfill the history up to the current head in shards before following the chain "
+             "(default: %(default)s, no sharded backfill)"
+    )
+    parser.add_argument(
+        "--shard-size", type=int, default=int(os.getenv("BACKFILL_SHARD_SIZE", 500000)),
+        help="Blocks per backfill shard (default: %(default)s)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(args: argparse.Namespace):
     import faulthandler
 
     faulthandler.enable()
 
+    if args.backfill_workers > 0:
+        from backfill import run_backfill
+        run_backfill(args)
+
+    if METRICS_PORT:
+        REGISTRY.start_http_server(METRICS_PORT)
+
     db_manager = DDBBManager(os.getenv("DDBB_STRING"))
-    e_factory = EntityFactory(db_manager)
+    logger.info("Reading last checkpoint...")
+    start_block = db_manager.get_first_unimported_block()
+    if start_block is None:
+        # DDBBs imported before checkpoints existed can only resume from their highest block
+        last_block = db_manager.get_last_block()
+        start_block = last_block.number if last_block else BLOCK_FOR_THE_FIRST_LP - 10
+
+    import_blocks(args, db_manager, start_block)
+
+
+def import_blocks(
+        args: argparse.Namespace,
+        db_manager: DDBBManager,
+        start_block: int,
+        end_block: int = None,
+        discover_pairs: bool = True,
+        gather_syncs: bool = True
+) -> None:
+    """
+    Imports windows of blocks from start_block up to end_block, or following the chain forever if it is None.
+
+    Windows are checkpointed only when their syncs are gathered: a checkpoint means that both the pairs and the syncs
+    of the window are in the DDBB, so gathering syncs without discovering pairs is only right once the pairs of every
+    block up to end_block were discovered (see backfill.py).
+
+    Following the chain, blocks are polled with eth_getLogs once TAIL_CONFIRMATIONS deep. Once the import catches up
+    with them, logs come from a ChainTail subscribed to the head if WEB3_WS_URLS is set: the blocks it covers are
+    imported as soon as the next header comes, in provisional windows that become final once TAIL_CONFIRMATIONS deep.
+    If the tail sees a provisional block reorged, everything from there on is rolled back and imported again, and so
+    are the provisional windows of a previous run. The blocks the tail missed (before it subscribed or while it
+    reconnects) are polled as the rest, once final. After each window that close to the head, the hashes of the last
+    REORG_CHECK_BLOCKS blocks are checked too, for reorgs below the confirmation depth.
+    """
+    batcher = JsonRpcBatcher(batch_size=RPC_BATCH_SIZE, cache=get_rpc_cache()) \
+        if RPC_BATCH_SIZE > 0 and not IPC_PATH else None
+    timestamps = BlockTimestampService(batcher, sample_every=BLOCK_TIMESTAMPS_SAMPLE_EVERY) \
+        if batcher and BLOCK_TIMESTAMPS_SAMPLE_EVERY > 0 else None
+    e_factory = EntityFactory(db_manager, batcher=batcher, timestamps=timestamps)
+    bloom_index = BloomIndex(BLOOM_INDEX_PATH, batcher) if BLOOM_INDEX_PATH and batcher else None
+    parquet_sink = ParquetSink(PARQUET_PATH) if SINK_PARQUET in SINKS and gather_syncs else None
     w3 = get_w3()
 
-    logger.info("Reading last block...")
-    last_block = db_manager.get_last_block()
-    start_block = last_block.number if last_block else BLOCK_FOR_THE_FIRST_LP - 10
+    if end_block is None:
+        # Those blocks may have been reorged while no tail was watching them
+        provisional_block = db_manager.get_first_provisional_block()
+        if provisional_block is not None:
+            logger.info(f"Importing again the provisional blocks from {provisional_block} on")
+            db_manager.roll_back_blocks(provisional_block)
+            if parquet_sink:
+                parquet_sink.roll_back(provisional_block)
+            if bloom_index:
+                bloom_index.roll_back(provisional_block)
+            start_block = min(start_block, provisional_block)
+
     dex_factories = {
-        dex.value: get_contract(w3, dex.value.factory_addr) for dex in DecentralizedExchange
+        # Every DEX factory is a UniswapV2 one, their ABI is not fetched from BscScan
+        dex.value: get_contract(w3, dex.value.factory_addr, abi=PANCAKE_SWAP_FACTORY_ABI)
+        for dex in DecentralizedExchange
     }
     logger.info("Reading pairs...")
-    pairs = db_manager.get_all_pairs()
+    pairs = PairRegistry.load(db_manager) if gather_syncs else PairRegistry()
     logger.info("Done!")
 
+    # Skipping idle pairs takes the headers of the window to check them against, and only saves requests that are
+    # filtered by address
+    per_pair = SYNC_FETCH_MODE == "per_pair" and args.engine == ENGINE_THREADS
+    activity = PairActivityScheduler(db_manager, batcher, bloom_index) \
+        if gather_syncs and batcher and PAIR_COLD_AFTER_BLOCKS > 0 and (per_pair or SYNC_ADDRESSES_PER_REQUEST > 0) \
+        else None
+    if activity:
+        logger.info(f"Scheduling polls with {activity}")
+
+    window = AdaptiveBlockWindow(
+        BLOCK_LENGTH, min_size=MIN_BLOCK_LENGTH, max_size=MAX_BLOCK_LENGTH, target_logs=TARGET_LOGS_PER_WINDOW
+    )
+
+    async_loop, async_importer = None, None
+    if args.engine == ENGINE_ASYNCIO:
+        # The loop runs in its own thread so that every pipeline stage can hand coroutines to it
+        async_loop = asyncio.new_event_loop()
+        threading.Thread(target=async_loop.run_forever, name="AsyncRpcLoop", daemon=True).start()
+        async_client = AsyncRpcClient(max_in_flight_per_provider=args.max_in_flight, cache=get_rpc_cache())
+        asyncio.run_coroutine_threadsafe(async_client.open(), async_loop).result()
+        async_importer = AsyncWindowImporter(
+            async_client, dex_factories, e_factory, window, SYNC_ADDRESSES_PER_REQUEST, bloom_index=bloom_index
+        )
+        logger.info(f"Using {async_client}")
+
+    def __run_async(coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, async_loop).result()
+
     start_time = time.time()
     logger.info(f"Starting in block {start_block}, {len(pairs)} pairs so far.")
 
-    block = start_block
-    while True:
-        logger.info(f"Importing blocks {block}-{block + BLOCK_LENGTH}...")
-
-        new_pairs = get_new_pairs(dex_factories, block, e_factory)
-        if len(new_pairs) > 0:
-            logger.info(f"\tGot {len(new_pairs)} new pairs")
-            pairs.extend(new_pairs)
-            for pair in new_pairs:
-                db_manager.persist(pair)
-
-        logger.info("\tLooking for trades...")
-        with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            trades_found = sum(
-                executor.map(
-                    lambda pair_for_worker: find_and_persist_trades(pair_for_worker, len(pairs), block, e_factory, db_manager),
-                    enumerate(pairs)
+    def __load_timestamps(work: WindowImport):
+        if timestamps:
+            try:
+                timestamps.load_window(work.from_block, work.to_block)
+            except (Exception,):
+                # Blocks will be fetched one by one
+                logger.exception("Could not load block timestamps")
+
+    next_block = start_block
+    # Addresses of the new pairs of the windows that are not committed yet, by first block of the window
+    uncommitted_pairs: Dict[int, List[str]] = {}
+    reorgs = ReorgDetector(db_manager, batcher) if end_block is None and REORG_CHECK_BLOCKS > 0 else None
+    # Following the chain: last block known to be TAIL_CONFIRMATIONS deep, and the subscription once caught up
+    final_block: Optional[int] = None
+    tail: Optional[ChainTail] = None
+    # Last block of the provisional windows that are not final yet, by their first block
+    provisional_windows: Dict[int, int] = {}
+
+    def __wait_for(block: int, depth: int) -> int:
+        """ Head - depth, once block is depth blocks deep. Without a subscription the head is polled. """
+        nonlocal final_block
+        while True:
+            if tail and tail.head is not None:
+                head = tail.wait_for_head(block + depth, TAIL_POLL_SECONDS)
+            else:
+                head = get_w3().eth.get_block_number()
+                if head - depth < block:
+                    time.sleep(TAIL_POLL_SECONDS)
+            if head is not None:
+                final_block = head - TAIL_CONFIRMATIONS
+                if head - depth >= block:
+                    return head - depth
+
+    def __fetch(_) -> Optional[WindowImport]:
+        # Windows are sized here, in order, so that each one gets the feedback of the previous fetches
+        nonlocal next_block, tail
+        if end_block is not None and next_block > end_block:
+            return None
+        if end_block is not None:
+            last_block = end_block
+        elif tail and tail.covers(next_block):
+            # The logs of a block may come after its header, but not after the next one
+            last_block = __wait_for(next_block, 1)
+        else:
+            last_block = __wait_for(next_block, TAIL_CONFIRMATIONS)
+        if end_block is None and tail is None and WEB3_WS_URLS and last_block - next_block < window.size:
+            tail = ChainTail(WEB3_WS_URLS, [factory_contract.address for factory_contract in dex_factories.values()])
+            tail.start()
+            logger.info(f"Caught up with block {last_block}, following the head with {tail}")
+        work = WindowImport(block=next_block, length=min(window.size, last_block - next_block + 1))
+        next_block += work.length
+        work.started_at = datetime.now()
+        logger.info(f"Importing blocks {work.block}-{work.block + work.length}...")
+        fetch_start_time = time.time()
+
+        # None unless the subscription got every block of the window
+        tail_logs = tail.take_logs(work.block, work.to_block) if tail and tail.covers(work.block) else None
+        if tail:
+            TAIL_WINDOWS.inc(source="polling" if tail_logs is None else "subscription")
+        if end_block is None and tail_logs is None and work.to_block > final_block:
+            # Missed by the subscription, nodes may not have all of those blocks yet
+            __wait_for(work.to_block, TAIL_CONFIRMATIONS)
+        if end_block is None and work.to_block > final_block:
+            work.provisional = True
+            provisional_windows[work.block] = work.to_block
+        if bloom_index and tail_logs is None:
+            bloom_index.prepare(work.from_block, work.to_block)
+
+        if discover_pairs:
+            if tail_logs is not None:
+                work.new_pairs = get_tail_pairs(dex_factories, tail_logs[0], e_factory)
+            elif async_importer:
+                work.new_pairs = __run_async(async_importer.get_new_pairs(work.from_block, work.to_block))
+            else:
+                work.new_pairs = get_new_pairs(
+                    dex_factories, work.from_block, work.to_block, e_factory, window, bloom_index
+                )
+        if len(work.new_pairs) > 0:
+            logger.info(f"\tGot {len(work.new_pairs)} new pairs")
+            # Later windows must look for the trades of these pairs, even if this one is not persisted yet
+            for pair in work.new_pairs:
+                pairs.add(pair)
+            uncommitted_pairs[work.block] = [pair.get_pair_addr() for pair in work.new_pairs]
+
+        if gather_syncs:
+            logger.info("\tLooking for trades...")
+            poll_pairs = activity.pairs_to_poll(
+                pairs, work.from_block, work.to_block, 1 if per_pair else SYNC_ADDRESSES_PER_REQUEST
+            ) if activity and tail_logs is None else list(pairs)
+            if tail_logs is not None:
+                # The subscription brings the Sync logs of every pair
+                work.sync_logs = [sync_log for sync_log in tail_logs[1] if sync_log['address'] in pairs]
+            elif async_importer:
+                work.sync_logs = __run_async(
+                    async_importer.get_sync_logs(poll_pairs, pairs, work.from_block, work.to_block)
+                )
+            elif per_pair:
+                # Fetching and decoding are a single step in this mode
+                __load_timestamps(work)
+                work.syncs = list(itertools.chain.from_iterable(
+                    get_worker_pool("fetch").map(
+                        lambda pair_for_worker: find_trades(
+                            pair_for_worker, len(poll_pairs), pairs, work.from_block, work.to_block, e_factory,
+                            window, bloom_index
+                        ),
+                        enumerate(poll_pairs)
+                    )
+                ))
+            else:
+                work.sync_logs = get_window_sync_logs(
+                    poll_pairs, pairs, work.from_block, work.to_block, window, bloom_index
                 )
-            )
-        logger.info(f"\tGot {trades_found} new trades")
-
-        first_block = BLOCK_FOR_THE_FIRST_LP
-        last_block = get_w3().eth.get_block_number()
-        seconds_so_far = time.time() - start_time
-        blocks_processed = block + BLOCK_LENGTH - start_block
-        blocks_per_second = blocks_processed / seconds_so_far
-        remaining_blocks = last_block - block + BLOCK_LENGTH
-        remaining_seconds = remaining_blocks / blocks_per_second
-        progress_percent = 100 * (block - first_block) / (last_block - first_block)
 
+        if tail_logs is None:
+            # Windows of the subscription say nothing about how long eth_getLogs takes
+            n_logs = len(work.new_pairs) + max(len(work.sync_logs), len(work.syncs))
+            window.record(work.length, n_logs, time.time() - fetch_start_time)
+        work.fetched_at = datetime.now()
+        return work
+
+    def __decode(work: Optional[WindowImport]) -> Optional[WindowImport]:
+        if work is None:
+            return None
+        if work.sync_logs:
+            __load_timestamps(work)
+            if async_importer:
+                work.syncs = __run_async(async_importer.get_syncs(work.sync_logs, pairs))
+            else:
+                work.syncs = get_window_syncs(work.sync_logs, pairs, e_factory)
+            work.sync_logs = []
+        if activity:
+            activity.record_syncs(work.block, work.syncs)
+        work.decoded_at = datetime.now()
+        return work
+
+    def __persist(work: Optional[WindowImport]) -> Optional[WindowImport]:
+        if work is None:
+            return None
+        start_persist_time = time.time()
+        for pair in work.new_pairs:
+            db_manager.persist(pair)
+        if SINK_DDBB in SINKS:
+            db_manager.persist_many(work.syncs)
+        if parquet_sink:
+            # Before the checkpoint is commited, a window whose files are not complete is imported again
+            parquet_sink.write_window(work.block, work.to_block, work.syncs)
+        if activity:
+            db_manager.persist_pair_activity(activity.take_changes(work.block))
+        if gather_syncs:
+            # Same transaction as the data, so a window is either checkpointed and complete or not there at all
+            work.provisional = work.provisional and work.to_block > final_block
+            db_manager.persist(work.checkpoint())
+            finalized = [
+                first_block for first_block, last_block in list(provisional_windows.items())
+                if first_block <= work.block and last_block <= final_block
+            ]
+            if finalized:
+                db_manager.finalize_checkpoints(final_block)
+                for first_block in finalized:
+                    provisional_windows.pop(first_block, None)
         try:
-            start_persist_time = time.time()
-            db_manager.commit_changes()
-            logger.info(f"\tNew entities commited in {time.time() - start_persist_time:.2f} seconds!")
+            db_manager.commit_changes(sync=True)
         except (Exception,):
-            logger.exception(f"Error committing")
+            logger.exception(f"Error committing blocks {work.block}-{work.block + work.length}")
+            raise
+        logger.info(f"\tBlocks {work.block}-{work.block + work.length}: {len(work.syncs)} new trades commited in "
+                    f"{time.time() - start_persist_time:.2f} seconds!")
+        return work
+
+    def __roll_back(fork_block: int) -> None:
+        nonlocal next_block
+        orphan_pairs = set(db_manager.roll_back_blocks(fork_block))
+        if parquet_sink:
+            parquet_sink.roll_back(fork_block)
+        if bloom_index:
+            bloom_index.roll_back(fork_block)
+        # Pairs of windows that did not get to commit are found again if they are still in the chain
+        orphan_pairs.update(itertools.chain.from_iterable(uncommitted_pairs.values()))
+        uncommitted_pairs.clear()
+        pairs.remove(orphan_pairs)
+        for first_block in [first_block for first_block in provisional_windows if first_block >= fork_block]:
+            del provisional_windows[first_block]
+        if activity:
+            activity.roll_back(fork_block, orphan_pairs)
+        e_factory.clear_caches()
+        REORGS.inc()
+        next_block = fork_block
+        logger.warning(f"Chain reorganised, importing again from block {fork_block} "
+                       f"({len(orphan_pairs)} pairs dropped)")
+
+    window_connection_setups = connection_setups()
+    import_pipeline = Pipeline(
+        [("fetch", __fetch), ("decode", __decode), ("persist", __persist)],
+        max_queued=PIPELINE_QUEUE_SIZE, threaded=PIPELINE_QUEUE_SIZE > 0
+    )
+    while True:
+        fork_block = None
+        windows = import_pipeline.run(itertools.count())
+        for work in windows:
+            if work is None:
+                # Past end_block
+                break
 
-        logger.info(
-            f"Progress update: {progress_percent:.2f}% "
-            f"({blocks_per_second:.2f} block/second, {remaining_seconds / 3600:.2f} hours remaining)"
-            "\n\n"
-        )
+            # Only windows whose commit succeeded get here, in order
+            BLOCKS_IMPORTED.inc(work.to_block - work.block + 1)
+            LAST_IMPORTED_BLOCK.set(work.to_block)
+            if METRICS_JSON_PATH:
+                REGISTRY.dump_json(METRICS_JSON_PATH)
+            e_factory.clear_prefetched()
+            logger.info(f"\tEntities from {e_factory.cache_stats}")
+            e_factory.cache_stats.reset()
+            logger.info(f"\tWindow wall time {(datetime.now() - work.started_at).total_seconds():.2f}s, "
+                        f"{connection_setups() - window_connection_setups} new connections")
+            window_connection_setups = connection_setups()
+            if not IPC_PATH:
+                logger.debug(f"\tRPC latencies: {get_provider_scheduler().latency_report()}")
+            if get_rpc_cache():
+                logger.info(f"\t{get_rpc_cache()}")
+            if bloom_index:
+                logger.info(f"\t{bloom_index}")
+
+            uncommitted_pairs.pop(work.block, None)
+            tail_fork_block = tail.take_reorg() if tail else None
+            if tail_fork_block is not None and provisional_windows:
+                # Reorgs of final blocks, deeper than TAIL_CONFIRMATIONS, are left to the ReorgDetector
+                fork_block = max(tail_fork_block, min(list(provisional_windows)))
+                logger.warning(f"Block {tail_fork_block} was reorged (or the tail lost track of it)")
+                break
+            if reorgs and work.to_block >= final_block - reorgs.depth:
+                fork_block = reorgs.find_fork(work.to_block)
+                if fork_block is not None:
+                    break
+
+            if end_block is None and work.to_block >= final_block:
+                # There is no ETA to speak of at the head
+                logger.info(f"Following the head: blocks up to {work.to_block} imported, final up to {final_block}\n\n")
+                continue
+
+            first_block = BLOCK_FOR_THE_FIRST_LP if end_block is None else start_block
+            last_block = final_block if end_block is None else end_block
+            seconds_so_far = time.time() - start_time
+            blocks_processed = work.block + work.length - start_block
+            blocks_per_second = blocks_processed / seconds_so_far
+            remaining_blocks = last_block - work.to_block
+            remaining_seconds = remaining_blocks / blocks_per_second
+            progress_percent = 100 * (work.block - first_block) / (last_block - first_block)
+
+            logger.info(
+                f"Progress update: {progress_percent:.2f}% "
+                f"({blocks_per_second:.2f} block/second, {remaining_seconds / 3600:.2f} hours remaining, "
+                f"window of {window}, queued windows {import_pipeline.queue_depths()})"
+                "\n\n"
+            )
+
+        # Stops the stages, windows after the fork that were still in the pipeline are dropped (or rolled back below)
+        windows.close()
+        if fork_block is None:
+            break
+        __roll_back(fork_block)
 
-        block += BLOCK_LENGTH
+    if tail:
+        tail.stop()
+    if async_loop:
+        # Backfill shards import several ranges per process, each one with its own client and loop
+        __run_async(async_client.close())
+        async_loop.call_soon_threadsafe(async_loop.stop)
 
 
 if __name__ == '__main__':
     setup_loggers()
-    main()
+    main(parse_args())
@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+from urllib.parse import urlparse
+
+# Port of the Prometheus text endpoint (/metrics), 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# File rewritten with every metric as JSON after each imported window, empty disables it
+METRICS_JSON_PATH = os.getenv("METRICS_JSON_PATH", "")
+METRICS_PREFIX = "bsc_gatherer_"
+# Upper bounds of histogram buckets: 1ms, 2ms, 4ms... ~65s
+SECONDS_BUCKETS = tuple(0.001 * 2 ** i for i in range(17))
+
+
+@lru_cache(maxsize=None)
+def provider_label(endpoint_uri: str) -> str:
+    # Only the host: some endpoint paths hold API keys
+    return urlparse(endpoint_uri).netloc or endpoint_uri
+
+
+class Metric:
+    """ Values of a metric per combination of its labels, thread-safe """
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(label_name, "")) for label_name in self.label_names)
+
+    def _labels(self, key: Tuple[str, ...], **extra: str) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._labels(key)} {value}" for key, value in self._values.items()]
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{"labels": dict(zip(self.label_names, key)), "value": value} for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = SECONDS_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{self._labels(key, le=le)} {cumulative}")
+                lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+                lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{
+                "labels": dict(zip(self.label_names, key)), "count": sum(counts), "sum": total,
+                "buckets": dict(zip([f"{bound:g}" for bound in self.buckets] + ["+Inf"], counts)),
+            } for key, (counts, total) in self._values.items()]
+
+
+class MetricsRegistry:
+    """ Metrics of the process, rendered in the Prometheus text format or as JSON """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self.__metrics: Dict[str, Metric] = {}
+        self.__lock = threading.Lock()
+
+    def __register(self, cls, name: str, *args, **kwargs) -> Any:
+        name = self.prefix + name
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = cls(name, *args, **kwargs)
+            return self.__metrics[name]
+
+    def counter(self, name: str, description: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.__register(Counter, name, description, label_names)
+
+    def gauge(self, name: str, description: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.__register(Gauge, name, description, label_names)
+
+    def histogram(self, name: str, description: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = SECONDS_BUCKETS) -> Histogram:
+        return self.__register(Histogram, name, description, label_names, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return {"timestamp": time.time(), "metrics": {metric.name: metric.snapshot() for metric in metrics}}
+
+    def dump_json(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_http_server(self, port: int) -> ThreadingHTTPServer:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+        self.logger.info(f"Serving metrics on :{port}/metrics")
+        return server
+
+
+REGISTRY = MetricsRegistry()
+
+RPC_CALLS = REGISTRY.counter("rpc_calls_total", "JSON-RPC calls sent, each call of a batch counted",
+                             ("provider", "method"))
+RPC_SECONDS = REGISTRY.histogram("rpc_seconds", "Latency of JSON-RPC requests (whole batches)", ("provider", "method"))
+RPC_ERRORS = REGISTRY.counter("rpc_errors_total", "Failed JSON-RPC requests", ("provider", "kind"))
+RPC_RETRIES = REGISTRY.counter("rpc_retries_total", "JSON-RPC calls sent again after a failure", ("method",))
+RPC_HEDGES = REGISTRY.counter("rpc_hedges_total", "Hedged reads sent, and won by the hedge", ("result",))
+CACHE_LOOKUPS = REGISTRY.counter("cache_lookups_total", "Lookups per cache and where they were answered from",
+                                 ("cache", "result"))
+DDBB_SECONDS = REGISTRY.histogram("ddbb_seconds", "Time of DDBBManager operations on the DB worker thread",
+                                  ("operation",))
+DDBB_WAIT_SECONDS = REGISTRY.histogram("ddbb_wait_seconds", "Time DDBBManager operations waited for the DB worker",
+                                       ("operation",))
+DDBB_ROWS = REGISTRY.counter("ddbb_rows_total", "Rows written (or merged) per table", ("table",))
+STAGE_SECONDS = REGISTRY.histogram("pipeline_stage_seconds", "Time each pipeline stage took per item", ("stage",))
+QUEUE_DEPTH = REGISTRY.gauge("pipeline_queue_depth", "Items waiting for each pipeline stage", ("stage",))
+BLOCKS_IMPORTED = REGISTRY.counter("blocks_imported_total", "Blocks of committed windows")
+LAST_IMPORTED_BLOCK = REGISTRY.gauge("last_imported_block", "Last block of the last committed window")
+TAIL_RECONNECTS = REGISTRY.counter("tail_reconnects_total", "Times the chain tail lost its WebSocket subscriptions")
+TAIL_WINDOWS = REGISTRY.counter("tail_windows_total", "Windows at the head by where their logs came from",
+                                ("source",))
+REORGS = REGISTRY.counter("reorgs_total", "Reorganisations found among the imported blocks and rolled back")
+PAIRS_POLLED = REGISTRY.counter("pairs_polled_total", "Pairs whose Sync logs were polled in a window, by why they were",
+                                ("reason",))
+PAIRS_SKIPPED = REGISTRY.counter("pairs_skipped_total", "Cold pairs not polled because the window bloom rules them out")
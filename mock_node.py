@@ -0,0 +1,525 @@
+"""
+Local stand-in for a BSC JSON-RPC node serving a synthetic chain, for benchmarks that must not hit public nodes:
+
+    python mock_node.py [--port 8645] [--providers 4] [--latency 0.02] [--error-rate 0.01] ...
+
+Every block is derived from its number (and the seed): PairCreated logs of the DEX factories for WBNB pairs, Sync logs
+of the most recently created pairs, one tx per log, and the headers and txs of those. Each provider listens on its own
+port (port, port + 1, ...) with its own rate limit, and can answer with latency, "filter not found" errors and 403s.
+
+With a block time, the head moves and the next port serves eth_subscribe (newHeads and logs) over WebSocket, with
+reorgs of the blocks below the head and dropped connections at the configured rates.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+import websockets
+from eth_hash.auto import keccak
+
+# Same as web3_utils and data_models, which this module does not import to start quickly in its own process
+WBNB_ADDRESS = "0xbb4cdb9cbd36b01bd1cbaebf2de08d9173bc095c"
+FACTORY_ADDRESSES = ("0xca143ce32fe78f1f7019d7d551a6402fc5350c73", "0x0841bd0b734e4f5853f0dd8d7ea041c241fb0da6")
+SYNC_EVENT_TOPIC = "0x1c411e9a96e071241c2f21f7726b17ae89e3cab4c78be50e062b03a9fffbbad1"
+PAIR_CREATED_EVENT_TOPIC = "0x0d3648bd0f6ba80134a33ba9275ac585d9d315f0ad8355cddefde31afa28d0e9"
+BSC_CHAIN_ID = 56
+BLOCK_SECONDS = 3
+GENESIS_TIMESTAMP = 1598671449
+ZERO_ADDRESS = "0x" + "00" * 20
+
+NAME_SELECTOR = "0x06fdde03"
+SYMBOL_SELECTOR = "0x95d89b41"
+DECIMALS_SELECTOR = "0x313ce567"
+# tryAggregate(bool requireSuccess, (address target, bytes callData)[] calls) of Multicall3, at its usual address
+TRY_AGGREGATE_SELECTOR = "0xbce38bd7"
+MULTICALL_ADDRESS = "0xca11bde05977b3631167028862be2a173976ca11"
+
+BLOCK_LOGS_CACHE_SIZE = 50000
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MockNodeConfig:
+    port: int = int(os.getenv("MOCK_NODE_PORT", 8645))
+    providers: int = int(os.getenv("MOCK_NODE_PROVIDERS", 4))
+    head: int = int(os.getenv("MOCK_NODE_HEAD", 10000000))
+    # WBNB pairs created per block, and Sync logs per block spread over the active_pairs most recent pairs
+    pairs_per_block: float = float(os.getenv("MOCK_NODE_PAIRS_PER_BLOCK", 0.2))
+    syncs_per_block: float = float(os.getenv("MOCK_NODE_SYNCS_PER_BLOCK", 10))
+    active_pairs: int = int(os.getenv("MOCK_NODE_ACTIVE_PAIRS", 1000))
+    # Mean seconds added to each HTTP request (exponentially distributed)
+    latency: float = float(os.getenv("MOCK_NODE_LATENCY", 0))
+    # Ratio of calls answered with a "filter not found" error, and of HTTP requests answered with a 403
+    error_rate: float = float(os.getenv("MOCK_NODE_ERROR_RATE", 0))
+    forbidden_rate: float = float(os.getenv("MOCK_NODE_FORBIDDEN_RATE", 0))
+    # HTTP requests per second each provider takes before answering 429s, 0 for no limit
+    rate_limit: float = float(os.getenv("MOCK_NODE_RATE_LIMIT", 0))
+    max_block_range: int = int(os.getenv("MOCK_NODE_MAX_BLOCK_RANGE", 5000))
+    seed: int = int(os.getenv("MOCK_NODE_SEED", 0))
+    # Seconds per block after the head, 0 keeps the head where it is (and serves no WebSocket)
+    block_time: float = float(os.getenv("MOCK_NODE_BLOCK_TIME", 0))
+    # Ratio of new heads that replace the reorg_depth blocks below them, and that close every WebSocket connection
+    reorg_rate: float = float(os.getenv("MOCK_NODE_REORG_RATE", 0))
+    reorg_depth: int = int(os.getenv("MOCK_NODE_REORG_DEPTH", 1))
+    ws_drop_rate: float = float(os.getenv("MOCK_NODE_WS_DROP_RATE", 0))
+
+    def endpoint_uris(self, host: str = "127.0.0.1") -> List[str]:
+        return [f"http://{host}:{self.port + i}" for i in range(self.providers)]
+
+    def ws_uri(self, host: str = "127.0.0.1") -> str:
+        return f"ws://{host}:{self.port + self.providers}"
+
+
+class RpcCallError(Exception):
+    def __init__(self, message: str, code: int = -32000):
+        super().__init__(message)
+        self.code = code
+
+
+def _word(value: int) -> str:
+    return f"{value:064x}"
+
+
+def _address(kind: str, n: int) -> str:
+    return "0x" + hashlib.sha256(f"{kind}{n}".encode()).hexdigest()[:40]
+
+
+def _block_hash(number: int, fork: int = 0) -> str:
+    # Blocks replaced by reorgs get another hash for each fork
+    return "0x" + hashlib.sha256((f"block{number}:{fork}" if fork else f"block{number}").encode()).hexdigest()
+
+
+def _tx_hash(block: int, index: int, fork: int = 0) -> str:
+    # The block and index are in the hash itself, so txs are found without an index
+    seed = f"tx{block}:{index}:{fork}" if fork else f"tx{block}:{index}"
+    return f"0x{block:016x}{index:08x}" + hashlib.sha256(seed.encode()).hexdigest()[:40]
+
+
+def _to_block_number(block: Any, head: int) -> int:
+    if block in (None, "latest", "pending", "safe", "finalized"):
+        return head
+    if block == "earliest":
+        return 0
+    return int(block, 16) if isinstance(block, str) else int(block)
+
+
+def _abi_string(text: str) -> str:
+    data = text.encode()
+    return "0x" + _word(32) + _word(len(data)) + data.hex().ljust(64 * -(-len(data) // 32), "0")
+
+
+def _abi_bytes32(text: str) -> str:
+    # What some early tokens return from name() and symbol()
+    return "0x" + text.encode()[:32].hex().ljust(64, "0")
+
+
+def _decode_try_aggregate(data: bytes) -> Tuple[bool, List[Tuple[str, str]]]:
+    """ requireSuccess and the (target, calldata) calls of a tryAggregate, without its selector """
+    def word(offset: int) -> int:
+        return int.from_bytes(data[offset:offset + 32], "big")
+
+    calls_start = word(32) + 32
+    calls = []
+    for i in range(word(calls_start - 32)):
+        call_start = calls_start + word(calls_start + 32 * i)
+        calldata_start = call_start + word(call_start + 32) + 32
+        calldata = data[calldata_start:calldata_start + word(calldata_start - 32)]
+        calls.append(("0x" + data[call_start + 12:call_start + 32].hex(), "0x" + calldata.hex()))
+    return word(0) != 0, calls
+
+
+def _encode_try_aggregate_result(results: List[Tuple[bool, str]]) -> str:
+    """ The (bool success, bytes returnData)[] of a tryAggregate """
+    offsets, tuples = [], []
+    offset = 32 * len(results)
+    for success, return_data in results:
+        return_data = return_data[2:]
+        encoded = _word(int(success)) + _word(64) + _word(len(return_data) // 2) + \
+            return_data.ljust(64 * -(-len(return_data) // 64), "0")
+        offsets.append(_word(offset))
+        tuples.append(encoded)
+        offset += len(encoded) // 2
+    return "0x" + _word(32) + _word(len(results)) + "".join(offsets) + "".join(tuples)
+
+
+def _logs_bloom(logs: Tuple[dict, ...]) -> str:
+    """ logsBloom of a block: 3 bits out of 2048 set by the address and by each topic of every log """
+    bloom = 0
+    for log in logs:
+        for item in (log["address"], *log["topics"]):
+            item_hash = keccak(bytes.fromhex(item[2:]))
+            for i in (0, 2, 4):
+                bloom |= 1 << (((item_hash[i] << 8) | item_hash[i + 1]) & 2047)
+    return "0x" + format(bloom, "0512x")
+
+
+def _log_matcher(log_filter: dict):
+    """ Whether a log passes the address and first topic of an eth_getLogs (or eth_subscribe) filter """
+    addresses = log_filter.get("address")
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    addresses = {address.lower() for address in addresses} if addresses else None
+    topics = (log_filter.get("topics") or [None])[0]
+    if isinstance(topics, str):
+        topics = [topics]
+    topics = {topic.lower() for topic in topics} if topics else None
+
+    return lambda log: (addresses is None or log["address"] in addresses) and \
+        (topics is None or log["topics"][0] in topics)
+
+
+class MockChain:
+    """ Synthetic chain, every block derived from its number so that any range can be served in any order """
+
+    def __init__(self, config: MockNodeConfig):
+        self.config = config
+        self.started_at = time.monotonic()
+        # Times each block was replaced by a reorg
+        self.forks: Dict[int, int] = {}
+
+    @property
+    def head(self) -> int:
+        if self.config.block_time <= 0:
+            return self.config.head
+        return self.config.head + int((time.monotonic() - self.started_at) / self.config.block_time)
+
+    def block_hash(self, number: int) -> str:
+        return _block_hash(number, self.forks.get(number, 0))
+
+    def pairs_until(self, block: int) -> int:
+        """ Pairs created in blocks up to block """
+        return int((block + 1) * self.config.pairs_per_block) if block >= 0 else 0
+
+    @lru_cache(maxsize=BLOCK_LOGS_CACHE_SIZE)
+    def block_logs(self, block: int, fork: int = 0) -> Tuple[dict, ...]:
+        """ Logs of block in the given branch: each fork has the same pairs created but other syncs and txs """
+        rng = random.Random(f"{self.config.seed}:{block}:{fork}" if fork else self.config.seed * 1000003 + block)
+        entries = []
+        previous_pairs = self.pairs_until(block - 1)
+        for pair in range(previous_pairs, self.pairs_until(block)):
+            token0, token1 = sorted((WBNB_ADDRESS, _address("token", pair)))
+            entries.append((FACTORY_ADDRESSES[pair % len(FACTORY_ADDRESSES)], [
+                PAIR_CREATED_EVENT_TOPIC, "0x" + _word(int(token0, 16)), "0x" + _word(int(token1, 16))
+            ], "0x" + _word(int(_address("pair", pair), 16)) + _word(pair + 1)))
+
+        if previous_pairs:
+            n_syncs = int(self.config.syncs_per_block)
+            n_syncs += rng.random() < self.config.syncs_per_block - n_syncs
+            first_active = max(0, previous_pairs - self.config.active_pairs)
+            for _ in range(n_syncs):
+                pair = rng.randrange(first_active, previous_pairs)
+                entries.append((_address("pair", pair), [SYNC_EVENT_TOPIC],
+                                "0x" + _word(rng.randrange(1, 2 ** 112)) + _word(rng.randrange(1, 2 ** 112))))
+
+        return tuple({
+            "address": address, "topics": topics, "data": data, "blockNumber": hex(block),
+            "blockHash": _block_hash(block, fork), "transactionHash": _tx_hash(block, index, fork),
+            "transactionIndex": hex(index), "logIndex": hex(index), "removed": False,
+        } for index, (address, topics, data) in enumerate(entries))
+
+    def logs_of(self, block: int) -> Tuple[dict, ...]:
+        """ block_logs of the current branch """
+        return self.block_logs(block, self.forks.get(block, 0))
+
+    def get_block(self, number: int, full_transactions: bool = False) -> Optional[dict]:
+        if number < 0 or number > self.head:
+            return None
+        tx_hashes = [log["transactionHash"] for log in self.logs_of(number)]
+        return {
+            "number": hex(number), "hash": self.block_hash(number), "parentHash": self.block_hash(number - 1),
+            "timestamp": hex(GENESIS_TIMESTAMP + BLOCK_SECONDS * number), "miner": ZERO_ADDRESS, "extraData": "0x",
+            "difficulty": "0x2", "gasLimit": hex(30000000), "gasUsed": hex(21000 * len(tx_hashes)),
+            "logsBloom": _logs_bloom(self.logs_of(number)),
+            "transactions": [self.get_tx(tx_hash) for tx_hash in tx_hashes] if full_transactions else tx_hashes,
+        }
+
+    def get_tx(self, tx_hash: str) -> Optional[dict]:
+        try:
+            block, index = int(tx_hash[2:18], 16), int(tx_hash[18:26], 16)
+        except ValueError:
+            return None
+        # Txs of blocks replaced by a reorg are not found anymore
+        if block > self.head or index >= len(self.logs_of(block)) \
+                or tx_hash != _tx_hash(block, index, self.forks.get(block, 0)):
+            return None
+        return {
+            "hash": tx_hash, "blockNumber": hex(block), "blockHash": self.block_hash(block),
+            "transactionIndex": hex(index),
+            "from": _address("sender", block * 1000 + index), "to": self.logs_of(block)[index]["address"],
+            "gas": hex(200000), "gasPrice": hex(5 * 10 ** 9), "nonce": "0x0", "value": "0x0", "input": "0x",
+        }
+
+    def get_logs(self, log_filter: dict) -> List[dict]:
+        if "blockHash" in log_filter:
+            raise RpcCallError("blockHash filters are not supported by the mock node")
+        from_block = _to_block_number(log_filter.get("fromBlock"), self.head)
+        to_block = min(_to_block_number(log_filter.get("toBlock"), self.head), self.head)
+        if to_block - from_block + 1 > self.config.max_block_range:
+            raise RpcCallError(f"exceed maximum block range: {self.config.max_block_range}")
+
+        matches = _log_matcher(log_filter)
+        return [log for block in range(from_block, to_block + 1) for log in self.logs_of(block) if matches(log)]
+
+    def call(self, transaction: dict) -> str:
+        data = transaction.get("data", transaction.get("input", ""))
+        selector = data[:10]
+        token = transaction.get("to", "").lower()
+        if token == MULTICALL_ADDRESS and selector == TRY_AGGREGATE_SELECTOR:
+            return self.__try_aggregate(bytes.fromhex(data[10:]))
+        # 1 token in 16 has the bytes32 name and symbol of the early ERC20s
+        abi_text = _abi_bytes32 if token[2] == "0" else _abi_string
+        if selector == NAME_SELECTOR:
+            return abi_text(f"Mock Token {token[2:8]}")
+        if selector == SYMBOL_SELECTOR:
+            return abi_text(token[2:6].upper())
+        if selector == DECIMALS_SELECTOR:
+            return "0x" + _word(18)
+        raise RpcCallError("execution reverted")
+
+    def __try_aggregate(self, data: bytes) -> str:
+        require_success, calls = _decode_try_aggregate(data)
+        results = []
+        for target, calldata in calls:
+            try:
+                results.append((True, self.call({"to": target, "data": calldata})))
+            except RpcCallError:
+                if require_success:
+                    raise RpcCallError("execution reverted: Multicall3: call failed")
+                results.append((False, "0x"))
+        return _encode_try_aggregate_result(results)
+
+
+class MockNode:
+    """ Serves a MockChain on config.providers ports, injecting the configured faults """
+
+    def __init__(self, config: MockNodeConfig):
+        self.config = config
+        self.chain = MockChain(config)
+        self.rng = random.Random(config.seed)
+        self.stats = Counter()
+        self.__lock = threading.Lock()
+        self.__buckets: Dict[int, Tuple[float, float]] = {}
+        self.__servers: List[ThreadingHTTPServer] = []
+        # Subscriptions of each WebSocket connection: None for newHeads, a log matcher for logs
+        self.__ws_clients: Dict[Any, Dict[str, Any]] = {}
+        self.__subscription_ids = itertools.count(1)
+
+    def __str__(self):
+        return f"MockNode<{', '.join(self.config.endpoint_uris())}>"
+
+    def dispatch(self, method: str, params: list) -> Any:
+        if method == "eth_blockNumber":
+            return hex(self.chain.head)
+        if method == "eth_chainId":
+            return hex(BSC_CHAIN_ID)
+        if method == "net_version":
+            return str(BSC_CHAIN_ID)
+        if method in ("eth_getBlockByNumber", "eth_getHeaderByNumber"):
+            full_transactions = method == "eth_getBlockByNumber" and len(params) > 1 and params[1]
+            return self.chain.get_block(_to_block_number(params[0], self.chain.head), full_transactions)
+        if method == "eth_getTransactionByHash":
+            return self.chain.get_tx(params[0])
+        if method == "eth_getLogs":
+            return self.chain.get_logs(params[0])
+        if method == "eth_call":
+            return self.chain.call(params[0])
+        if method == "mock_stats":
+            with self.__lock:
+                return dict(self.stats)
+        raise RpcCallError(f"the method {method} does not exist/is not available", code=-32601)
+
+    def handle_call(self, call: dict) -> dict:
+        response = {"jsonrpc": "2.0", "id": call.get("id")}
+        method = call.get("method")
+        with self.__lock:
+            if method != "mock_stats":
+                self.stats[f"calls.{method}"] += 1
+            fail = method != "mock_stats" and self.rng.random() < self.config.error_rate
+            if fail:
+                self.stats["errors.filter_not_found"] += 1
+        try:
+            if fail:
+                raise RpcCallError("filter not found")
+            response["result"] = self.dispatch(method, call.get("params") or [])
+        except RpcCallError as e:
+            response["error"] = {"code": e.code, "message": str(e)}
+        return response
+
+    def handle_http(self, port: int, body: bytes) -> Tuple[int, bytes]:
+        """ Returns the HTTP status and body answering a JSON-RPC call or batch received on port """
+        if self.config.latency > 0:
+            time.sleep(self.rng.expovariate(1 / self.config.latency))
+
+        with self.__lock:
+            self.stats["http_requests"] += 1
+            if not self.__take_token(port):
+                self.stats["errors.rate_limited"] += 1
+                return 429, b"Too Many Requests"
+            if self.rng.random() < self.config.forbidden_rate:
+                self.stats["errors.forbidden"] += 1
+                return 403, b"Forbidden"
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, b"Invalid JSON"
+        if isinstance(payload, list):
+            with self.__lock:
+                self.stats["batches"] += 1
+            response = [self.handle_call(call) for call in payload]
+        else:
+            response = self.handle_call(payload)
+        return 200, json.dumps(response).encode()
+
+    def __take_token(self, port: int) -> bool:
+        if self.config.rate_limit <= 0:
+            return True
+        now = time.monotonic()
+        tokens, updated = self.__buckets.get(port, (self.config.rate_limit, now))
+        tokens = min(self.config.rate_limit, tokens + (now - updated) * self.config.rate_limit)
+        allowed = tokens >= 1
+        self.__buckets[port] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def start(self) -> None:
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so that connection pooling shows up in benchmarks as it does against real nodes
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                status, response_body = node.handle_http(
+                    self.server.server_address[1], self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                )
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json" if status == 200 else "text/plain")
+                self.send_header("Content-Length", str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            def log_message(self, format, *args):
+                pass
+
+        for i in range(self.config.providers):
+            server = ThreadingHTTPServer(("127.0.0.1", self.config.port + i), Handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name=f"MockNode{i}", daemon=True).start()
+            self.__servers.append(server)
+        if self.config.block_time > 0:
+            threading.Thread(target=self.__serve_ws, name="MockNodeWs", daemon=True).start()
+            logger.info(f"{self} following the head from {self.chain.head} on {self.config.ws_uri()}")
+        else:
+            logger.info(f"{self} serving blocks up to {self.chain.head}")
+
+    def __serve_ws(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(websockets.serve(
+            self.__handle_ws, "127.0.0.1", self.config.port + self.config.providers, max_size=None
+        ))
+        loop.run_until_complete(self.__produce_heads())
+
+    async def __handle_ws(self, websocket, path: str = None) -> None:
+        subscriptions = self.__ws_clients.setdefault(websocket, {})
+        try:
+            async for message in websocket:
+                call = json.loads(message)
+                if call.get("method") == "eth_subscribe":
+                    subscription_id = hex(next(self.__subscription_ids))
+                    kind, *log_filter = call.get("params") or [None]
+                    subscriptions[subscription_id] = None if kind == "newHeads" else _log_matcher(
+                        log_filter[0] if log_filter else {}
+                    )
+                    response = {"jsonrpc": "2.0", "id": call.get("id"), "result": subscription_id}
+                else:
+                    response = self.handle_call(call)
+                await websocket.send(json.dumps(response))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            del self.__ws_clients[websocket]
+
+    async def __produce_heads(self) -> None:
+        notified = self.chain.head
+        while True:
+            await asyncio.sleep(self.config.block_time / 4)
+            while notified < self.chain.head:
+                notified += 1
+                with self.__lock:
+                    reorg = self.rng.random() < self.config.reorg_rate
+                    drop = self.rng.random() < self.config.ws_drop_rate
+                if reorg:
+                    # The blocks below the head are replaced by others with other hashes, syncs and txs
+                    for block in range(notified - self.config.reorg_depth, notified):
+                        removed = [dict(log, removed=True) for log in self.chain.logs_of(block)]
+                        self.chain.forks[block] = self.chain.forks.get(block, 0) + 1
+                        await self.__notify(block, removed)
+                    self.__count("ws.reorgs")
+                await self.__notify(notified)
+                if drop:
+                    for websocket in list(self.__ws_clients):
+                        await websocket.close()
+                    self.__count("ws.drops")
+
+    async def __notify(self, block: int, removed_logs: List[dict] = ()) -> None:
+        """ Header and then logs of block to every subscription, after the logs it removes from the old branch """
+        header = self.chain.get_block(block)
+        del header["transactions"]
+        for websocket, subscriptions in list(self.__ws_clients.items()):
+            for subscription_id, matches in list(subscriptions.items()):
+                results = [header] if matches is None else [
+                    log for log in list(removed_logs) + list(self.chain.logs_of(block)) if matches(log)
+                ]
+                for result in results:
+                    try:
+                        await websocket.send(json.dumps({"jsonrpc": "2.0", "method": "eth_subscription", "params": {
+                            "subscription": subscription_id, "result": result
+                        }}))
+                    except websockets.ConnectionClosed:
+                        break
+                self.__count("ws.notifications", len(results))
+
+    def __count(self, stat: str, amount: int = 1) -> None:
+        with self.__lock:
+            self.stats[stat] += amount
+
+    def stop(self) -> None:
+        for server in self.__servers:
+            server.shutdown()
+            server.server_close()
+        self.__servers.clear()
+
+
+def serve(config: MockNodeConfig) -> None:
+    """ Serves until the process is killed """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    node = MockNode(config)
+    node.start()
+    threading.Event().wait()
+
+
+def parse_args() -> MockNodeConfig:
+    defaults = MockNodeConfig()
+    parser = argparse.ArgumentParser(description="Serves a synthetic BSC chain over JSON-RPC")
+    for name, value in vars(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value,
+                            help="(default: %(default)s)")
+    return MockNodeConfig(**vars(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    serve(parse_args())
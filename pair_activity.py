@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from bloom_index import BloomIndex, bloom_key, bloom_may_contain, BLOOM_BITS
+from data_models import DexTradeSync
+from ddbb_manager import DDBBManager
+from metrics import PAIRS_POLLED, PAIRS_SKIPPED
+from pair_registry import PairRecord, address_bytes
+from rpc_batch import JsonRpcBatcher
+
+# A pair is cold once it has not synced for this many blocks (about a day), or for PAIR_COLD_AFTER_GAPS times the mean
+# gap between its syncs if that is longer. 0 polls every pair in every window.
+PAIR_COLD_AFTER_BLOCKS = int(os.getenv("PAIR_COLD_AFTER_BLOCKS", 28800))
+PAIR_COLD_AFTER_GAPS = float(os.getenv("PAIR_COLD_AFTER_GAPS", 20))
+# Cold pairs are still polled directly every so many blocks, an interval that doubles after each poll up to the max
+PAIR_COLD_MIN_INTERVAL = int(os.getenv("PAIR_COLD_MIN_INTERVAL", 28800))
+PAIR_COLD_MAX_INTERVAL = int(os.getenv("PAIR_COLD_MAX_INTERVAL", 28800 * 64))
+# Headers worth fetching to save one eth_getLogs call. Windows with fewer cold pairs than that just poll them all.
+PAIR_BLOOM_HEADERS_PER_CALL = int(os.getenv("PAIR_BLOOM_HEADERS_PER_CALL", 100))
+
+NO_BLOOM_KEY = -1
+
+
+class PairStats(NamedTuple):
+    first_block: int
+    last_sync_block: Optional[int]
+    syncs: int
+    # Blocks between direct polls while cold (0 while hot), and the last block of the window due for the next one
+    check_interval: int = 0
+    next_check_block: int = 0
+    bloom_key: int = NO_BLOOM_KEY
+
+    def is_hot(self, block: int, cold_after_blocks: int) -> bool:
+        last_active = self.first_block if self.last_sync_block is None else self.last_sync_block
+        cold_after = cold_after_blocks
+        if self.syncs > 1:
+            cold_after = max(cold_after, PAIR_COLD_AFTER_GAPS * (last_active - self.first_block) / self.syncs)
+        return block - last_active <= cold_after
+
+
+class PairActivityScheduler:
+    """
+    Picks which pairs have their Sync logs polled in each window, from the syncs seen of each one.
+
+    Hot pairs (recent syncs) are polled every window. Cold ones are polled directly at exponentially decreasing
+    frequency, and in the windows in between only if the window may have logs of theirs: the logsBloom of every
+    header of the window are OR-ed together, and a pair whose address is not in that bloom emitted nothing in the
+    window. Blooms have false positives but no false negatives, so no sync is ever missed. With a BloomIndex the
+    window bloom comes from it, otherwise headers are fetched for it. When the bloom cannot be had, or the window has
+    too few cold pairs for its headers to pay off, cold pairs are polled as well.
+
+    Syncs seen are kept in the pair_activity table, committed with the window they come from.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, db_manager: DDBBManager, batcher: JsonRpcBatcher, bloom_index: BloomIndex = None,
+                 cold_after_blocks: int = PAIR_COLD_AFTER_BLOCKS):
+        self.db_manager = db_manager
+        self.batcher = batcher
+        self.bloom_index = bloom_index
+        self.cold_after_blocks = cold_after_blocks
+        self.__lock = threading.Lock()
+        # By the 20 bytes of the address of each pair, like PairRegistry
+        self.__stats: Dict[bytes, PairStats] = {
+            address_bytes(pair_addr): PairStats(*activity)
+            for pair_addr, activity in db_manager.get_pair_activity().items()
+        }
+        # Syncs recorded and not persisted yet, by first block of their window: [first block, last sync block, syncs]
+        # by pair
+        self.__changes: Dict[int, Dict[str, List[int]]] = {}
+
+    def __str__(self):
+        with self.__lock:
+            cold_pairs = sum(1 for stats in self.__stats.values() if stats.check_interval)
+        return f"PairActivityScheduler<{len(self.__stats)} pairs, {cold_pairs} cold>"
+
+    def pairs_to_poll(
+            self, pairs: Iterable[PairRecord], from_block: int, to_block: int, addresses_per_call: int
+    ) -> List[PairRecord]:
+        """ The pairs that may have syncs between from_block and to_block """
+        if self.cold_after_blocks <= 0:
+            return list(pairs)
+
+        to_poll: List[PairRecord] = []
+        unchecked: List[PairRecord] = []
+        cold_due = 0
+        with self.__lock:
+            for pair in pairs:
+                stats = self.__stats.get(pair.address)
+                if stats is None:
+                    # New pairs count from the window they were found in
+                    stats = self.__stats[pair.address] = PairStats(
+                        first_block=from_block, last_sync_block=None, syncs=0
+                    )
+                if not stats.check_interval:
+                    if stats.is_hot(to_block, self.cold_after_blocks):
+                        to_poll.append(pair)
+                        continue
+                    stats = self.__stats[pair.address] = stats._replace(
+                        check_interval=PAIR_COLD_MIN_INTERVAL, next_check_block=to_block + PAIR_COLD_MIN_INTERVAL
+                    )
+                if stats.next_check_block <= to_block:
+                    interval = min(2 * stats.check_interval, PAIR_COLD_MAX_INTERVAL)
+                    self.__stats[pair.address] = stats._replace(
+                        check_interval=interval, next_check_block=to_block + interval
+                    )
+                    to_poll.append(pair)
+                    cold_due += 1
+                else:
+                    unchecked.append(pair)
+
+        hot = len(to_poll) - cold_due
+        bloom = None
+        saved_calls = -(-len(unchecked) // max(1, addresses_per_call))
+        if unchecked and (self.bloom_index or saved_calls * PAIR_BLOOM_HEADERS_PER_CALL >= to_block - from_block + 1):
+            bloom = self.__window_bloom(from_block, to_block)
+        if bloom is None:
+            to_poll.extend(unchecked)
+            PAIRS_POLLED.inc(len(unchecked), reason="cold_unchecked")
+        else:
+            in_bloom = [pair for pair in unchecked if bloom_may_contain(bloom, self.__bloom_key(pair))]
+            to_poll.extend(in_bloom)
+            PAIRS_POLLED.inc(len(in_bloom), reason="cold_in_bloom")
+            PAIRS_SKIPPED.inc(len(unchecked) - len(in_bloom))
+            self.logger.debug(f"\t{len(in_bloom)}/{len(unchecked)} cold pairs may be in the bloom of the window "
+                              f"({100 * bin(bloom).count('1') / BLOOM_BITS:.0f}% of its bits set)")
+        PAIRS_POLLED.inc(hot, reason="hot")
+        PAIRS_POLLED.inc(cold_due, reason="cold_due")
+
+        self.logger.debug(f"\tPolling {len(to_poll)}/{len(self.__stats)} pairs: {hot} hot, {cold_due} cold due, "
+                          f"{len(to_poll) - hot - cold_due} cold left after the bloom")
+        return to_poll
+
+    def record_syncs(self, window_block: int, syncs: Iterable[DexTradeSync]) -> None:
+        """
+        Syncs found in the window starting at window_block, which make their pairs hot. Windows fetch the block before
+        them too, whose syncs the previous window counted already.
+        """
+        with self.__lock:
+            changes = self.__changes.setdefault(window_block, {})
+            for sync in syncs:
+                block = sync.tx.block.number
+                if block < window_block:
+                    continue
+                pair_addr = sync.dex_pair.pair_addr
+                address = address_bytes(pair_addr)
+                stats = self.__stats.get(address) or PairStats(first_block=block, last_sync_block=None, syncs=0)
+                last_sync_block = block if stats.last_sync_block is None else max(block, stats.last_sync_block)
+                self.__stats[address] = stats._replace(
+                    last_sync_block=last_sync_block, syncs=stats.syncs + 1, check_interval=0, next_check_block=0
+                )
+                change = changes.setdefault(pair_addr, [stats.first_block, block, 0])
+                change[1] = max(change[1], block)
+                change[2] += 1
+
+    def take_changes(self, window_block: int) -> List[Tuple[str, int, int, int]]:
+        """ (pair_addr, first_block, last_sync_block, syncs) rows of the syncs recorded for the window """
+        with self.__lock:
+            changes = self.__changes.pop(window_block, {})
+        return [(pair_addr, *change) for pair_addr, change in changes.items()]
+
+    def roll_back(self, first_block: int, orphan_pairs: Iterable[str]) -> None:
+        """
+        After DDBBManager.roll_back_blocks(first_block): drops pairs that are not in the chain anymore and the syncs of
+        windows that did not commit, and reads the activity of the pairs that synced from first_block on again
+        """
+        activity = self.db_manager.get_pair_activity()
+        with self.__lock:
+            for pair_addr in orphan_pairs:
+                self.__stats.pop(address_bytes(pair_addr), None)
+            self.__changes.clear()
+            stale = {
+                address for address, stats in self.__stats.items()
+                if stats.first_block >= first_block or (stats.last_sync_block or -1) >= first_block
+            }
+            for pair_addr, pair_activity in activity.items():
+                address = address_bytes(pair_addr)
+                if address in stale:
+                    self.__stats[address] = PairStats(*pair_activity)
+                    stale.discard(address)
+            for address in stale:
+                del self.__stats[address]
+
+    def __bloom_key(self, pair: PairRecord) -> int:
+        stats = self.__stats[pair.address]
+        if stats.bloom_key == NO_BLOOM_KEY:
+            # Worth keeping: the hash is the expensive part, and cold pairs are checked window after window
+            with self.__lock:
+                stats = self.__stats[pair.address] = self.__stats[pair.address]._replace(
+                    bloom_key=bloom_key(pair.hex_address)
+                )
+        return stats.bloom_key
+
+    def __window_bloom(self, from_block: int, to_block: int) -> Optional[int]:
+        if self.bloom_index:
+            # Its headers are fetched anyway, to prune the eth_getLogs calls of the window
+            self.bloom_index.prepare(from_block, to_block)
+            return self.bloom_index.bloom(from_block, to_block) or None
+        try:
+            headers = self.batcher.get_headers(range(from_block, to_block + 1))
+        except (Exception,):
+            self.logger.exception(f"Could not fetch the headers of blocks {from_block}-{to_block}, polling cold pairs")
+            return None
+
+        bloom = 0
+        for header in headers.values():
+            if not header.get('logsBloom'):
+                return None
+            bloom |= int(header['logsBloom'], 16)
+        # Nodes that do not fill in blooms could not be told from a window without logs
+        return bloom or None
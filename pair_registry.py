@@ -0,0 +1,112 @@
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, Optional
+
+from eth_typing import ChecksumAddress
+from web3 import Web3
+
+from data_models import DecentralizedExchange, DecentralizedExchangeType, DexTradePair, Token
+from ddbb_manager import DDBBManager
+
+DEX_TYPES: Dict[str, DecentralizedExchangeType] = {dex.value.dex_name: dex.value for dex in DecentralizedExchange}
+
+
+def address_bytes(address: str) -> bytes:
+    """ The 20 bytes of a hex address, whatever its case """
+    return bytes.fromhex(address[2:])
+
+
+@lru_cache(maxsize=2 ** 16)
+def checksum_address(address: bytes) -> ChecksumAddress:
+    # Hashing takes longer than decoding a log, and the pairs that trade in a window tend to trade in the next ones
+    return Web3.toChecksumAddress("0x" + address.hex())
+
+
+class PairRecord:
+    """ What importing the syncs of a pair needs of its DexTradePair, in a small fraction of the memory """
+    __slots__ = ("address", "id", "dex", "token", "token_decimals", "is_token0_wbnb")
+
+    def __init__(self, address: bytes, id: Optional[int], dex: Optional[DecentralizedExchangeType],
+                 token: Optional[bytes], token_decimals: Optional[int], is_token0_wbnb: bool):
+        self.address = address
+        # None for pairs found in this run, the DDBB manager looks their id up by address when writing syncs
+        self.id = id
+        self.dex = dex
+        self.token = token
+        self.token_decimals = token_decimals
+        self.is_token0_wbnb = is_token0_wbnb
+
+    @property
+    def hex_address(self) -> str:
+        # Lowercase, which nodes take in log filters: checksumming hashes the address
+        return "0x" + self.address.hex()
+
+    def __repr__(self):
+        return f"PairRecord<{self.hex_address} #{self.id}>"
+
+
+class PairRegistry:
+    """
+    Every known pair as a PairRecord, by the 20 bytes of its address, instead of a resident DexTradePair with its
+    token, dex and creator tx. Pairs are read from the DDBB a batch of rows at a time, and syncs get a DexTradePair
+    (see pair()) only for the pairs that traded.
+    """
+
+    def __init__(self):
+        self.__records: Dict[bytes, PairRecord] = {}
+
+    @classmethod
+    def load(cls, db_manager: DDBBManager) -> "PairRegistry":
+        registry = cls()
+        db_manager.stream_pairs(registry.__add_row)
+        return registry
+
+    def __str__(self):
+        return f"PairRegistry<{len(self.__records)} pairs>"
+
+    def __len__(self):
+        return len(self.__records)
+
+    def __iter__(self) -> Iterator[PairRecord]:
+        return iter(self.__records.values())
+
+    def __contains__(self, pair_addr: str) -> bool:
+        return address_bytes(pair_addr) in self.__records
+
+    def get(self, pair_addr: str) -> Optional[PairRecord]:
+        return self.__records.get(address_bytes(pair_addr))
+
+    def add(self, pair: DexTradePair) -> None:
+        """ Adds a new pair """
+        self.__add_row((
+            pair.pair_addr, pair.id, pair.dex.dex_name if pair.dex else None,
+            pair.token.address if pair.token else None, pair.token.decimals if pair.token else None,
+            pair.is_token0_wbnb
+        ))
+
+    def remove(self, pair_addrs: Iterable[str]) -> None:
+        for pair_addr in pair_addrs:
+            self.__records.pop(address_bytes(pair_addr), None)
+
+    def pair(self, pair_addr: str) -> DexTradePair:
+        """
+        A DexTradePair for the syncs of a known pair, whose address may come in any case. It is in no session, and it
+        is not to be persisted: its token only has an address and decimals and it has no creator tx.
+        """
+        record = self.__records[address_bytes(pair_addr)]
+        token = Token(
+            address=checksum_address(record.token), name=None, symbol=None, decimals=record.token_decimals
+        ) if record.token else None
+        pair = DexTradePair(
+            pair_addr=checksum_address(record.address), dex=record.dex, token=token, creator_tx=None,
+            is_token0_wbnb=record.is_token0_wbnb
+        )
+        pair.id = record.id
+        return pair
+
+    def __add_row(self, row: tuple) -> None:
+        pair_addr, pair_id, dex_name, token_address, token_decimals, is_token0_wbnb = row
+        address = address_bytes(pair_addr)
+        self.__records[address] = PairRecord(
+            address, pair_id, DEX_TYPES.get(dex_name), address_bytes(token_address) if token_address else None,
+            token_decimals, is_token0_wbnb
+        )
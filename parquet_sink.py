@@ -0,0 +1,123 @@
+import glob
+import logging
+import os
+from typing import Dict, Iterable, List
+
+from data_models import Block, DexTradeSync, Tx
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pc, pq = None, None, None
+
+# Blocks per partition directory
+PARQUET_PARTITION_BLOCKS = int(os.getenv("PARQUET_PARTITION_BLOCKS", 1000000))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+
+
+class ParquetSink:
+    """
+    Writes the syncs of each window, and their txs and blocks, as Parquet files under root:
+
+        syncs/blocks=<first block of the partition>/dex=<dex name>/<first block>-<last block>.parquet
+        txs/blocks=<first block of the partition>/<first block>-<last block>.parquet
+        blocks/blocks=<first block of the partition>/<first block>-<last block>.parquet
+
+    Pair and token addresses are dictionary encoded, tx hashes are 32 bytes binaries and reserves (uint112) are exact
+    decimal128(38, 0). Only the rows of the blocks of the window are written, so windows never overlap.
+
+    Needs pyarrow, which is not required by the rest of the gatherer.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, root: str, partition_blocks: int = PARQUET_PARTITION_BLOCKS):
+        if pa is None:
+            raise ImportError("ParquetSink needs pyarrow: pip install pyarrow")
+
+        self.root = root
+        self.partition_blocks = partition_blocks
+
+    def __str__(self):
+        return f"ParquetSink<{self.root}>"
+
+    def write_window(self, first_block: int, last_block: int, syncs: Iterable[DexTradeSync]) -> None:
+        syncs = [sync for sync in syncs if first_block <= sync.tx.block.number <= last_block]
+        txs: Dict[str, Tx] = {sync.tx.hash: sync.tx for sync in syncs}
+        blocks: Dict[int, Block] = {tx.block.number: tx.block for tx in txs.values()}
+
+        # A window that failed to commit is imported again from its first block, maybe with another size
+        partition = f"blocks={first_block - first_block % self.partition_blocks}"
+        for stale_file in glob.glob(os.path.join(self.root, "*", partition, "**", f"{first_block:010d}-*.parquet"),
+                                    recursive=True):
+            os.remove(stale_file)
+        if not syncs:
+            return
+
+        file_name = f"{first_block:010d}-{last_block:010d}.parquet"
+        syncs_by_dex: Dict[str, List[DexTradeSync]] = {}
+        for sync in syncs:
+            syncs_by_dex.setdefault(sync.dex_pair.dex.dex_name, []).append(sync)
+        for dex_name, dex_syncs in syncs_by_dex.items():
+            self.__write(self.__syncs_table(dex_syncs), "syncs", partition, f"dex={dex_name}", file_name)
+        self.__write(self.__txs_table(txs.values()), "txs", partition, file_name)
+        self.__write(self.__blocks_table(blocks.values()), "blocks", partition, file_name)
+
+    def roll_back(self, first_block: int) -> None:
+        """ Removes every row from first_block on, windows written after it are deleted and the one across it cut """
+        for file_path in glob.glob(os.path.join(self.root, "*", "blocks=*", "**", "*.parquet"), recursive=True):
+            window_first, window_last = (int(block) for block in os.path.basename(file_path)[:-8].split("-"))
+            if window_first >= first_block:
+                os.remove(file_path)
+            elif window_last >= first_block:
+                table = pq.ParquetFile(file_path).read()
+                block_column = 'number' if 'number' in table.column_names else 'block_number'
+                self.__write(table.filter(pc.less(table[block_column], first_block)),
+                             os.path.relpath(file_path, self.root))
+
+    def __write(self, table: 'pa.Table', *path: str) -> None:
+        file_path = os.path.join(self.root, *path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Readers never see half written files
+        tmp_path = f"{file_path}.tmp"
+        pq.write_table(table, tmp_path, compression=PARQUET_COMPRESSION)
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def __syncs_table(syncs: List[DexTradeSync]) -> 'pa.Table':
+        return pa.table({
+            'pair_addr': pa.array([sync.dex_pair.pair_addr for sync in syncs], pa.string()).dictionary_encode(),
+            'token_address': pa.array(
+                [sync.dex_pair.token.address for sync in syncs], pa.string()
+            ).dictionary_encode(),
+            'block_number': pa.array([sync.tx.block.number for sync in syncs], pa.int64()),
+            'tx_hash': pa.array([bytes.fromhex(sync.tx.hash[2:]) for sync in syncs], pa.binary(32)),
+            'log_index': pa.array([sync.log_index for sync in syncs], pa.int32()),
+            'token_reserves': pa.array([sync.token_reserves for sync in syncs], pa.decimal128(38, 0)),
+            'wbnb_reserves': pa.array([sync.wbnb_reserves for sync in syncs], pa.decimal128(38, 0)),
+        })
+
+    @staticmethod
+    def __txs_table(txs: Iterable[Tx]) -> 'pa.Table':
+        txs = list(txs)
+        return pa.table({
+            'hash': pa.array([bytes.fromhex(tx.hash[2:]) for tx in txs], pa.binary(32)),
+            'block_number': pa.array([tx.block.number for tx in txs], pa.int64()),
+            'transaction_index': pa.array([tx.transaction_index for tx in txs], pa.int32()),
+            'gas_price': pa.array([tx.gas_price for tx in txs], pa.uint64()),
+        })
+
+    @staticmethod
+    def __blocks_table(blocks: Iterable[Block]) -> 'pa.Table':
+        blocks = list(blocks)
+        return pa.table({
+            'number': pa.array([block.number for block in blocks], pa.int64()),
+            'timestamp': pa.array([block.timestamp for block in blocks], pa.timestamp('s')),
+            'hash': pa.array(
+                [bytes.fromhex(block.hash[2:]) if block.hash else None for block in blocks], pa.binary(32)
+            ),
+            'parent_hash': pa.array(
+                [bytes.fromhex(block.parent_hash[2:]) if block.parent_hash else None for block in blocks], pa.binary(32)
+            ),
+        })
@@ -0,0 +1,150 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from metrics import QUEUE_DEPTH, STAGE_SECONDS
+
+# Seconds a blocked stage waits before checking whether the pipeline was stopped
+POLL_SECONDS = 0.5
+
+
+class _EndOfStream:
+    pass
+
+
+class _StageFailure:
+    def __init__(self, stage_name: str, exception: BaseException):
+        self.stage_name = stage_name
+        self.exception = exception
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages, each one in its own thread, connected by bounded queues.
+
+    Each stage processes items one at a time and in order, so item N+1 can be in the first stage while item N is in
+    the last one, but no stage ever sees items out of order. A full queue blocks the stage before it (backpressure),
+    and a failure in any stage stops the whole pipeline and is raised to whoever iterates the results.
+
+    With threaded=False every item goes through all the stages before the next one is taken, in the caller's thread.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, stages: List[Tuple[str, Callable[[Any], Any]]], max_queued: int = 1, threaded=True):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+
+        self.stages = stages
+        self.max_queued = max_queued
+        self.threaded = threaded
+        self.__stop = threading.Event()
+        self.__queues: List[queue.Queue] = []
+        # Stage that takes the items of each queue, by queue id, to report their depth
+        self.__queue_stages: Dict[int, str] = {}
+
+    def queue_depths(self) -> List[int]:
+        return [q.qsize() for q in self.__queues]
+
+    def run(self, source: Iterable) -> Iterator:
+        """ Yields the output of the last stage for each item of source """
+        if not self.threaded:
+            for item in source:
+                for stage_name, stage in self.stages:
+                    item = self.__timed(stage_name, stage, item)
+                yield item
+            return
+
+        self.__stop.clear()
+        self.__queues = [queue.Queue(maxsize=self.max_queued) for _ in self.stages]
+        output_queue = queue.Queue(maxsize=self.max_queued)
+        self.__queue_stages = {id(q): stage_name for q, (stage_name, _) in zip(self.__queues, self.stages)}
+        self.__queue_stages[id(output_queue)] = "output"
+
+        threads = [threading.Thread(target=self.__feed, args=(source, self.__queues[0]), name="Pipeline-source",
+                                    daemon=True)]
+        for index, (stage_name, stage) in enumerate(self.stages):
+            next_queue = self.__queues[index + 1] if index + 1 < len(self.stages) else output_queue
+            threads.append(threading.Thread(
+                target=self.__run_stage, args=(stage_name, stage, self.__queues[index], next_queue),
+                name=f"Pipeline-{stage_name}", daemon=True
+            ))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self.__get(output_queue)
+                if isinstance(item, _EndOfStream):
+                    break
+                if isinstance(item, _StageFailure):
+                    raise PipelineError(f"Stage {item.stage_name} failed") from item.exception
+                yield item
+        finally:
+            self.__stop.set()
+            for thread in threads:
+                thread.join()
+
+    def __put(self, q: queue.Queue, item: Any) -> bool:
+        while not self.__stop.is_set():
+            try:
+                q.put(item, timeout=POLL_SECONDS)
+                self.__report_depth(q)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __get(self, q: queue.Queue) -> Any:
+        while True:
+            try:
+                item = q.get(timeout=POLL_SECONDS)
+                self.__report_depth(q)
+                return item
+            except queue.Empty:
+                if self.__stop.is_set():
+                    return _EndOfStream()
+
+    def __report_depth(self, q: queue.Queue) -> None:
+        QUEUE_DEPTH.set(q.qsize(), stage=self.__queue_stages.get(id(q), "unknown"))
+
+    @staticmethod
+    def __timed(stage_name: str, stage: Callable, item: Any) -> Any:
+        start_time = time.monotonic()
+        try:
+            return stage(item)
+        finally:
+            STAGE_SECONDS.observe(time.monotonic() - start_time, stage=stage_name)
+
+    def __feed(self, source: Iterable, first_queue: queue.Queue) -> None:
+        try:
+            for item in source:
+                if not self.__put(first_queue, item):
+                    return
+            self.__put(first_queue, _EndOfStream())
+        except BaseException as e:
+            self.logger.exception("Pipeline source failed")
+            self.__put(first_queue, _StageFailure("source", e))
+
+    def __run_stage(self, stage_name: str, stage: Callable, input_queue: queue.Queue, output_queue: queue.Queue):
+        while True:
+            item = self.__get(input_queue)
+            if isinstance(item, (_EndOfStream, _StageFailure)):
+                self.__put(output_queue, item)
+                return
+
+            try:
+                result = self.__timed(stage_name, stage, item)
+            except BaseException as e:
+                self.logger.exception(f"Pipeline stage {stage_name} failed")
+                self.__put(output_queue, _StageFailure(stage_name, e))
+                return
+
+            if not self.__put(output_queue, result):
+                return
@@ -0,0 +1,241 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, List, Mapping, Sequence, Tuple
+
+import numpy as np
+
+from ddbb_manager import DDBBManager
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa, ds = None, None
+
+
+# Reserves are uint112, stored exactly as two uint64 halves of 56 bits: value = hi * 2**56 + lo
+HALF_BITS = 56
+HALF_MASK = (1 << HALF_BITS) - 1
+HALF_SCALE = float(1 << HALF_BITS)
+WBNB_DECIMALS = 18
+
+
+def split_uint112(values: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+    values = [int(value) for value in values]
+    hi = np.fromiter((value >> HALF_BITS for value in values), dtype=np.uint64, count=len(values))
+    lo = np.fromiter((value & HALF_MASK for value in values), dtype=np.uint64, count=len(values))
+    return hi, lo
+
+
+def join_uint112(hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+    """ float64 values of hi/lo halves, signed or not (53 bits of precision, enough for prices) """
+    return hi.astype(np.float64) * HALF_SCALE + lo.astype(np.float64)
+
+
+def to_ints(hi: np.ndarray, lo: np.ndarray) -> List[int]:
+    """ Exact Python ints of hi/lo halves, signed or not """
+    return [(int(h) << HALF_BITS) + int(l) for h, l in zip(hi, lo)]
+
+
+def _split_decimal128(array: 'pa.Array') -> Tuple[np.ndarray, np.ndarray]:
+    """ hi/lo halves of a non-negative decimal128(38, 0) array, read from its 16 bytes little endian values """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    words = np.frombuffer(array.buffers()[1], dtype='<u8')[2 * array.offset:2 * (array.offset + len(array))]
+    lo64, hi64 = words[0::2], words[1::2]
+    return (hi64 << np.uint64(64 - HALF_BITS)) | (lo64 >> np.uint64(HALF_BITS)), lo64 & np.uint64(HALF_MASK)
+
+
+@dataclass
+class OhlcBars:
+    """ Price (in BNB per token) bars of one interval per pair, ordered by pair and start """
+    pair_addr: np.ndarray
+    start: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    # At the close of the bar
+    liquidity_bnb: np.ndarray
+    # BNB in and out of the pair (trades and liquidity changes alike)
+    wbnb_volume: np.ndarray
+    syncs: np.ndarray
+
+    def __len__(self):
+        return len(self.start)
+
+
+@dataclass
+class SyncSeries:
+    """
+    DexTradeSyncs of several pairs as columns, ordered by pair and then chronologically. Columns are per sync but for
+    pair_addrs and token_decimals, which are per pair and indexed by pair.
+    """
+    pair_addrs: np.ndarray
+    token_decimals: np.ndarray
+    pair: np.ndarray
+    block_number: np.ndarray
+    timestamp: np.ndarray
+    log_index: np.ndarray
+    token_hi: np.ndarray
+    token_lo: np.ndarray
+    wbnb_hi: np.ndarray
+    wbnb_lo: np.ndarray
+
+    def __len__(self):
+        return len(self.pair)
+
+    def __str__(self):
+        return f"SyncSeries<{len(self.pair_addrs)} pairs, {len(self)} syncs>"
+
+    @classmethod
+    def from_columns(
+            cls, pair_addr: Sequence[str], token_decimals: Sequence[int], block_number: np.ndarray,
+            timestamp: np.ndarray, log_index: np.ndarray, token_reserves: Tuple[np.ndarray, np.ndarray],
+            wbnb_reserves: Tuple[np.ndarray, np.ndarray]
+    ) -> 'SyncSeries':
+        """ Columns per sync, in any order, with reserves already split in hi/lo halves """
+        pair_addrs, first_rows, pair = np.unique(np.asarray(pair_addr, dtype=object), return_index=True,
+                                                 return_inverse=True)
+        block_number = np.asarray(block_number, dtype=np.int64)
+        log_index = np.asarray(log_index, dtype=np.int64)
+        order = np.lexsort((log_index, block_number, pair))
+        return cls(
+            pair_addrs=pair_addrs,
+            token_decimals=np.asarray(token_decimals, dtype=np.int64)[first_rows],
+            pair=pair[order],
+            block_number=block_number[order],
+            timestamp=np.asarray(timestamp, dtype='datetime64[s]')[order],
+            log_index=log_index[order],
+            token_hi=token_reserves[0][order], token_lo=token_reserves[1][order],
+            wbnb_hi=wbnb_reserves[0][order], wbnb_lo=wbnb_reserves[1][order],
+        )
+
+    @classmethod
+    def from_ddbb(
+            cls, db_manager: DDBBManager, pair_addrs: Iterable[str] = None, from_block: int = None,
+            to_block: int = None
+    ) -> 'SyncSeries':
+        rows = db_manager.get_sync_rows(pair_addrs, from_block=from_block, to_block=to_block)
+        columns = list(zip(*rows)) or [[]] * 7
+        pair_addr, decimals, block_number, timestamp, log_index, token_reserves, wbnb_reserves = columns
+        return cls.from_columns(
+            pair_addr, decimals, np.asarray(block_number, dtype=np.int64),
+            np.array(timestamp, dtype='datetime64[s]'), np.asarray(log_index, dtype=np.int64),
+            split_uint112(token_reserves), split_uint112(wbnb_reserves)
+        )
+
+    @classmethod
+    def from_parquet(
+            cls, root: str, token_decimals: Mapping[str, int], pair_addrs: Iterable[str] = None,
+            from_block: int = None, to_block: int = None
+    ) -> 'SyncSeries':
+        """ Loads the files of a ParquetSink, token_decimals maps token addresses to their decimals """
+        if ds is None:
+            raise ImportError("SyncSeries.from_parquet needs pyarrow: pip install pyarrow")
+
+        sync_filter = ds.field('block_number') >= (from_block or 0)
+        if to_block is not None:
+            sync_filter &= ds.field('block_number') <= to_block
+        if pair_addrs is not None:
+            sync_filter &= ds.field('pair_addr').isin(list(pair_addrs))
+        syncs = ds.dataset(f"{root}/syncs", format="parquet", partitioning="hive").to_table(filter=sync_filter)
+        block_number = syncs.column('block_number').to_numpy()
+
+        blocks = ds.dataset(f"{root}/blocks", format="parquet", partitioning="hive").to_table(
+            columns=['number', 'timestamp'],
+            filter=ds.field('number').isin(np.unique(block_number).tolist())
+        )
+        block_order = np.argsort(blocks.column('number').to_numpy())
+        block_numbers = blocks.column('number').to_numpy()[block_order]
+        block_timestamps = blocks.column('timestamp').to_numpy().astype('datetime64[s]')[block_order]
+
+        return cls.from_columns(
+            syncs.column('pair_addr').cast(pa.string()).to_pylist(),
+            [token_decimals[token] for token in syncs.column('token_address').cast(pa.string()).to_pylist()],
+            block_number, block_timestamps[np.searchsorted(block_numbers, block_number)],
+            syncs.column('log_index').to_numpy(),
+            _split_decimal128(syncs.column('token_reserves')), _split_decimal128(syncs.column('wbnb_reserves'))
+        )
+
+    def reserves(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Token and WBNB reserves in units (decimals applied) """
+        return (
+            join_uint112(self.token_hi, self.token_lo) / 10.0 ** self.token_decimals[self.pair],
+            join_uint112(self.wbnb_hi, self.wbnb_lo) / 10.0 ** WBNB_DECIMALS
+        )
+
+    def prices(self) -> np.ndarray:
+        """ BNB per token after each sync, NaN while the pair has no token reserves """
+        token_reserves, wbnb_reserves = self.reserves()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(token_reserves > 0, wbnb_reserves / token_reserves, np.nan)
+
+    def liquidity_bnb(self) -> np.ndarray:
+        """ Value in BNB of both sides of the pair after each sync """
+        return 2 * self.reserves()[1]
+
+    def first_of_pair(self) -> np.ndarray:
+        """ Mask of the first sync of each pair """
+        first = np.ones(len(self), dtype=bool)
+        first[1:] = self.pair[1:] != self.pair[:-1]
+        return first
+
+    def exact_trade_deltas(self) -> Tuple[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+        """
+        Token and WBNB into the pair since its previous sync, as the signed hi/lo halves of raw amounts (see to_ints).
+        This is what a DexTrade held (token_delta, wbnb_delta), with liquidity additions and removals showing up as
+        deltas of the same sign on both sides. First syncs of each pair have no previous one and get 0.
+        """
+        first = self.first_of_pair()
+
+        def __delta(hi: np.ndarray, lo: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            hi, lo = hi.astype(np.int64), lo.astype(np.int64)
+            delta_hi, delta_lo = np.zeros(len(self), dtype=np.int64), np.zeros(len(self), dtype=np.int64)
+            delta_hi[1:], delta_lo[1:] = hi[1:] - hi[:-1], lo[1:] - lo[:-1]
+            # Keep lo in [0, 2**56) borrowing from hi
+            borrow = delta_lo < 0
+            delta_lo[borrow] += 1 << HALF_BITS
+            delta_hi[borrow] -= 1
+            delta_hi[first], delta_lo[first] = 0, 0
+            return delta_hi, delta_lo
+
+        return __delta(self.token_hi, self.token_lo), __delta(self.wbnb_hi, self.wbnb_lo)
+
+    def trade_deltas(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ exact_trade_deltas in units (decimals applied), NaN at the first sync of each pair """
+        (token_hi, token_lo), (wbnb_hi, wbnb_lo) = self.exact_trade_deltas()
+        first = self.first_of_pair()
+        token_deltas = join_uint112(token_hi, token_lo) / 10.0 ** self.token_decimals[self.pair]
+        wbnb_deltas = join_uint112(wbnb_hi, wbnb_lo) / 10.0 ** WBNB_DECIMALS
+        token_deltas[first], wbnb_deltas[first] = np.nan, np.nan
+        return token_deltas, wbnb_deltas
+
+    def ohlc(self, interval_seconds: int, since: datetime = datetime(1970, 1, 1)) -> OhlcBars:
+        """ Bars of interval_seconds per pair, aligned to since. Intervals without syncs have no bar. """
+        if not len(self):
+            empty = np.array([], dtype=np.float64)
+            return OhlcBars(np.array([], dtype=object), np.array([], dtype='datetime64[s]'),
+                            empty, empty, empty, empty, empty, empty, np.array([], dtype=np.int64))
+
+        since = np.datetime64(since, 's')
+        bucket = (self.timestamp - since).astype(np.int64) // interval_seconds
+        # Syncs are ordered by pair and time, so the syncs of each bar are contiguous
+        new_bar = self.first_of_pair()
+        new_bar[1:] |= bucket[1:] != bucket[:-1]
+        starts = np.flatnonzero(new_bar)
+        ends = np.append(starts[1:], len(self)) - 1
+
+        prices = self.prices()
+        wbnb_deltas = np.nan_to_num(np.abs(self.trade_deltas()[1]))
+        return OhlcBars(
+            pair_addr=self.pair_addrs[self.pair[starts]],
+            start=since + (bucket[starts] * interval_seconds).astype('timedelta64[s]'),
+            open=prices[starts],
+            high=np.fmax.reduceat(prices, starts),
+            low=np.fmin.reduceat(prices, starts),
+            close=prices[ends],
+            liquidity_bnb=self.liquidity_bnb()[ends],
+            wbnb_volume=np.add.reduceat(wbnb_deltas, starts),
+            syncs=ends - starts + 1,
+        )
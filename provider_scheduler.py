@@ -0,0 +1,400 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from http_pool import get_http_session
+from metrics import RPC_CALLS, RPC_ERRORS, RPC_HEDGES, RPC_RETRIES, RPC_SECONDS, provider_label
+
+# The rate limit of BSC endpoint on Testnet and Mainnet is 10K/5min (https://docs.binance.org/smart-chain/developer/rpc.html#rate-limit)
+RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", 10000))
+RATE_LIMIT_SECONDS = int(os.getenv("RATE_LIMIT_SECONDS", 5 * 60))
+# Requests a provider may receive at once after being idle. Kept small so that no 5 minutes window sees much more
+# than RATE_LIMIT_REQUESTS requests.
+RATE_LIMIT_BURST_SECONDS = 10
+
+# A throttled provider is left alone this long, doubling on every consecutive throttle up to the max
+COOLDOWN_SECONDS = 15
+MAX_COOLDOWN_SECONDS = 5 * 60
+# Weight of the last request in the latency and error rate averages
+EWMA_ALPHA = 0.2
+MAX_REQUEST_ATTEMPTS = 10
+
+# Fraction of the requests that may be hedged: sent again to a second provider when the first one has not answered
+# within its p95 latency for that method. 0 disables hedging.
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", 0))
+# Answers needed from a provider (for a method) before its p95 is trusted as a deadline
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DEADLINE_SECONDS = 0.05
+HEDGE_MAX_WORKERS = 64
+# Only reads can be sent twice
+HEDGEABLE_METHODS = {
+    "eth_blockNumber", "eth_call", "eth_chainId", "eth_getBlockByHash", "eth_getBlockByNumber", "eth_getCode",
+    "eth_getHeaderByNumber", "eth_getLogs", "eth_getTransactionByHash", "eth_getTransactionReceipt",
+}
+# Upper bounds of the latency histogram buckets: 1ms, 2ms, 4ms... ~65s
+LATENCY_BUCKETS = tuple(0.001 * 2 ** i for i in range(17))
+
+THROTTLE_ERROR_MSGS = (
+    "403 Client Error: Forbidden for url",
+    "429 Client Error",
+    "too many",
+    "rate limit",
+    "limit exceeded",
+)
+
+
+def is_throttle_error(error: Any) -> bool:
+    error_text = str(error).lower()
+    return any(msg.lower() in error_text for msg in THROTTLE_ERROR_MSGS)
+
+
+class TokenBucket:
+    """ Thread-safe token bucket, refilled continuously at rate tokens per second up to capacity """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """ Seconds until tokens are available (0 if they already are) """
+        with self.__lock:
+            self.__refill()
+            return max(0.0, (min(tokens, self.capacity) - self.__tokens) / self.rate)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        # Requests bigger than the bucket (e.g. a large JSON-RPC batch) take it whole and leave it in debt
+        with self.__lock:
+            self.__refill()
+            if self.__tokens < min(tokens, self.capacity):
+                return False
+            self.__tokens -= tokens
+            return True
+
+
+class LatencyHistogram:
+    """ Latencies in exponential buckets, enough to estimate percentiles in constant memory """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0
+
+    def record(self, latency: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.total += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """ Upper bound of the bucket holding the q-th percentile (q in [0, 1]) """
+        if not self.total:
+            return None
+        threshold = q * self.total
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else float('inf')
+        return float('inf')
+
+    def __str__(self):
+        return " ".join(
+            f"p{q * 100:g}={self.percentile(q) * 1000:.0f}ms" for q in (0.5, 0.95, 0.99)
+        ) + f" ({self.total})"
+
+
+class ScheduledEndpoint:
+    """ An RPC endpoint as seen by the ProviderScheduler: its rate limit, health and cooldown """
+
+    def __init__(self, endpoint_uri: str, priority: int, bucket: TokenBucket):
+        self.endpoint_uri = endpoint_uri
+        self.priority = priority
+        self.bucket = bucket
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.throttles = 0
+        self.cooldown_until = 0.0
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.__consecutive_throttles = 0
+
+    def __str__(self):
+        return f"{self.endpoint_uri} ({self.latency * 1000:.0f}ms, {self.error_rate:.0%} errors, " \
+               f"{self.requests} requests, {self.throttles} throttles)"
+
+    def score(self) -> float:
+        # Expected time per successful request, lower is better
+        return self.latency / max(1 - self.error_rate, 0.05)
+
+    def record_success(self, latency: float, method: str = None) -> None:
+        if method:
+            self.latencies.setdefault(method, LatencyHistogram()).record(latency)
+        self.requests += 1
+        self.latency = latency if self.requests == 1 else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * latency
+        self.error_rate *= 1 - EWMA_ALPHA
+        self.__consecutive_throttles = 0
+
+    def record_error(self) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA
+
+    def record_throttle(self) -> float:
+        """ Puts the endpoint in cooldown, returns for how long """
+        self.record_error()
+        self.throttles += 1
+        self.__consecutive_throttles += 1
+        cooldown = min(COOLDOWN_SECONDS * 2 ** (self.__consecutive_throttles - 1), MAX_COOLDOWN_SECONDS)
+        self.cooldown_until = time.monotonic() + cooldown
+        return cooldown
+
+
+class ProviderScheduler:
+    """
+    Picks an endpoint for every single request (or batch of requests) among several providers.
+
+    Each endpoint has a token bucket honouring its rate limit, and tracks its latency and error rate. Requests go to
+    the endpoint with the best score among the ones that are not cooling down after a throttle and have tokens left,
+    and only wait when none of them does, and only as long as it takes for the first one to be available again.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+            self,
+            endpoint_uris: Sequence[str],
+            rate_limit_requests: int = RATE_LIMIT_REQUESTS,
+            rate_limit_seconds: int = RATE_LIMIT_SECONDS,
+            hedge_max_rate: float = HEDGE_MAX_RATE
+    ):
+        if not endpoint_uris:
+            raise ValueError("At least one endpoint is needed")
+
+        rate = rate_limit_requests / rate_limit_seconds
+        self.endpoints = [
+            ScheduledEndpoint(endpoint_uri, priority, TokenBucket(rate, max(1.0, rate * RATE_LIMIT_BURST_SECONDS)))
+            for priority, endpoint_uri in enumerate(endpoint_uris)
+        ]
+        self.hedge_max_rate = hedge_max_rate
+        self.requests = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        return "ProviderScheduler<" + ", ".join(str(endpoint) for endpoint in self.endpoints) + ">"
+
+    def acquire(self, cost: int = 1, exclude: Sequence[ScheduledEndpoint] = ()) -> ScheduledEndpoint:
+        """ Blocks until an endpoint can take cost requests, avoiding the excluded ones unless they are the only ones """
+        while True:
+            endpoint, wait_time = self.__try_acquire(cost, exclude)
+            if endpoint:
+                return endpoint
+            self.logger.debug(f"Every provider is busy or cooling down, waiting {wait_time:.2f}s")
+            time.sleep(wait_time)
+
+    async def acquire_async(self, cost: int = 1, exclude: Sequence[ScheduledEndpoint] = ()) -> ScheduledEndpoint:
+        """ acquire for coroutines, which wait without blocking their event loop """
+        while True:
+            endpoint, wait_time = self.__try_acquire(cost, exclude)
+            if endpoint:
+                return endpoint
+            self.logger.debug(f"Every provider is busy or cooling down, waiting {wait_time:.2f}s")
+            await asyncio.sleep(wait_time)
+
+    def __try_acquire(
+            self, cost: int, exclude: Sequence[ScheduledEndpoint], strict: bool = False
+    ) -> Tuple[Optional[ScheduledEndpoint], float]:
+        """ An endpoint that can take cost requests now, or how long until the first one can """
+        with self.__lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            if not candidates:
+                if strict:
+                    return None, 0
+                candidates = self.endpoints
+            for endpoint in sorted(candidates, key=lambda e: (e.cooldown_until > now, e.score(), e.priority)):
+                if endpoint.cooldown_until <= now and endpoint.bucket.try_acquire(cost):
+                    return endpoint, 0
+
+            return None, min(
+                max(endpoint.cooldown_until - now, endpoint.bucket.wait_time(cost)) for endpoint in candidates
+            )
+
+    def latency_report(self) -> str:
+        with self.__lock:
+            lines = [f"{self.hedges}/{self.requests} requests hedged, {self.hedges_won} hedges won"]
+            for endpoint in self.endpoints:
+                lines.extend(
+                    f"{endpoint.endpoint_uri} {method}: {histogram}"
+                    for method, histogram in sorted(endpoint.latencies.items())
+                )
+            return "\n".join(lines)
+
+    def hedge_deadline(self, endpoint: ScheduledEndpoint, method: str) -> Optional[float]:
+        """ Seconds to wait for endpoint before hedging a method request, None if it must not be hedged """
+        if self.hedge_max_rate <= 0 or method not in HEDGEABLE_METHODS or len(self.endpoints) < 2:
+            return None
+        with self.__lock:
+            histogram = endpoint.latencies.get(method)
+            if not histogram or histogram.total < HEDGE_MIN_SAMPLES:
+                return None
+            return max(histogram.percentile(0.95), HEDGE_MIN_DEADLINE_SECONDS)
+
+    def try_hedge(self, exclude: Sequence[ScheduledEndpoint]) -> Optional[ScheduledEndpoint]:
+        """
+        The endpoint to hedge a request with, and counts the hedge: one other than the excluded ones (the primary
+        request's) that can take it right now. None, without waiting, if there is none or the hedge rate is reached.
+        """
+        with self.__lock:
+            if self.hedges + 1 > self.hedge_max_rate * self.requests:
+                return None
+        endpoint, _ = self.__try_acquire(1, exclude, strict=True)
+        if endpoint is None:
+            return None
+        with self.__lock:
+            self.hedges += 1
+        RPC_HEDGES.inc(result="sent")
+        return endpoint
+
+    def record_request(self) -> None:
+        with self.__lock:
+            self.requests += 1
+
+    def record_hedge_won(self) -> None:
+        with self.__lock:
+            self.hedges_won += 1
+        RPC_HEDGES.inc(result="won")
+
+    def record_success(self, endpoint: ScheduledEndpoint, latency: float, method: str = None) -> None:
+        with self.__lock:
+            endpoint.record_success(latency, method)
+
+    def record_error(self, endpoint: ScheduledEndpoint, error: Any) -> None:
+        throttled = is_throttle_error(error)
+        RPC_ERRORS.inc(provider=provider_label(endpoint.endpoint_uri), kind="throttle" if throttled else "error")
+        with self.__lock:
+            if throttled:
+                cooldown = endpoint.record_throttle()
+                self.logger.warning(f"{endpoint.endpoint_uri} throttled us, cooling it down for {cooldown}s: {error}")
+            else:
+                endpoint.record_error()
+
+
+@lru_cache(maxsize=None)
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    # Shared by every ScheduledProvider of the process
+    return ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix='HedgedRequest')
+
+
+class ScheduledProvider(BaseProvider):
+    """
+    web3 provider that sends every request through the endpoint a ProviderScheduler picks, rerouting it to another
+    one when it fails or is throttled.
+
+    Reads that take longer than the p95 latency of their endpoint are hedged if the scheduler allows it: the same
+    request goes to a second endpoint and the first successful answer wins.
+
+    JSON-RPC errors other than throttles (e.g. reverts, or a too big eth_getLogs range) are answered as they are.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, scheduler: ProviderScheduler, max_attempts: int = MAX_REQUEST_ATTEMPTS):
+        super().__init__()
+        self.scheduler = scheduler
+        self.max_attempts = max_attempts
+        self.__providers: Dict[str, Web3.HTTPProvider] = {
+            endpoint.endpoint_uri: Web3.HTTPProvider(endpoint.endpoint_uri, session=get_http_session(endpoint.endpoint_uri))
+            for endpoint in scheduler.endpoints
+        }
+
+    def __str__(self):
+        return f"ScheduledProvider<{len(self.__providers)} endpoints>"
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        self.scheduler.record_request()
+        failed: List[ScheduledEndpoint] = []
+        last_error: Optional[Exception] = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                RPC_RETRIES.inc(method=method)
+            endpoint = self.scheduler.acquire(exclude=failed)
+            deadline = self.scheduler.hedge_deadline(endpoint, method)
+            try:
+                if deadline is None:
+                    return self.__send(endpoint, method, params)
+                return self.__send_hedged(endpoint, deadline, method, params, failed)
+            except (Exception,) as e:
+                failed.append(endpoint)
+                last_error = e
+
+        raise last_error
+
+    def __send(self, endpoint: ScheduledEndpoint, method: RPCEndpoint, params: Any) -> RPCResponse:
+        provider = provider_label(endpoint.endpoint_uri)
+        RPC_CALLS.inc(provider=provider, method=method)
+        start_time = time.monotonic()
+        try:
+            response = self.__providers[endpoint.endpoint_uri].make_request(method, params)
+            if 'error' in response and is_throttle_error(response['error']):
+                raise ValueError(response['error'])
+        except (Exception,) as e:
+            self.scheduler.record_error(endpoint, e)
+            raise
+
+        latency = time.monotonic() - start_time
+        RPC_SECONDS.observe(latency, provider=provider, method=method)
+        self.scheduler.record_success(endpoint, latency, method)
+        return response
+
+    def __send_hedged(
+            self,
+            endpoint: ScheduledEndpoint,
+            deadline: float,
+            method: RPCEndpoint,
+            params: Any,
+            failed: List[ScheduledEndpoint]
+    ) -> RPCResponse:
+        executor = _get_hedge_executor()
+        primary = executor.submit(self.__send, endpoint, method, params)
+        try:
+            return primary.result(timeout=deadline)
+        except TimeoutError:
+            pass
+
+        hedge_endpoint = self.scheduler.try_hedge(exclude=failed + [endpoint])
+        if hedge_endpoint is None:
+            return primary.result()
+
+        # The slow request keeps going (and its latency is recorded), whichever answers first successfully wins
+        hedge = executor.submit(self.__send, hedge_endpoint, method, params)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.scheduler.record_hedge_won()
+                    return future.result()
+                if future is hedge:
+                    failed.append(hedge_endpoint)
+
+        return primary.result()
+
+    def isConnected(self) -> bool:
+        return any(provider.isConnected() for provider in self.__providers.values())
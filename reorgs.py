@@ -0,0 +1,65 @@
+import logging
+import os
+from typing import Dict, Iterable, Optional
+
+from ddbb_manager import DDBBManager
+from rpc_batch import JsonRpcBatcher
+from web3_utils import get_w3
+
+# Blocks below the last imported one whose hashes are checked against the canonical chain, after each window imported
+# this close to the head
+REORG_CHECK_BLOCKS = int(os.getenv("REORG_CHECK_BLOCKS", 64))
+
+
+class ReorgDetector:
+    """
+    Finds imported blocks that are not in the canonical chain anymore, comparing the hashes stored with them to the ones
+    of the node.
+
+    Only the last REORG_CHECK_BLOCKS imported blocks are checked each time, unless the lowest of them is already off
+    the chain: then the blocks below are checked too, as many at a time, until the branch point is found.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, db_manager: DDBBManager, batcher: JsonRpcBatcher = None, depth: int = REORG_CHECK_BLOCKS):
+        self.db_manager = db_manager
+        self.batcher = batcher
+        self.depth = depth
+
+    def __str__(self):
+        return f"ReorgDetector<last {self.depth} blocks>"
+
+    def find_fork(self, last_block: int) -> Optional[int]:
+        """ First imported block up to last_block that is not in the canonical chain, None if they all are """
+        fork_block = None
+        to_block = last_block
+        while to_block >= 0:
+            stored_hashes = {
+                number: block_hash for number, (block_hash, _)
+                in self.db_manager.get_block_hashes(to_block - self.depth + 1, to_block).items() if block_hash
+            }
+            if not stored_hashes:
+                break
+            canonical_hashes = self.__canonical_hashes(stored_hashes.keys())
+            forked_blocks = [number for number, block_hash in stored_hashes.items()
+                             if canonical_hashes.get(number) != block_hash]
+            if not forked_blocks:
+                break
+
+            fork_block = min(forked_blocks)
+            self.logger.warning(f"{len(forked_blocks)} blocks between {fork_block} and {max(forked_blocks)} are not in "
+                                f"the canonical chain anymore")
+            if fork_block > min(stored_hashes):
+                break
+            to_block -= self.depth
+
+        return fork_block
+
+    def __canonical_hashes(self, block_numbers: Iterable[int]) -> Dict[int, str]:
+        block_numbers = sorted(block_numbers)
+        if self.batcher:
+            # The RPC cache only keeps blocks deeper than any reorg this can find. A block the node does not have
+            # raises: it would look like a fork otherwise.
+            headers = self.batcher.request_many("eth_getBlockByNumber", [[hex(n), False] for n in block_numbers])
+            return {number: header['hash'] for number, header in zip(block_numbers, headers)}
+        return {number: get_w3().eth.get_block(number)['hash'].hex() for number in block_numbers}
@@ -0,0 +1,196 @@
+import itertools
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+from web3._utils.method_formatters import block_formatter, transaction_result_formatter
+from web3.datastructures import AttributeDict
+from web3.types import BlockData, TxData
+
+from http_pool import get_http_session
+from metrics import RPC_CALLS, RPC_RETRIES, RPC_SECONDS, provider_label
+from provider_scheduler import ProviderScheduler, is_throttle_error
+from rpc_cache import RpcResponseCache
+from web3_utils import get_provider_scheduler
+
+# Most public nodes reject batches bigger than a few hundred calls
+DEFAULT_BATCH_SIZE = 100
+MAX_ITEM_RETRIES = 5
+REQUEST_TIMEOUT_SECONDS = 30
+RETRY_WAIT_SECONDS = 1
+
+
+class BatchRpcError(Exception):
+    def __init__(self, method: str, failures: Dict[Any, Any]):
+        super().__init__(f"{len(failures)} {method} calls failed, e.g. {next(iter(failures.items()))}")
+        self.method = method
+        self.failures = failures
+
+
+class NullResult(str):
+    """ Failure of a call answered with a null result, e.g. by a node that does not have that data yet """
+
+
+class JsonRpcBatcher:
+    """
+    Resolves many calls to the same read-only method with JSON-RPC batch requests (arrays of calls in one HTTP POST).
+
+    Calls that fail inside a batch, or are missing from its response, are retried in the next round of batches
+    (possibly on another provider) without repeating the ones that succeeded.
+
+    Providers are picked by a ProviderScheduler, where each batch costs as many requests as calls it has. By default
+    it is the one get_w3() uses, so batches and single requests share the rate limit of each provider.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+            self,
+            endpoint_uris: Sequence[str] = None,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            max_item_retries: int = MAX_ITEM_RETRIES,
+            timeout_seconds: float = REQUEST_TIMEOUT_SECONDS,
+            cache: RpcResponseCache = None
+    ):
+        self.scheduler: ProviderScheduler = ProviderScheduler(endpoint_uris) if endpoint_uris \
+            else get_provider_scheduler()
+        self.endpoint_uris = [endpoint.endpoint_uri for endpoint in self.scheduler.endpoints]
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch size {batch_size}")
+
+        self.batch_size = batch_size
+        self.max_item_retries = max_item_retries
+        self.timeout_seconds = timeout_seconds
+        self.cache = cache
+        self.header_method = "eth_getHeaderByNumber"
+
+    def __str__(self):
+        return f"JsonRpcBatcher<{len(self.endpoint_uris)} providers, {self.batch_size} calls per batch>"
+
+    def request_many(self, method: str, params_list: Sequence[List[Any]], allow_null: bool = False) -> List[Any]:
+        """
+        Returns the results of calling method with each params, in the same order. Null results are retried like
+        failures; with allow_null, calls still answered with null once retries run out are None instead of raising.
+        """
+        results: Dict[int, Any] = {}
+        pending = list(range(len(params_list)))
+        failures: Dict[int, Any] = {}
+        if self.cache:
+            for i in pending:
+                found, result = self.cache.get(method, params_list[i])
+                if found:
+                    results[i] = result
+            pending = [i for i in pending if i not in results]
+        fetched = set(pending)
+
+        for retry in itertools.count():
+            if not pending:
+                break
+            if retry > self.max_item_retries:
+                if allow_null and all(isinstance(failures.get(i), NullResult) for i in pending):
+                    results.update((i, None) for i in pending)
+                    break
+                raise BatchRpcError(method, {tuple(params_list[i]): failures.get(i) for i in pending})
+            if retry > 0:
+                self.logger.debug(f"Retrying {len(pending)} failed {method} calls (retry #{retry})")
+                RPC_RETRIES.inc(len(pending), method=method)
+                time.sleep(RETRY_WAIT_SECONDS * retry)
+
+            failed = []
+            for batch_start in range(0, len(pending), self.batch_size):
+                batch = pending[batch_start:batch_start + self.batch_size]
+                batch_results, batch_failures = self.__send_batch(method, [(i, params_list[i]) for i in batch])
+                results.update(batch_results)
+                failures.update(batch_failures)
+                failed.extend(i for i in batch if i not in batch_results)
+            pending = failed
+
+        if self.cache:
+            for i in fetched:
+                self.cache.put(method, params_list[i], results[i])
+
+        return [results[i] for i in range(len(params_list))]
+
+    def __send_batch(self, method: str, calls: List[Tuple[int, List[Any]]]) -> Tuple[Dict[int, Any], Dict[int, Any]]:
+        endpoint = self.scheduler.acquire(cost=len(calls))
+        endpoint_uri = endpoint.endpoint_uri
+        payload = [{"jsonrpc": "2.0", "method": method, "params": params, "id": call_id} for call_id, params in calls]
+        provider = provider_label(endpoint_uri)
+        RPC_CALLS.inc(len(calls), provider=provider, method=method)
+        start_time = time.monotonic()
+        try:
+            response = get_http_session(endpoint_uri).post(
+                endpoint_uri, data=json.dumps(payload), headers={'Content-Type': 'application/json'},
+                timeout=self.timeout_seconds
+            )
+            response.raise_for_status()
+            responses = response.json()
+            if not isinstance(responses, list):
+                # Some nodes answer a rejected batch with a single error object
+                raise ValueError(responses.get('error', responses) if isinstance(responses, dict) else responses)
+        except (Exception,) as e:
+            self.scheduler.record_error(endpoint, e)
+            self.logger.warning(f"Batch of {len(calls)} {method} calls to {endpoint_uri} failed: {e}")
+            return {}, {call_id: str(e) for call_id, _ in calls}
+
+        results, failures = {}, {}
+        for item in responses:
+            call_id = item.get('id')
+            if 'error' in item:
+                failures[call_id] = item['error']
+            elif item.get('result') is None:
+                # Lagging nodes answer null for data they do not have yet
+                failures[call_id] = NullResult(f"null result from {endpoint_uri}")
+            else:
+                results[call_id] = item['result']
+
+        throttle_errors = [error for error in failures.values() if is_throttle_error(error)]
+        if throttle_errors:
+            self.scheduler.record_error(endpoint, throttle_errors[0])
+        else:
+            latency = time.monotonic() - start_time
+            RPC_SECONDS.observe(latency, provider=provider, method=method)
+            self.scheduler.record_success(endpoint, latency)
+
+        return results, failures
+
+    def get_transactions(self, tx_hashes: Iterable[str]) -> Dict[str, TxData]:
+        """ Txs by hash, without the ones the node does not know (yet) """
+        tx_hashes = list(tx_hashes)
+        return {
+            tx_hash: AttributeDict.recursive(transaction_result_formatter(tx_data))
+            for tx_hash, tx_data in zip(tx_hashes, self.request_many(
+                "eth_getTransactionByHash", [[tx_hash] for tx_hash in tx_hashes], allow_null=True
+            )) if tx_data is not None
+        }
+
+    def get_headers(self, block_numbers: Iterable[int]) -> Dict[int, dict]:
+        """
+        Headers as the node returns them (hex strings), with eth_getHeaderByNumber or eth_getBlockByNumber without txs
+        if the node lacks it
+        """
+        block_numbers = list(block_numbers)
+        try:
+            headers = self.request_many(self.header_method, [
+                [hex(n)] if self.header_method == "eth_getHeaderByNumber" else [hex(n), False] for n in block_numbers
+            ])
+        except BatchRpcError as e:
+            if self.header_method == "eth_getBlockByNumber" or not any(
+                    "not exist" in str(error) or "not found" in str(error) or "-32601" in str(error)
+                    for error in e.failures.values()
+            ):
+                raise
+            self.logger.warning(f"{self.header_method} not supported, falling back to eth_getBlockByNumber")
+            self.header_method = "eth_getBlockByNumber"
+            return self.get_headers(block_numbers)
+
+        return dict(zip(block_numbers, headers))
+
+    def get_blocks(self, block_numbers: Iterable[int]) -> Dict[int, BlockData]:
+        block_numbers = list(block_numbers)
+        return {
+            block_number: AttributeDict.recursive(block_formatter(block_data))
+            for block_number, block_data in zip(block_numbers, self.request_many(
+                "eth_getBlockByNumber", [[hex(block_number), False] for block_number in block_numbers]
+            ))
+        }
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Callable, Optional, Tuple
+
+from web3.providers.base import BaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from metrics import CACHE_LOOKUPS
+
+# Blocks this close to the head may still be reorganised, responses about them are never cached
+RPC_CACHE_CONFIRMATIONS = int(os.getenv("RPC_CACHE_CONFIRMATIONS", 100))
+HEAD_REFRESH_SECONDS = 60
+COMPRESSION_LEVEL = 6
+
+# Methods whose response only depends on their params once the blocks involved are final
+BLOCK_NUMBER_METHODS = {"eth_getBlockByNumber", "eth_getHeaderByNumber"}
+TX_METHODS = {"eth_getTransactionByHash", "eth_getTransactionReceipt"}
+CACHEABLE_METHODS = BLOCK_NUMBER_METHODS | TX_METHODS | {"eth_getLogs", "eth_chainId"}
+
+
+def _to_int(block: Any) -> Optional[int]:
+    if isinstance(block, int):
+        return block
+    if isinstance(block, str) and block.startswith("0x"):
+        return int(block, 16)
+    # "latest", "pending", "earliest" or missing
+    return None
+
+
+class RpcResponseCache:
+    """
+    Persistent cache of the responses to read-only RPCs about final blocks, in a SQLite file.
+
+    Entries are keyed by a hash of the method and its params and hold the zlib compressed JSON result. A response is
+    only stored when every block it depends on is at least RPC_CACHE_CONFIRMATIONS blocks behind the head, which is
+    asked to head_fetcher every HEAD_REFRESH_SECONDS.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, path: str, head_fetcher: Callable[[], int], confirmations: int = RPC_CACHE_CONFIRMATIONS):
+        self.path = path
+        self.head_fetcher = head_fetcher
+        self.confirmations = confirmations
+        self.hits = 0
+        self.misses = 0
+        self.__head: Optional[int] = None
+        self.__head_updated = 0.0
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(
+            # Backfill workers share the file, WAL lets them read while another one writes
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS rpc_response (key BLOB PRIMARY KEY, value BLOB NOT NULL)")
+
+    def __str__(self):
+        return f"RpcResponseCache<{self.path}, {self.hits} hits, {self.misses} misses>"
+
+    @staticmethod
+    def key(method: str, params: Any) -> bytes:
+        return hashlib.sha256(
+            f"{method}:{json.dumps(params, sort_keys=True, separators=(',', ':'))}".encode()
+        ).digest()
+
+    def get(self, method: str, params: Any) -> Tuple[bool, Any]:
+        """ Returns (found, result) """
+        if method not in CACHEABLE_METHODS:
+            return False, None
+
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT value FROM rpc_response WHERE key = ?", (self.key(method, params),)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="rpc", result="misses")
+                return False, None
+            self.hits += 1
+        CACHE_LOOKUPS.inc(cache="rpc", result="hits")
+
+        return True, json.loads(zlib.decompress(row[0]))
+
+    def put(self, method: str, params: Any, result: Any) -> bool:
+        """ Stores result if it can never change, returns whether it did """
+        if not self.__is_final(method, params, result):
+            return False
+
+        value = zlib.compress(json.dumps(result, separators=(',', ':')).encode(), COMPRESSION_LEVEL)
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO rpc_response (key, value) VALUES (?, ?)", (self.key(method, params), value)
+            )
+        return True
+
+    def safe_block(self) -> Optional[int]:
+        """ Highest block considered final, None if the head is unknown """
+        if time.monotonic() - self.__head_updated > HEAD_REFRESH_SECONDS:
+            try:
+                self.update_head(self.head_fetcher())
+            except (Exception,):
+                self.logger.exception("Could not refresh the head, caching nothing until it can be")
+                return None
+        return self.__head - self.confirmations if self.__head is not None else None
+
+    def update_head(self, head: int) -> None:
+        self.__head = head
+        self.__head_updated = time.monotonic()
+
+    def __is_final(self, method: str, params: Any, result: Any) -> bool:
+        if method not in CACHEABLE_METHODS or result is None:
+            return False
+        if method == "eth_chainId":
+            return True
+
+        if method in BLOCK_NUMBER_METHODS:
+            last_block = _to_int(params[0])
+        elif method in TX_METHODS:
+            last_block = _to_int(result.get('blockNumber'))
+        else:
+            log_filter = params[0]
+            if 'blockHash' in log_filter:
+                return False
+            last_block = _to_int(log_filter.get('toBlock'))
+            if _to_int(log_filter.get('fromBlock')) is None:
+                return False
+
+        if last_block is None:
+            return False
+        safe_block = self.safe_block()
+        return safe_block is not None and last_block <= safe_block
+
+
+class CachingProvider(BaseProvider):
+    """ web3 provider answering from an RpcResponseCache when it can, and from the wrapped provider otherwise """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, provider: BaseProvider, cache: RpcResponseCache):
+        super().__init__()
+        self.provider = provider
+        self.cache = cache
+
+    def __str__(self):
+        return f"CachingProvider<{self.provider}, {self.cache}>"
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        found, result = self.cache.get(method, params)
+        if found:
+            return {"jsonrpc": "2.0", "id": 0, "result": result}
+
+        response = self.provider.make_request(method, params)
+        if 'result' in response:
+            if method == "eth_blockNumber":
+                self.cache.update_head(_to_int(response['result']))
+            self.cache.put(method, params, response['result'])
+        return response
+
+    def isConnected(self) -> bool:
+        return self.provider.isConnected()
@@ -0,0 +1,162 @@
+from typing import Collection, Dict, Iterable
+
+import pytest
+
+from bloom_index import BloomIndex, bloom_key, bloom_may_contain
+
+PANCAKESWAP_FACTORY = "0xcA143Ce32Fe78f1f7019d7d551a6402fC5350c73"
+APESWAP_FACTORY = "0x0841BD0B734E4F5853f0dD8d7Ea041c241fb0Da6"
+PAIR_CREATED_TOPIC = "0x0d3648bd0f6ba80134a33ba9275ac585d9d315f0ad8355cddefde31afa28d0e9"
+WBNB_TOPIC = "0x000000000000000000000000bb4cdb9cbd36b01bd1cbaebf2de08d9173bc095c"
+# logsBloom of a header whose only log is a PairCreated of the PancakeSwap factory with WBNB as token0, as computed by
+# eth-bloom, the implementation py-evm fills in headers with
+PAIR_CREATED_BLOOM = int(
+    "0000000000000000000000000000000000000001000000000000000000000000000000000000000000000880000000000000000000000000"
+    "0000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000"
+    "0000000000000000000000000000000000400000000000000000000000000000000000000020000000000000000000000000000008000000"
+    "0000000000000000000000000000000000000000000000000000000000000000000000000000004000000000000000000000000100000000"
+    "0000000000000000080000000000000000000000000000000000000000000000", 16
+)
+# Logs of another contract in every block, so that the blooms of blocks without the factory's are not empty
+OTHER_CONTRACT = "0x" + "11" * 20
+
+
+def _bloom_of(*items: str) -> int:
+    bloom = 0
+    for item in items:
+        key = bloom_key(item)
+        bloom |= (1 << (key & 2047)) | (1 << ((key >> 11) & 2047)) | (1 << (key >> 22))
+    return bloom
+
+
+OTHER_BLOOM = _bloom_of(OTHER_CONTRACT, PAIR_CREATED_TOPIC)
+
+
+class FakeBatcher:
+    """ Serves headers whose logsBloom has a PairCreated of the factory in the given blocks """
+
+    def __init__(self, pair_created_blocks: Collection[int], missing_blocks: Collection[int] = (),
+                 empty_bloom_blocks: Collection[int] = ()):
+        self.pair_created_blocks = pair_created_blocks
+        self.missing_blocks = missing_blocks
+        self.empty_bloom_blocks = empty_bloom_blocks
+        self.requested = []
+
+    def get_headers(self, block_numbers: Iterable[int]) -> Dict[int, dict]:
+        block_numbers = list(block_numbers)
+        self.requested.extend(block_numbers)
+        headers = {}
+        for block_number in block_numbers:
+            if block_number in self.missing_blocks:
+                continue
+            bloom = 0 if block_number in self.empty_bloom_blocks else OTHER_BLOOM
+            if block_number in self.pair_created_blocks:
+                bloom |= PAIR_CREATED_BLOOM
+            headers[block_number] = {"logsBloom": f"0x{bloom:0512x}"}
+        return headers
+
+
+@pytest.fixture
+def index_path(tmp_path) -> str:
+    return str(tmp_path / "bloom.sqlite")
+
+
+def _index(path: str, batcher: FakeBatcher) -> BloomIndex:
+    # Segments of 4, 8 and 16 blocks
+    return BloomIndex(path, batcher, segment_blocks=4, fanout=2, levels=3)
+
+
+def _factory_ranges(index: BloomIndex, from_block: int, to_block: int, factory: str = PANCAKESWAP_FACTORY):
+    return index.ranges(from_block, to_block, [factory], PAIR_CREATED_TOPIC)
+
+
+def test_bloom_key_sets_the_bits_of_a_header_bloom():
+    assert _bloom_of(PANCAKESWAP_FACTORY, PAIR_CREATED_TOPIC, WBNB_TOPIC) == PAIR_CREATED_BLOOM
+    # Addresses are hashed as bytes, whatever their case
+    assert bloom_key(PANCAKESWAP_FACTORY) == bloom_key(PANCAKESWAP_FACTORY.lower())
+
+
+def test_bloom_may_contain():
+    for item in (PANCAKESWAP_FACTORY, PAIR_CREATED_TOPIC, WBNB_TOPIC):
+        assert bloom_may_contain(PAIR_CREATED_BLOOM, bloom_key(item))
+    assert not bloom_may_contain(PAIR_CREATED_BLOOM, bloom_key(APESWAP_FACTORY))
+    assert not bloom_may_contain(OTHER_BLOOM, bloom_key(PANCAKESWAP_FACTORY))
+
+
+def test_ranges_keep_only_segments_that_may_match(index_path):
+    index = _index(index_path, FakeBatcher(pair_created_blocks={10, 37}))
+    index.prepare(0, 63)
+
+    assert _factory_ranges(index, 0, 63) == [(8, 11), (36, 39)]
+    # Ranges are clipped to the ones asked for, which need not be aligned to segments
+    assert _factory_ranges(index, 9, 38) == [(9, 11), (36, 38)]
+    assert _factory_ranges(index, 12, 35) == []
+    assert _factory_ranges(index, 0, 63, APESWAP_FACTORY) == []
+    assert index.span(0, 63, [PANCAKESWAP_FACTORY], PAIR_CREATED_TOPIC) == (8, 39)
+    # Any address, only by topic
+    assert index.ranges(0, 63, None, PAIR_CREATED_TOPIC) == [(0, 63)]
+
+    assert index.bloom(0, 63) == PAIR_CREATED_BLOOM | OTHER_BLOOM
+    assert index.bloom(16, 31) == OTHER_BLOOM
+
+
+def test_segments_are_persisted(index_path):
+    _index(index_path, FakeBatcher(pair_created_blocks={10})).prepare(0, 63)
+
+    batcher = FakeBatcher(pair_created_blocks=())
+    index = _index(index_path, batcher)
+    index.prepare(0, 63)
+    assert batcher.requested == []
+    assert _factory_ranges(index, 0, 63) == [(8, 11)]
+
+
+def test_partial_segments(index_path):
+    batcher = FakeBatcher(pair_created_blocks={61})
+    index = _index(index_path, batcher)
+    index.prepare(0, 61)
+
+    # The segment of blocks 60-63 is only indexed up to 61
+    assert _factory_ranges(index, 56, 61) == [(60, 61)]
+    assert _factory_ranges(index, 0, 59) == []
+    assert _factory_ranges(index, 0, 63) == [(60, 63)]
+    assert index.bloom(0, 61) is not None
+    assert index.bloom(0, 63) is None
+
+    # Filling it in only fetches the blocks it lacks
+    batcher.requested.clear()
+    index.prepare(62, 63)
+    assert batcher.requested == [62, 63]
+    assert _factory_ranges(index, 0, 63) == [(60, 63)]
+    assert index.bloom(0, 63) is not None
+
+
+def test_unindexed_blocks_may_have_logs(index_path):
+    batcher = FakeBatcher(pair_created_blocks=(), missing_blocks={5}, empty_bloom_blocks=range(40, 44))
+    index = _index(index_path, batcher)
+    index.prepare(0, 15)
+    index.prepare(32, 47)
+
+    # Blocks 16-31 were never indexed, block 5 has no header (its segment is only indexed up to block 4) and
+    # blocks 40-43 have empty blooms, as nodes that do not fill them in send
+    assert _factory_ranges(index, 0, 47) == [(4, 7), (16, 31), (40, 43)]
+    assert _factory_ranges(index, 48, 63) == [(48, 63)]
+    assert index.bloom(0, 15) is None
+    assert index.bloom(16, 31) is None
+    assert index.bloom(8, 15) == OTHER_BLOOM
+
+
+def test_roll_back(index_path):
+    index = _index(index_path, FakeBatcher(pair_created_blocks={10, 37}))
+    index.prepare(0, 61)
+
+    index.roll_back(36)
+    # Every segment with blocks from 36 on is forgotten, so nothing from the abandoned branch rules anything out
+    assert _factory_ranges(index, 0, 63) == [(8, 11), (36, 63)]
+    assert _factory_ranges(index, 0, 35) == [(8, 11)]
+    assert index.bloom(0, 35) is not None
+    assert index.bloom(0, 36) is None
+
+    # The canonical branch has its PairCreated in block 50 instead
+    reorged = _index(index_path, FakeBatcher(pair_created_blocks={10, 50}))
+    reorged.prepare(0, 63)
+    assert _factory_ranges(reorged, 0, 63) == [(8, 11), (48, 51)]
@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import time
+from typing import Callable
+
+from sqlalchemy import create_engine, text
+
+from mock_node import MockNode, MockNodeConfig, SYNC_EVENT_TOPIC
+
+MOCK_NODE_PORT = 19870
+HEAD = 1200
+# The head must move on for the import to get past the blocks it waits for, and see the reorg
+BLOCK_SECONDS = 0.5
+# Blocks imported on a branch that is reorged away once they are
+FORKED_BLOCKS = range(1180, HEAD + 1)
+TAIL_CONFIRMATIONS = 2
+WAIT_SECONDS = 60
+
+
+def _import_following_head(ddbb_string: str) -> None:
+    """ Runs in its own process, so that web3_utils and main pick up the mock node and the settings of the test """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from ddbb_manager import DDBBManager
+    from main import import_blocks, parse_args
+
+    import_blocks(parse_args([]), DDBBManager(ddbb_string), 1)
+
+
+def _wait_for(condition: Callable[[], bool], what: str) -> None:
+    deadline = time.time() + WAIT_SECONDS
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError(f"Timed out waiting for {what}")
+        time.sleep(0.2)
+
+
+def test_import_past_a_reorg(tmp_path, monkeypatch):
+    config = MockNodeConfig(
+        port=MOCK_NODE_PORT, providers=2, head=HEAD, pairs_per_block=0.05, syncs_per_block=2, active_pairs=20,
+        block_time=BLOCK_SECONDS
+    )
+    for name, value in {
+        "WEB3_PROVIDER_URLS": ",".join(config.endpoint_uris()), "WEB3_WS_URLS": "",
+        "RATE_LIMIT_REQUESTS": str(10 ** 9), "BLOCK_LENGTH": "500", "TAIL_CONFIRMATIONS": str(TAIL_CONFIRMATIONS),
+        "TAIL_POLL_SECONDS": "0.1", "BLOOM_INDEX_PATH": "", "RPC_CACHE_PATH": "", "SINKS": "ddbb",
+    }.items():
+        monkeypatch.setenv(name, value)
+    ddbb_string = f"sqlite:///{tmp_path / 'reorg.db'}"
+    engine = create_engine(ddbb_string)
+
+    def __scalar(query: str):
+        try:
+            with engine.connect() as connection:
+                return connection.execute(text(query)).scalar()
+        except (Exception,):
+            # Before the importer creates the tables
+            return None
+
+    def __stored_hash(block: int):
+        return __scalar(f"SELECT hash FROM block WHERE number = {block}")
+
+    node = MockNode(config)
+    chain = node.chain
+    chain.forks.update((block, 1) for block in FORKED_BLOCKS)
+    orphan_hash = chain.block_hash(FORKED_BLOCKS[0])
+    node.start()
+    importer = multiprocessing.get_context("spawn").Process(
+        target=_import_following_head, args=(ddbb_string,), daemon=True
+    )
+    importer.start()
+    try:
+        _wait_for(lambda: (__scalar("SELECT MAX(last_block) FROM import_checkpoint") or 0) >= HEAD - TAIL_CONFIRMATIONS,
+                  "the import of the branch to be orphaned")
+        assert __stored_hash(FORKED_BLOCKS[0]) == orphan_hash
+        orphan_txs = {log["transactionHash"] for block in FORKED_BLOCKS for log in chain.logs_of(block)}
+
+        # The forked blocks are replaced by others
+        chain.forks.update((block, 2) for block in FORKED_BLOCKS)
+        final_block = chain.head - TAIL_CONFIRMATIONS
+        _wait_for(lambda: __stored_hash(FORKED_BLOCKS[0]) == chain.block_hash(FORKED_BLOCKS[0])
+                  and (__scalar("SELECT MAX(last_block) FROM import_checkpoint") or 0) >= final_block,
+                  "the import of the canonical branch")
+    finally:
+        importer.terminate()
+        importer.join()
+        node.stop()
+
+    with engine.connect() as connection:
+        checkpoints = connection.execute(text(
+            "SELECT first_block, last_block FROM import_checkpoint ORDER BY first_block"
+        )).all()
+        stored_hashes = dict(connection.execute(text("SELECT number, hash FROM block")).all())
+        tx_hashes = {tx_hash for tx_hash, in connection.execute(text("SELECT hash FROM tx"))}
+        pair_txs = {tx_hash for tx_hash, in connection.execute(text("SELECT creator_tx_hash FROM dex_trade_pair"))}
+        sync_txs = [tx_hash for tx_hash, in connection.execute(text("SELECT tx_hash FROM dex_trade_sync"))]
+        pair_syncs = {
+            pair_addr: (syncs, last_sync_block) for pair_addr, syncs, last_sync_block in connection.execute(text(
+                "SELECT p.pair_addr, COUNT(*), MAX(tx.block_number) FROM dex_trade_sync s "
+                "JOIN dex_trade_pair p ON p.id = s.dex_pair_id JOIN tx ON tx.hash = s.tx_hash GROUP BY p.pair_addr"
+            ))
+        }
+        activity = {
+            pair_addr: (syncs, last_sync_block) for pair_addr, syncs, last_sync_block in connection.execute(text(
+                "SELECT pair_addr, syncs, last_sync_block FROM pair_activity"
+            ))
+        }
+
+    # Nothing of the orphaned branch is left
+    assert not orphan_txs & (tx_hashes | pair_txs | set(sync_txs))
+    assert all(block_hash == chain.block_hash(number) for number, block_hash in stored_hashes.items())
+    # And the canonical range is imported again, once
+    assert checkpoints[0][0] == 1
+    assert all(previous[1] + 1 == checkpoint[0] for previous, checkpoint in zip(checkpoints, checkpoints[1:]))
+    last_block = checkpoints[-1][1]
+    canonical_syncs = [
+        log["transactionHash"] for block in range(last_block + 1) for log in chain.logs_of(block)
+        if log["topics"][0] == SYNC_EVENT_TOPIC
+    ]
+    assert sorted(sync_txs) == sorted(canonical_syncs)
+    assert len(pair_txs) == chain.pairs_until(last_block)
+    # The activity of pairs that synced in the orphaned blocks only counts the syncs that are left
+    assert {
+        pair_addr: pair_activity for pair_addr, pair_activity in activity.items() if pair_activity[0] > 0
+    } == pair_syncs
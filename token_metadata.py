@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Tuple
+
+from eth_abi import decode_abi, encode_abi
+from eth_typing import ChecksumAddress
+from hexbytes import HexBytes
+from web3 import Web3
+
+from data_models import Token
+from rpc_batch import JsonRpcBatcher
+from web3_utils import get_erc20_contract, get_w3
+
+# Multicall3, deployed at the same address on BSC, its testnet and most EVM chains
+MULTICALL_ADDRESS = Web3.toChecksumAddress(os.getenv("MULTICALL_ADDRESS", "0xcA11bde05977b3631167028862bE2a173976CA11"))
+# Tokens whose name, symbol and decimals go in one aggregate eth_call (3 calls each)
+TOKEN_METADATA_TOKENS_PER_CALL = int(os.getenv("TOKEN_METADATA_TOKENS_PER_CALL", 100))
+
+TRY_AGGREGATE_SELECTOR = Web3.keccak(text="tryAggregate(bool,(address,bytes)[])")[:4]
+NAME_SELECTOR = Web3.keccak(text="name()")[:4]
+SYMBOL_SELECTOR = Web3.keccak(text="symbol()")[:4]
+DECIMALS_SELECTOR = Web3.keccak(text="decimals()")[:4]
+
+
+def _decode_text(data: bytes) -> str:
+    """ A string return value, or a bytes32 one (as some early tokens return their name and symbol) """
+    text = ""
+    if len(data) >= 64:
+        try:
+            text = decode_abi(["string"], data)[0]
+        except (Exception,):
+            pass
+    elif len(data) == 32:
+        text = data.rstrip(b"\0").decode("utf-8", errors="replace")
+    # PostgreSQL does not take NUL characters in text
+    return text.replace("\0", "")
+
+
+def _decode_decimals(data: bytes) -> int:
+    if len(data) != 32:
+        return 0
+    decimals = int.from_bytes(data, "big")
+    # Declared as uint8, anything above is not a real ERC20 decimals()
+    return decimals if decimals < 256 else 0
+
+
+class TokenMetadataResolver:
+    """
+    Resolves the name, symbol and decimals of many tokens at once: the three calls of every token go in a Multicall3
+    tryAggregate, so a call that reverts (or a token without one of the methods) only fails for itself, and the
+    aggregate calls of a batch of tokens go in one JSON-RPC batch. Tokens that another thread is resolving already are
+    waited for instead of fetched again. If the multicall fails (a chain without it, or the node rejects it) tokens
+    are resolved one eth_call at a time.
+
+    Missing or undecodable values are "" for names and symbols and 0 for decimals.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, batcher: JsonRpcBatcher = None, multicall_address: ChecksumAddress = MULTICALL_ADDRESS,
+                 tokens_per_call: int = TOKEN_METADATA_TOKENS_PER_CALL):
+        self.batcher = batcher
+        self.multicall_address = multicall_address
+        self.tokens_per_call = max(1, tokens_per_call)
+        self.__lock = threading.Lock()
+        self.__in_flight: Dict[ChecksumAddress, Future] = {}
+
+    def __str__(self):
+        return f"TokenMetadataResolver<{self.multicall_address}, {self.tokens_per_call} tokens per call>"
+
+    def resolve(self, token_addrs: Iterable[ChecksumAddress]) -> Dict[ChecksumAddress, Token]:
+        futures: Dict[ChecksumAddress, Future] = {}
+        to_fetch: List[ChecksumAddress] = []
+        with self.__lock:
+            for token_addr in set(token_addrs):
+                future = self.__in_flight.get(token_addr)
+                if future is None:
+                    future = self.__in_flight[token_addr] = Future()
+                    to_fetch.append(token_addr)
+                futures[token_addr] = future
+
+        try:
+            if to_fetch:
+                tokens = self.__fetch(to_fetch)
+                for token_addr in to_fetch:
+                    futures[token_addr].set_result(tokens[token_addr])
+        except (Exception,) as e:
+            for token_addr in to_fetch:
+                if not futures[token_addr].done():
+                    futures[token_addr].set_exception(e)
+            raise
+        finally:
+            with self.__lock:
+                for token_addr in to_fetch:
+                    self.__in_flight.pop(token_addr, None)
+
+        return {token_addr: future.result() for token_addr, future in futures.items()}
+
+    def __fetch(self, token_addrs: List[ChecksumAddress]) -> Dict[ChecksumAddress, Token]:
+        chunks = [
+            token_addrs[i:i + self.tokens_per_call] for i in range(0, len(token_addrs), self.tokens_per_call)
+        ]
+        try:
+            results = self.__aggregate([self.__calldata(chunk) for chunk in chunks])
+            tokens: Dict[ChecksumAddress, Token] = {}
+            for chunk, result in zip(chunks, results):
+                tokens.update(self.__decode(chunk, result))
+            return tokens
+        except (Exception,):
+            self.logger.exception(f"Could not resolve {len(token_addrs)} tokens with {self.multicall_address}, "
+                                  f"resolving them one by one")
+            return {token_addr: self.__fetch_one(token_addr) for token_addr in token_addrs}
+
+    def __calldata(self, token_addrs: List[ChecksumAddress]) -> str:
+        calls = [
+            (token_addr, selector) for token_addr in token_addrs
+            for selector in (NAME_SELECTOR, SYMBOL_SELECTOR, DECIMALS_SELECTOR)
+        ]
+        return HexBytes(TRY_AGGREGATE_SELECTOR + encode_abi(["bool", "(address,bytes)[]"], [False, calls])).hex()
+
+    def __aggregate(self, calldatas: List[str]) -> List[bytes]:
+        params_list = [[{"to": self.multicall_address, "data": calldata}, "latest"] for calldata in calldatas]
+        if self.batcher:
+            return [HexBytes(result) for result in self.batcher.request_many("eth_call", params_list)]
+        return [HexBytes(get_w3().eth.call(*params)) for params in params_list]
+
+    @staticmethod
+    def __decode(token_addrs: List[ChecksumAddress], result: bytes) -> Dict[ChecksumAddress, Token]:
+        returns: List[Tuple[bool, bytes]] = decode_abi(["(bool,bytes)[]"], result)[0]
+        if len(returns) != 3 * len(token_addrs):
+            raise ValueError(f"{len(returns)} results for {3 * len(token_addrs)} calls")
+
+        tokens = {}
+        for i, token_addr in enumerate(token_addrs):
+            (name_ok, name), (symbol_ok, symbol), (decimals_ok, decimals) = returns[3 * i:3 * i + 3]
+            tokens[token_addr] = Token(
+                address=token_addr,
+                name=_decode_text(name) if name_ok else "",
+                symbol=_decode_text(symbol) if symbol_ok else "",
+                decimals=_decode_decimals(decimals) if decimals_ok else 0
+            )
+        return tokens
+
+    @staticmethod
+    def __fetch_one(token_addr: ChecksumAddress) -> Token:
+        contract = get_erc20_contract(get_w3(), token_addr)
+        try:
+            name = contract.functions.name().call()
+        except (Exception,):
+            name = ""
+
+        try:
+            symbol = contract.functions.symbol().call()
+        except (Exception,):
+            symbol = ""
+
+        try:
+            decimals = contract.functions.decimals().call()
+        except (Exception,):
+            decimals = 0
+
+        return Token(address=token_addr, name=name, symbol=symbol, decimals=decimals)
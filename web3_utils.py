@@ -2,21 +2,24 @@
 import json
 import logging
 import os
-import threading
 import random
 import time
 from functools import lru_cache
-from typing import Union, Optional, Tuple
+from typing import List, Union, Optional, Tuple
 from urllib import request
 
 from eth_account.signers.local import LocalAccount
 from eth_typing import Address, ChecksumAddress
 from hexbytes import HexBytes
 from web3 import Web3
+from web3._utils.rpc_abi import RPC
 from web3.contract import ContractFunction, Contract
 from web3.exceptions import TransactionNotFound
 from web3.middleware import geth_poa_middleware
-from web3.types import Wei, TxParams
+from web3.types import FilterParams, Wei, TxParams
+
+from provider_scheduler import ProviderScheduler, ScheduledProvider
+from rpc_cache import CachingProvider, RpcResponseCache
 
 TEST_MODE_DRY_RUN = False
 
@@ -45,6 +48,9 @@ TESTNET_PANCAKE_SWAP_FACTORY = "0xB7926C0430Afb07AA7DEfDE6DA862aE0Bde767bc"
 
 MAX_APPROVAL_INT = int(f"0x{64 * 'f'}", 16)
 
+SYNC_EVENT_TOPIC = Web3.keccak(text="Sync(uint112,uint112)").hex()
+PAIR_CREATED_EVENT_TOPIC = Web3.keccak(text="PairCreated(address,address,address,uint256)").hex()
+
 logger = logging.getLogger(__name__)
 
 # Sorted from best to worst.
@@ -64,47 +70,48 @@ WEB3_PROVIDERS = [
     # Web3.HTTPProvider("https://bsc-dataseed4.binance.org/"),
 ]
 
+# Comma separated endpoints replacing the public ones, e.g. a local node or the mock_node.py used by benchmarks
+if os.getenv("WEB3_PROVIDER_URLS"):
+    WEB3_PROVIDERS = [Web3.HTTPProvider(url) for url in os.getenv("WEB3_PROVIDER_URLS").split(",")]
+
 WEB3_TESTNET_PROVIDERS = [
     Web3.HTTPProvider("https://data-seed-prebsc-2-s1.binance.org:8545/")
 ]
 
-__providers_used = {
-    False: {provider: (0, index) for index, provider, in enumerate(WEB3_PROVIDERS)}, # For mainnet
-    True: {provider: (0, index) for index, provider in enumerate(WEB3_TESTNET_PROVIDERS)}, # For testnet
-}
-__provider_lock = threading.Lock()
-MAX_RETRIES = 5 * sum(len(candidates) for candidates in __providers_used.values())
 IPC_PATH = os.getenv("WEB3_IPC_PATH", "")
+# SQLite file where responses about final blocks are kept across runs, empty disables it
+RPC_CACHE_PATH = os.getenv("RPC_CACHE_PATH", "")
 
-@lru_cache(maxsize=None)
-def _create_best_provider(thread: threading.Thread, testnet=False) -> Web3:
-    if IPC_PATH:
-        return Web3.IPCProvider(IPC_PATH)
-
-    with __provider_lock:
-        logger.debug(f"Creating WEB3 instance for {thread}")
 
-        for retries in range(MAX_RETRIES):
-            best_provider = min(__providers_used[testnet], key=__providers_used[testnet].get)
-            try:
-                web3 = Web3(best_provider)
-                web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-                if not web3.isConnected():
-                    raise ValueError("Not connected!")
+@lru_cache(maxsize=None)
+def get_provider_scheduler(testnet=False) -> ProviderScheduler:
+    """ Shared by every thread of the process, so that rate limits and provider health are tracked as a whole """
+    providers = WEB3_TESTNET_PROVIDERS if testnet else WEB3_PROVIDERS
+    return ProviderScheduler([provider.endpoint_uri for provider in providers])
 
-                logger.debug(f"{threading.current_thread().name} got provider: {best_provider}")
-                return web3
-            except (Exception,) as e:
-                logger.warning(f"Skipping {best_provider}: {e}")
-            finally:
-                n_used, priority = __providers_used[testnet][best_provider]
-                __providers_used[testnet][best_provider] = n_used + 1, priority
 
-        raise ValueError(f"No provider available after {MAX_RETRIES} tries!")
+@lru_cache(maxsize=None)
+def get_rpc_cache(testnet=False) -> Optional[RpcResponseCache]:
+    if not RPC_CACHE_PATH:
+        return None
+    return RpcResponseCache(
+        f"{RPC_CACHE_PATH}.testnet" if testnet else RPC_CACHE_PATH,
+        head_fetcher=lambda: get_w3(testnet).eth.block_number
+    )
 
 
+@lru_cache(maxsize=None)
 def get_w3(testnet=False) -> Web3:
-    return _create_best_provider(threading.current_thread(), testnet)
+    """ Shared by every thread: each request picks its provider, and connections are pooled per host """
+    logger.debug(f"Creating WEB3 instance (testnet: {testnet})")
+    if IPC_PATH:
+        provider = Web3.IPCProvider(IPC_PATH)
+    else:
+        provider = ScheduledProvider(get_provider_scheduler(testnet))
+    rpc_cache = get_rpc_cache(testnet)
+    web3 = Web3(CachingProvider(provider, rpc_cache) if rpc_cache else provider)
+    web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    return web3
 
 
 def _deadline() -> int:
@@ -282,6 +289,25 @@ def decode_tx_input(web_provider, tx):
 def get_lptoken_contract(w3, addr: ChecksumAddress):
     return w3.eth.contract(address=addr, abi=PANCAKE_SWAP_LP_ABI)
 
+
+def get_raw_logs(w3: Web3, log_filter: FilterParams) -> List[dict]:
+    """
+    eth_getLogs straight to the provider, with the logs as the node sent them (see log_decoder.py). Skips the
+    middlewares that validate the addresses of the filter: web3 only takes checksum addresses, and checksumming every
+    address polled in every window takes longer than the request. Nodes take them in any case.
+    """
+    rpc_filter = dict(log_filter)
+    for block_key in ('fromBlock', 'toBlock'):
+        if isinstance(rpc_filter.get(block_key), int):
+            rpc_filter[block_key] = hex(rpc_filter[block_key])
+
+    response = w3.provider.make_request(RPC.eth_getLogs, [rpc_filter])
+    if "error" in response:
+        # What web3 raises for error responses
+        raise ValueError(response["error"])
+    return response["result"]
+
+
 def get_router_contract(w3, testnet=False) -> Contract:
     router_addr = TESTNET_PANCAKE_SWAP_ROUTER if testnet else PANCAKE_SWAP_ROUTER
     return w3.eth.contract(address=router_addr, abi=PANCAKE_SWAP_ROUTER_ABI)